@@ -1,11 +1,11 @@
 from django.contrib import admin
-from .models import Conversation, Message, ConversationAnalysis
+from .models import AnalysisJob, AnalysisRollup, Conversation, Message, ConversationAnalysis, TermStatistics
 
 
 @admin.register(Conversation)
 class ConversationAdmin(admin.ModelAdmin):
-    list_display = ['id', 'title', 'created_at', 'analyzed']
-    list_filter = ['analyzed', 'created_at']
+    list_display = ['id', 'title', 'bot', 'created_at', 'analyzed', 'archived_at']
+    list_filter = ['analyzed', 'bot', 'created_at', 'archived_at']
     search_fields = ['title']
 
 
@@ -13,7 +13,9 @@ class ConversationAdmin(admin.ModelAdmin):
 class MessageAdmin(admin.ModelAdmin):
     list_display = ['id', 'conversation', 'sender', 'text_preview', 'timestamp']
     list_filter = ['sender', 'timestamp']
-    search_fields = ['text']
+    # Deduplicated texts are searched in MessageText (uncompressed ones)
+    search_fields = ['text', 'stored_text__text']
+    raw_id_fields = ['stored_text']
     
     def text_preview(self, obj):
         return obj.text[:50] + '...' if len(obj.text) > 50 else obj.text
@@ -32,3 +34,25 @@ class ConversationAnalysisAdmin(admin.ModelAdmin):
     ]
     list_filter = ['sentiment', 'resolution', 'escalation_needed']
     readonly_fields = ['created_at']
+
+
+
+@admin.register(AnalysisRollup)
+class AnalysisRollupAdmin(admin.ModelAdmin):
+    list_display = ['day', 'bot', 'analyses', 'positive', 'neutral', 'negative', 'resolved', 'escalated']
+    list_filter = ['bot']
+    date_hierarchy = 'day'
+
+
+@admin.register(AnalysisJob)
+class AnalysisJobAdmin(admin.ModelAdmin):
+    list_display = ['id', 'conversation', 'status', 'created_at', 'finished_at']
+    list_filter = ['status']
+    readonly_fields = ['created_at', 'started_at', 'finished_at']
+
+
+@admin.register(TermStatistics)
+class TermStatisticsAdmin(admin.ModelAdmin):
+    list_display = ['id', 'documents', 'created_at']
+    # The token table itself is too large to render
+    exclude = ['frequencies']
@@ -4,3 +4,9 @@ from django.apps import AppConfig
 class AnalysisConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'analysis'
+
+    def ready(self):
+        from . import signals  # noqa: F401
+        from .metrics import load_plugins
+
+        load_plugins()
@@ -0,0 +1,600 @@
+"""
+Cold storage of old conversations in compressed columnar files
+
+Archiving moves the messages and the analysis of analyzed conversations
+into NumPy .npz files in ARCHIVE_DIR, one pair per chunk of conversations,
+and leaves the Conversation row behind as a stub pointing at its files.
+Messages never change once archived; analyses go to a small file of
+their own (<name>.analyses.npz), the only one a re-score rewrites. Every
+column is a separately deflated member of its file, so reading one
+column never decompresses the others:
+
+    conversation.id               int64, one row per conversation
+    conversation.message_offsets  int64, messages of conversation i are
+                                  rows offsets[i]:offsets[i + 1]
+    message.id / .timestamp       int64 (timestamps in UTC microseconds)
+    message.sender / .text        strings, as .data (UTF-8 bytes) and
+                                  .offsets like Arrow's string arrays
+    analysis.conversation         int64, the conversation of each analysis
+    analysis.<field>              one column per ConversationAnalysis field,
+                                  with a .valid mask where it can be null
+
+ArchiveFile reads them back one file at a time, as lightweight objects
+ConversationAnalyzer analyzes like loaded conversations, so archived
+conversations are re-scored without loading them into the database.
+Archived analyses still count in the summary rollups.
+"""
+import json
+import logging
+import os
+import tempfile
+from datetime import datetime, timedelta, timezone as dt_timezone
+from pathlib import Path
+
+import numpy as np
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Min
+from django.utils import timezone
+
+from .metrics import registry
+from .models import Conversation, ConversationAnalysis, Message
+from .rollups import RollupDeltas, analysis_values
+from .services import ConversationAnalyzer, content_hash
+from .texts import get_texts
+
+
+logger = logging.getLogger(__name__)
+
+# Bumped whenever the layout of the files changes
+FORMAT_VERSION = 1
+
+# Archived conversations are never appended to, so their running state
+# is not kept
+ANALYSIS_FIELDS = [
+    field for field in ConversationAnalysis._meta.concrete_fields
+    if field.name not in ('id', 'conversation', 'running_state')
+]
+
+_EPOCH = datetime(1970, 1, 1, tzinfo=dt_timezone.utc)
+
+
+def get_archive_dir():
+    return Path(getattr(settings, 'ARCHIVE_DIR', Path(settings.BASE_DIR) / 'archive'))
+
+
+def _micros(timestamp):
+    if timestamp.tzinfo is None:
+        timestamp = timestamp.replace(tzinfo=dt_timezone.utc)
+    return (timestamp - _EPOCH) // timedelta(microseconds=1)
+
+
+def _datetime(micros):
+    return _EPOCH + timedelta(microseconds=int(micros))
+
+
+def _pack_strings(name, values):
+    """
+    Returns: {name.data: UTF-8 bytes of every value, name.offsets: start of
+    each value in data, plus the end}
+    """
+    encoded = [value.encode('utf-8') for value in values]
+    return _pack_bytes(name, encoded)
+
+
+def _pack_bytes(name, values):
+    offsets = np.zeros(len(values) + 1, dtype=np.int64)
+    np.cumsum([len(value) for value in values], out=offsets[1:])
+    return {
+        f'{name}.data': np.frombuffer(b''.join(values), dtype=np.uint8),
+        f'{name}.offsets': offsets,
+    }
+
+
+def _unpack_bytes(columns, name):
+    data = columns[f'{name}.data'].tobytes()
+    offsets = columns[f'{name}.offsets'].tolist()
+    return [data[start:end] for start, end in zip(offsets, offsets[1:])]
+
+
+def _unpack_strings(columns, name):
+    return [value.decode('utf-8') for value in _unpack_bytes(columns, name)]
+
+
+def _pack_field(field, values):
+    """
+    Columns of one ConversationAnalysis field
+    """
+    name = f'analysis.{field.name}'
+    kind = field.get_internal_type()
+    columns = {}
+    if field.null:
+        valid = np.array([value is not None for value in values], dtype=bool)
+        if not valid.all():
+            columns[f'{name}.valid'] = valid
+    if kind == 'FloatField':
+        columns[name] = np.array([np.nan if value is None else value for value in values], dtype=np.float64)
+    elif kind in ('IntegerField', 'BigIntegerField'):
+        columns[name] = np.array([value or 0 for value in values], dtype=np.int64)
+    elif kind == 'BooleanField':
+        columns[name] = np.array(values, dtype=bool)
+    elif kind == 'DateTimeField':
+        columns[name] = np.array([_micros(value) if value else 0 for value in values], dtype=np.int64)
+    elif kind == 'BinaryField':
+        columns.update(_pack_bytes(name, [bytes(value or b'') for value in values]))
+    elif kind == 'JSONField':
+        columns.update(_pack_strings(name, [json.dumps(value) for value in values]))
+    else:
+        columns.update(_pack_strings(name, values))
+    return columns
+
+
+def _unpack_field(columns, field):
+    name = f'analysis.{field.name}'
+    kind = field.get_internal_type()
+    if kind in ('FloatField', 'IntegerField', 'BigIntegerField', 'BooleanField'):
+        values = columns[name].tolist()
+    elif kind == 'DateTimeField':
+        values = [_datetime(micros) for micros in columns[name].tolist()]
+    elif kind == 'BinaryField':
+        values = _unpack_bytes(columns, name)
+    elif kind == 'JSONField':
+        values = [json.loads(value) for value in _unpack_strings(columns, name)]
+    else:
+        values = _unpack_strings(columns, name)
+    if f'{name}.valid' in columns:
+        values = [
+            value if valid else None
+            for value, valid in zip(values, columns[f'{name}.valid'].tolist())
+        ]
+    return values
+
+
+def analysis_columns(analyses):
+    """
+    Columns of ConversationAnalysis instances (or objects with the same
+    attributes)
+    """
+    columns = {'analysis.conversation': np.array([a.conversation_id for a in analyses], dtype=np.int64)}
+    for field in ANALYSIS_FIELDS:
+        columns.update(_pack_field(field, [getattr(a, field.attname) for a in analyses]))
+    return columns
+
+
+def conversation_columns(conversation_ids, messages):
+    """
+    Columns of conversations and their messages
+    conversation_ids: in ascending order
+    messages: (conversation_id, id, sender, text, timestamp) rows, by
+    conversation in the same order
+    """
+    owners, message_ids, senders, texts, timestamps = zip(*messages) if messages else ((),) * 5
+    ids = np.array(conversation_ids, dtype=np.int64)
+    return {
+        'conversation.id': ids,
+        'conversation.message_offsets': np.searchsorted(
+            np.array(owners, dtype=np.int64), np.append(ids, ids[-1] + 1)
+        ).astype(np.int64),
+        'message.id': np.array(message_ids, dtype=np.int64),
+        'message.timestamp': np.array([_micros(timestamp) for timestamp in timestamps], dtype=np.int64),
+        **_pack_strings('message.sender', senders),
+        **_pack_strings('message.text', texts),
+    }
+
+
+def message_rows(conversation_ids):
+    """
+    Returns: (conversation_id, id, sender, text, timestamp) of the messages
+    of conversations, by conversation and in timestamp order, read as
+    tuples rather than model instances
+    """
+    rows = list(
+        Message.objects.filter(conversation_id__in=conversation_ids)
+        .order_by('conversation_id', 'timestamp', 'id')
+        .values_list('conversation_id', 'id', 'sender', 'text', 'stored_text_id', 'timestamp')
+    )
+    texts = get_texts({row[4] for row in rows if row[4]})
+    return [
+        (conversation_id, message_id, sender, texts[text_hash] if text_hash else text, timestamp)
+        for conversation_id, message_id, sender, text, text_hash, timestamp in rows
+    ]
+
+
+def analyses_path(path):
+    """
+    Returns: the path of the analyses file going with the archive file path
+    """
+    path = Path(path)
+    return path.with_name(f'{path.stem}.analyses.npz')
+
+
+def _write_temporary(path, columns):
+    """
+    Write columns to a compressed .npz file next to path, to be moved
+    into place with os.replace
+    Returns: the path of the temporary file
+    """
+    path = Path(path)
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd, temporary = tempfile.mkstemp(dir=path.parent, prefix='.archive-', suffix='.npz')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            np.savez_compressed(f, format=np.array(FORMAT_VERSION), **columns)
+    except BaseException:
+        os.unlink(temporary)
+        raise
+    return temporary
+
+
+def write_columns(path, columns):
+    """
+    Write columns to a compressed .npz file atomically, so readers never
+    see a partial file
+    """
+    temporary = _write_temporary(path, columns)
+    try:
+        os.replace(temporary, path)
+    except BaseException:
+        os.unlink(temporary)
+        raise
+
+
+class ArchivedMessage:
+    __slots__ = ('id', 'conversation_id', 'sender', 'text', 'timestamp')
+
+    def __init__(self, id, conversation_id, sender, text, timestamp):
+        self.id = id
+        self.conversation_id = conversation_id
+        self.sender = sender
+        self.text = text
+        self.timestamp = timestamp
+
+
+class _ArchivedMessages:
+    # Stands in for conversation.messages with its messages prefetched
+
+    def __init__(self, messages):
+        self._messages = messages
+
+    def all(self):
+        return self._messages
+
+
+class ArchivedConversation:
+    """
+    An archived conversation's id and messages, as ConversationAnalyzer
+    reads them from a loaded Conversation
+    """
+
+    def __init__(self, id, messages):
+        self.id = id
+        self.messages = _ArchivedMessages(messages)
+
+
+def read_columns(path):
+    """
+    Returns: the columns of an .npz file, each read when first accessed
+    Raises: OSError if it cannot be read, ValueError if it is not an
+    archive file of this format
+    """
+    columns = np.load(path, allow_pickle=False)
+    if 'format' not in columns or int(columns['format']) != FORMAT_VERSION:
+        columns.close()
+        raise ValueError(f'{path} is not a conversation archive of format {FORMAT_VERSION}')
+    return columns
+
+
+class ArchiveFile:
+    """
+    One archive file and its analyses file, read column by column on demand
+    Raises: see read_columns
+    """
+
+    def __init__(self, path):
+        self.path = Path(path)
+        self._columns = read_columns(self.path)
+        try:
+            self._analyses = read_columns(analyses_path(self.path))
+        except BaseException:
+            self._columns.close()
+            raise
+
+    def close(self):
+        self._columns.close()
+        self._analyses.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    @property
+    def conversation_ids(self):
+        return self._columns['conversation.id'].tolist()
+
+    def conversations(self):
+        """
+        Returns: list of ArchivedConversation in id order
+        """
+        columns = self._columns
+        ids = self.conversation_ids
+        offsets = columns['conversation.message_offsets'].tolist()
+        message_ids = columns['message.id'].tolist()
+        senders = _unpack_strings(columns, 'message.sender')
+        texts = _unpack_strings(columns, 'message.text')
+        timestamps = columns['message.timestamp'].tolist()
+        conversations = []
+        for index, conversation_id in enumerate(ids):
+            conversations.append(ArchivedConversation(conversation_id, [
+                ArchivedMessage(message_ids[i], conversation_id, senders[i], texts[i], _datetime(timestamps[i]))
+                for i in range(offsets[index], offsets[index + 1])
+            ]))
+        return conversations
+
+    def analysis_values(self, names=None):
+        """
+        Returns: list of {field: value} of the archived analyses, with their
+        conversation_id; only the fields in names (and only their columns
+        are read) if given
+        """
+        fields = [field for field in ANALYSIS_FIELDS if names is None or field.name in names]
+        values = {field.attname: _unpack_field(self._analyses, field) for field in fields}
+        return [
+            {'conversation_id': conversation_id, **{name: column[index] for name, column in values.items()}}
+            for index, conversation_id in enumerate(self._analyses['analysis.conversation'].tolist())
+        ]
+
+    def analyses(self):
+        """
+        Returns: {conversation id: unsaved ConversationAnalysis}
+        """
+        return {values['conversation_id']: ConversationAnalysis(**values) for values in self.analysis_values()}
+
+
+def archived_files():
+    """
+    Paths of the archive files stubs point to, in order (the analyses
+    files go with them, see analyses_path)
+    Files no stub points to (left by an interrupted run) are ignored
+    """
+    files = (
+        Conversation.objects.filter(archived_at__isnull=False)
+        .values('archive').annotate(first_id=Min('id')).order_by('first_id')
+    )
+    directory = get_archive_dir()
+    return [directory / row['archive'] for row in files]
+
+
+def iter_archives():
+    """
+    Yields: each ArchiveFile in turn, closed once the next one is requested
+    """
+    for path in archived_files():
+        with ArchiveFile(path) as archive:
+            yield archive
+
+
+def stub_bots(conversation_ids):
+    """
+    Returns: {conversation id: bot} from the stubs, which keep the bot
+    """
+    return dict(Conversation.objects.filter(id__in=conversation_ids).values_list('id', 'bot'))
+
+
+class _Changed(Exception):
+    pass
+
+
+def archivable(older_than):
+    """
+    Analyzed conversations created before older_than and not archived yet;
+    conversations awaiting analysis are left for the nightly run
+    (archive_chunk also checks the analyses are up to date)
+    """
+    return Conversation.objects.filter(
+        created_at__lt=older_than, analyzed=True, archived_at__isnull=True
+    ).order_by('id')
+
+
+def stale_analyses(analyzer, conversation_ids, messages, analyses):
+    """
+    Conversations whose analysis does not match their messages: they got
+    messages since, were analyzed partially or by other scoring rules, or
+    have messages but no analysis
+    messages: message_rows of the conversations
+    analyses: their ConversationAnalysis instances
+    Returns: set of conversation ids
+    """
+    by_conversation = {conversation_id: [] for conversation_id in conversation_ids}
+    for conversation_id, message_id, sender, text, timestamp in messages:
+        by_conversation[conversation_id].append(
+            ArchivedMessage(message_id, conversation_id, sender, text, timestamp)
+        )
+    fingerprints = {analysis.conversation_id: analysis.fingerprint for analysis in analyses}
+    stale = set()
+    for conversation_id, conversation_messages in by_conversation.items():
+        stored = fingerprints.get(conversation_id)
+        if stored is None:
+            if conversation_messages:
+                stale.add(conversation_id)
+        elif stored != analyzer.fingerprint(content_hash(conversation_messages)):
+            stale.add(conversation_id)
+    return stale
+
+
+def _delete_archived_rows(model, archive):
+    """
+    Delete the rows of model belonging to the conversations just stubbed
+    to the archive file named archive, with one plain DELETE
+
+    Deliberately not QuerySet.delete(): its per-row signals would take
+    the analyses out of the rollups, where archived analyses keep
+    counting, and drop running states and mark the conversations
+    unanalyzed as if their messages had been edited
+    """
+    quote = connection.ops.quote_name
+    sql = (
+        f'DELETE FROM {quote(model._meta.db_table)} '
+        f'WHERE {quote(model._meta.get_field("conversation").column)} IN ('
+        f'SELECT {quote(Conversation._meta.pk.column)} FROM {quote(Conversation._meta.db_table)} '
+        f'WHERE {quote(Conversation._meta.get_field("archive").column)} = %s)'
+    )
+    with connection.cursor() as cursor:
+        cursor.execute(sql, [archive])
+
+
+def archive_chunk(conversation_ids, analyzer=None):
+    """
+    Archive conversations to one pair of files and turn their rows into stubs
+    Conversations with a stale analysis (see stale_analyses) are marked
+    unanalyzed instead, for the nightly run to analyze them again
+    Returns: (conversations, messages) archived; (0, 0) if one of them
+    got new messages or a new analysis meanwhile, in which case none is
+    archived
+    """
+    analyzer = analyzer or ConversationAnalyzer()
+    ids = sorted(conversation_ids)
+    analyses = list(
+        ConversationAnalysis.objects.filter(conversation_id__in=ids)
+        .defer('running_state').order_by('conversation_id')
+    )
+    messages = message_rows(ids)
+    stale = stale_analyses(analyzer, ids, messages, analyses)
+    if stale:
+        Conversation.objects.filter(id__in=stale, archived_at__isnull=True).update(analyzed=False)
+        ids = [conversation_id for conversation_id in ids if conversation_id not in stale]
+        if not ids:
+            return 0, 0
+        analyses = [analysis for analysis in analyses if analysis.conversation_id not in stale]
+        messages = [row for row in messages if row[0] not in stale]
+
+    columns = conversation_columns(ids, messages)
+    path = get_archive_dir() / f'conversations-{ids[0]}-{ids[-1]}.npz'
+    written = []
+    try:
+        write_columns(path, columns)
+        written.append(path)
+        write_columns(analyses_path(path), analysis_columns(analyses))
+        written.append(analyses_path(path))
+
+        with transaction.atomic():
+            # Appending messages marks a conversation unanalyzed in the
+            # same transaction, so its rows are not touched
+            stubbed = Conversation.objects.filter(id__in=ids, analyzed=True, archived_at__isnull=True).update(
+                archived_at=timezone.now(), archive=path.name
+            )
+            if stubbed != len(ids):
+                raise _Changed()
+            # The UPDATE holds the stubs (the whole database on SQLite), and
+            # write_analyses locks conversations before saving, so this
+            # reads the analyses as they will stay
+            fingerprints = dict(
+                ConversationAnalysis.objects.filter(conversation_id__in=ids)
+                .order_by().values_list('conversation_id', 'fingerprint')
+            )
+            if fingerprints != {analysis.conversation_id: analysis.fingerprint for analysis in analyses}:
+                raise _Changed()
+            _delete_archived_rows(Message, path.name)
+            _delete_archived_rows(ConversationAnalysis, path.name)
+    except BaseException as e:
+        for written_path in written:
+            os.unlink(written_path)
+        if not isinstance(e, _Changed):
+            raise
+        logger.warning(f"Skipped archiving conversations {ids[0]}-{ids[-1]}: they changed while archiving")
+        return 0, 0
+    return len(ids), len(columns['message.id'])
+
+
+def archive_conversations(older_than, chunk_size=None):
+    """
+    Archive every analyzed conversation created before older_than, in
+    files of ARCHIVE_CHUNK_SIZE conversations
+    Returns: {'conversations': n, 'messages': n, 'files': n}
+    """
+    chunk_size = chunk_size or getattr(settings, 'ARCHIVE_CHUNK_SIZE', 5000)
+    analyzer = ConversationAnalyzer()
+    totals = {'conversations': 0, 'messages': 0, 'files': 0}
+    last_id = 0
+    while True:
+        ids = list(archivable(older_than).filter(id__gt=last_id).values_list('id', flat=True)[:chunk_size])
+        if not ids:
+            return totals
+        last_id = ids[-1]
+        conversations, messages = archive_chunk(ids, analyzer)
+        if conversations:
+            totals['conversations'] += conversations
+            totals['messages'] += messages
+            totals['files'] += 1
+
+
+def _lock_stubs(archive):
+    """
+    Lock the stubs of the archive file named archive until the end of the
+    transaction, so re-scores of one file run one after the other
+    """
+    stubs = Conversation.objects.filter(archive=archive)
+    if connection.features.has_select_for_update:
+        list(stubs.select_for_update().order_by('id').values_list('id', flat=True))
+    else:
+        # SQLite has no row locks: a write takes the database lock (and
+        # waits for it, unlike a read upgraded later, see write_analyses)
+        stubs.update(archive=archive)
+
+
+def rescore_archive(path, analyzer=None):
+    """
+    Analyze the conversations of one archive file again (after scoring
+    rules changed) and replace its analyses; the rollups are updated
+    with the difference
+
+    The conversations are analyzed first; the old analyses are then read,
+    the rollups updated and the new analyses file moved into place in one
+    transaction holding the file's stubs, so concurrent re-scores do not
+    subtract the same old values twice
+    Returns: number of conversations analyzed
+    """
+    analyzer = analyzer or ConversationAnalyzer()
+    path = Path(path)
+    with ArchiveFile(path) as archive:
+        conversations = archive.conversations()
+
+    scored = [conversation for conversation in conversations if conversation.messages.all()]
+    results = analyzer.analyze_batch(scored)
+    bots = stub_bots([conversation.id for conversation in scored])
+
+    with transaction.atomic():
+        _lock_stubs(path.name)
+        with ArchiveFile(path) as archive:
+            analyses = archive.analyses()
+
+        deltas = RollupDeltas()
+        now = timezone.now()
+        for conversation, analysis_data in zip(scored, results):
+            bot = bots.get(conversation.id, '')
+            analysis = analyses.get(conversation.id)
+            if analysis is None:
+                analysis = analyses[conversation.id] = ConversationAnalysis(
+                    conversation_id=conversation.id, created_at=now
+                )
+            else:
+                deltas.add(analysis_values(analysis), bot, sign=-1)
+            # Like writer.prepare_analysis: metrics left out go back to defaults
+            for field in registry.fields():
+                setattr(analysis, field, ConversationAnalysis._meta.get_field(field).get_default())
+            for name, value in analysis_data.items():
+                setattr(analysis, name, value)
+            deltas.add(analysis_values(analysis), bot)
+
+        temporary = _write_temporary(analyses_path(path), analysis_columns([
+            analyses[conversation.id] for conversation in conversations if conversation.id in analyses
+        ]))
+        try:
+            deltas.apply()
+            # Last, so a failed update leaves the old file in place
+            os.replace(temporary, analyses_path(path))
+        except BaseException:
+            os.unlink(temporary)
+            raise
+    return len(scored)
@@ -0,0 +1,171 @@
+"""
+Async versions of the upload, analyse and reports endpoints, for ASGI
+servers (uvicorn conversation_analyzer.asgi:application)
+
+Database access uses the async ORM and the CPU-bound analysis runs on a
+bounded thread pool, so the event loop keeps serving other clients while
+a request waits on either. These are plain Django async views: DRF views
+are sync and would each take a thread under ASGI
+"""
+import asyncio
+import json
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.db import close_old_connections
+from django.http import HttpResponseNotAllowed, JsonResponse
+from rest_framework import status
+
+from .metrics import UnknownMetric, registry
+from .models import Conversation
+from .pagination import InvalidCursor, akeyset_page, andjson_response
+from .serializers import AnalysisSerializer, ConversationCreateSerializer
+from .services import ConversationAnalyzer
+from .views import analysis_response, filter_reports, report_queryset, uploaded
+
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_analysis_executor():
+    """
+    Process-wide pool of ANALYSIS_ASYNC_THREADS threads running analyses
+    for the async views
+    """
+    global _executor
+    if _executor is None:
+        with _executor_lock:
+            if _executor is None:
+                _executor = ThreadPoolExecutor(
+                    max_workers=getattr(settings, 'ANALYSIS_ASYNC_THREADS', 4),
+                    thread_name_prefix='analysis-async'
+                )
+    return _executor
+
+
+def _in_pool_thread(function, *args):
+    # Pool threads keep their connections between calls, like request
+    # threads do; drop the ones past CONN_MAX_AGE or broken
+    close_old_connections()
+    try:
+        return function(*args)
+    finally:
+        close_old_connections()
+
+
+async def offload(function, *args):
+    """
+    Run function(*args) on the analysis thread pool without blocking the event loop
+    """
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(get_analysis_executor(), partial(_in_pool_thread, function, *args))
+
+
+def csrf_exempt(view):
+    # django.views.decorators.csrf.csrf_exempt only supports async views
+    # from Django 5.0; the middleware just checks this attribute
+    view.csrf_exempt = True
+    return view
+
+
+def _json_body(request):
+    """
+    Returns: the JSON object in the request body
+    Raises: ValueError if the body is not a JSON object
+    """
+    try:
+        data = json.loads(request.body or b'{}')
+    except (ValueError, UnicodeDecodeError):
+        raise ValueError('Request body must be JSON')
+    if not isinstance(data, dict):
+        raise ValueError('Request body must be a JSON object')
+    return data
+
+
+def _error(message, code=status.HTTP_400_BAD_REQUEST):
+    return JsonResponse({'error': message}, status=code)
+
+
+@csrf_exempt
+async def upload_conversation(request):
+    """
+    POST /api/async/conversations/
+    Same as POST /api/conversations/
+    """
+    if request.method != 'POST':
+        return HttpResponseNotAllowed(['POST'])
+    try:
+        data = _json_body(request)
+    except ValueError as e:
+        return _error(str(e))
+
+    serializer = ConversationCreateSerializer(data=data)
+    if not serializer.is_valid():
+        return JsonResponse(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+    # The async ORM has no transactions yet (Django 4.2): the conversation
+    # and its messages are written in one transaction on the sync thread
+    # (ConversationCreateSerializer.create), so a failure or a cancelled
+    # request never leaves a conversation without its messages
+    conversation = await sync_to_async(serializer.save, thread_sensitive=True)()
+
+    return JsonResponse(uploaded(conversation), status=status.HTTP_201_CREATED)
+
+
+def _analyze(conversation, metrics):
+    return analysis_response(ConversationAnalyzer(metrics=metrics), conversation)
+
+
+@csrf_exempt
+async def analyze_conversation(request):
+    """
+    POST /api/async/analyse/
+    Same as POST /api/analyse/, always answered with the analysis (there
+    is no "async" job mode: waiting for it costs no thread here)
+    """
+    if request.method != 'POST':
+        return HttpResponseNotAllowed(['POST'])
+    try:
+        data = _json_body(request)
+    except ValueError as e:
+        return _error(str(e))
+
+    conversation_id = data.get('conversation_id')
+    if not conversation_id:
+        return _error('conversation_id is required')
+
+    metrics = data.get('metrics', request.GET.get('metrics')) or None
+    try:
+        registry.resolve(metrics)
+    except UnknownMetric as e:
+        return _error(str(e))
+
+    try:
+        conversation = await Conversation.objects.select_related('analysis').aget(id=conversation_id)
+    except (Conversation.DoesNotExist, ValueError):
+        return _error(f'Conversation with id {conversation_id} not found', status.HTTP_404_NOT_FOUND)
+
+    body, code = await offload(_analyze, conversation, metrics)
+    return JsonResponse(body, status=code)
+
+
+async def get_reports(request):
+    """
+    GET /api/async/reports/
+    Same as GET /api/reports/ (?format=ndjson streams every row)
+    """
+    if request.method != 'GET':
+        return HttpResponseNotAllowed(['GET'])
+    try:
+        analyses = filter_reports(report_queryset(), request.GET)
+        if request.GET.get('format') == 'ndjson':
+            return andjson_response(analyses, request, AnalysisSerializer)
+        return JsonResponse(await akeyset_page(analyses, request, AnalysisSerializer))
+    except InvalidCursor:
+        return _error('Invalid cursor')
+    except ValueError as e:
+        return _error(str(e))
@@ -0,0 +1,185 @@
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+
+from django.conf import settings
+
+from .sentiment import FORMAT_VERSION, nltk_version
+
+
+logger = logging.getLogger(__name__)
+
+
+def normalize_text(text):
+    """
+    Collapse whitespace; VADER splits on whitespace, so this never
+    changes the score of a text
+    """
+    return ' '.join(text.split())
+
+
+def text_key(text):
+    return hashlib.blake2b(normalize_text(text).encode('utf-8'), digest_size=16).hexdigest()
+
+
+def redis_prefix():
+    """
+    Prefix of the Redis keys: scores cached by workers running another
+    sentiment engine or NLTK version (during a rolling upgrade) are kept
+    apart rather than shared
+    """
+    return f'sentiment:{FORMAT_VERSION}:{nltk_version()}:'
+
+
+class SentimentCache:
+    """
+    Bounded cache of VADER compound scores keyed by a hash of the
+    normalized text
+
+    Tier 1 is an in-process LRU of max_size entries; tier 2 is an
+    optional Redis shared by all workers. Redis errors are counted and
+    otherwise ignored, so a Redis outage only costs cache hits.
+    """
+
+    def __init__(self, max_size=50000, redis_url=None, ttl=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._redis = None
+        self.redis_prefix = redis_prefix()
+        if redis_url:
+            import redis
+            self._redis = redis.Redis.from_url(redis_url, socket_timeout=0.5, socket_connect_timeout=0.5)
+        self.reset_stats()
+
+    @property
+    def enabled(self):
+        return bool(self.max_size) or self._redis is not None
+
+    def reset_stats(self):
+        with self._lock:
+            self.hits = 0
+            self.misses = 0
+            self.evictions = 0
+            self.redis_hits = 0
+            self.redis_errors = 0
+
+    def _count(self, **increments):
+        # The cache is shared by threads (async views, local job pool), and
+        # += on an attribute is not atomic
+        with self._lock:
+            for name, increment in increments.items():
+                setattr(self, name, getattr(self, name) + increment)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'size': len(self._entries),
+                'max_size': self.max_size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'redis_hits': self.redis_hits,
+                'redis_errors': self.redis_errors,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+            }
+
+    def _get_local(self, key):
+        with self._lock:
+            value = self._entries.get(key)
+            if value is not None:
+                self._entries.move_to_end(key)
+            return value
+
+    def _set_local(self, key, value):
+        if not self.max_size:
+            return
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def get_many(self, texts, compute_many):
+        """
+        Look up the score of every text, computing all misses with one
+        compute_many(texts) call
+        Returns: list of scores in the order of texts
+        """
+        keys = [text_key(text) for text in texts]
+        scores = [self._get_local(key) for key in keys]
+
+        missing = [i for i, score in enumerate(scores) if score is None]
+        self._count(hits=len(texts) - len(missing))
+
+        if missing and self._redis is not None:
+            try:
+                cached = self._redis.mget([self.redis_prefix + keys[i] for i in missing])
+            except Exception as e:
+                self._count(redis_errors=1)
+                logger.warning(f"Sentiment cache Redis lookup failed: {e}")
+                cached = [None] * len(missing)
+            still_missing = []
+            for i, value in zip(missing, cached):
+                if value is None:
+                    still_missing.append(i)
+                else:
+                    scores[i] = float(value)
+                    self._set_local(keys[i], scores[i])
+            found = len(missing) - len(still_missing)
+            self._count(redis_hits=found, hits=found)
+            missing = still_missing
+
+        # The same text can appear several times in one call
+        unique = {}
+        for i in missing:
+            unique.setdefault(keys[i], texts[i])
+        computed = dict(zip(unique, compute_many(list(unique.values())))) if unique else {}
+        for key, score in computed.items():
+            self._set_local(key, score)
+        for i in missing:
+            scores[i] = computed[keys[i]]
+        self._count(misses=len(computed), hits=len(missing) - len(computed))
+
+        if computed and self._redis is not None:
+            try:
+                pipeline = self._redis.pipeline(transaction=False)
+                for key, score in computed.items():
+                    pipeline.set(self.redis_prefix + key, score, ex=self.ttl)
+                pipeline.execute()
+            except Exception as e:
+                self._count(redis_errors=1)
+                logger.warning(f"Sentiment cache Redis write failed: {e}")
+
+        return scores
+
+    def get(self, text, compute):
+        return self.get_many([text], lambda texts: [compute(text) for text in texts])[0]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+_sentiment_cache = None
+_sentiment_cache_lock = threading.Lock()
+
+
+def get_sentiment_cache():
+    """
+    Process-wide SentimentCache configured from settings
+    """
+    global _sentiment_cache
+    if _sentiment_cache is None:
+        with _sentiment_cache_lock:
+            if _sentiment_cache is None:
+                _sentiment_cache = SentimentCache(
+                    max_size=getattr(settings, 'SENTIMENT_CACHE_SIZE', 50000),
+                    redis_url=getattr(settings, 'SENTIMENT_CACHE_REDIS_URL', None),
+                    ttl=getattr(settings, 'SENTIMENT_CACHE_TTL', None),
+                )
+    return _sentiment_cache
@@ -0,0 +1,336 @@
+"""
+Streaming bulk export of analyses as CSV, NDJSON or Parquet
+
+The query is a values_list() in id order, read with
+iterator() (a server-side cursor where the database has them)
+EXPORT_CHUNK_SIZE rows at a time, and written straight to the output
+format: no model instances, no serializers, and memory stays flat
+however many rows there are. The writers convert the few columns that
+need it (datetimes, booleans and JSON) straight to their output form.
+The columns are those of AnalysisSerializer, so NDJSON lines match
+/api/reports/?format=ndjson rows.
+
+An export can start after a watermark, the id of the last row of the
+previous export, so a nightly job only reads new analyses. Ids follow
+the table's insert sequence, whereas created_at is set in Python before
+the row is written, so a slow transaction could commit a row older than
+one already exported. Re-analyzing a conversation updates its analysis
+in place, keeping its id, so incremental exports carry new analyses, not
+updated ones. Analyses of archived conversations are in
+ARCHIVE_DIR (see archive.py), not here.
+"""
+import csv
+import io
+import json
+import zlib
+from itertools import islice
+from datetime import timezone as dt_timezone
+
+from django.conf import settings
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from .models import ConversationAnalysis
+from .serializers import AnalysisSerializer
+
+
+FORMATS = ('csv', 'ndjson', 'parquet')
+
+CONTENT_TYPES = {
+    'csv': 'text/csv; charset=utf-8',
+    'ndjson': 'application/x-ndjson',
+    'parquet': 'application/vnd.apache.parquet',
+}
+
+# Serializer fields read through a relation
+_LOOKUPS = {
+    'conversation': 'conversation_id',
+    'conversation_title': 'conversation__title',
+}
+
+# (column name, values_list lookup)
+EXPORT_COLUMNS = [(name, _LOOKUPS.get(name, name)) for name in AnalysisSerializer.Meta.fields]
+
+
+def _column_type(lookup):
+    if lookup == 'conversation__title':
+        return 'CharField'
+    field = ConversationAnalysis._meta.get_field(lookup)
+    if field.is_relation:
+        return 'IntegerField'
+    return field.get_internal_type()
+
+
+COLUMN_TYPES = [_column_type(lookup) for _, lookup in EXPORT_COLUMNS]
+
+
+def isoformat(value):
+    """
+    Datetime as DRF renders it: ISO 8601, with Z for UTC
+    """
+    text = value.isoformat()
+    if text.endswith('+00:00'):
+        return text[:-6] + 'Z'
+    return text
+
+
+def parse_since(since):
+    """
+    Returns: the aware datetime of an ISO 8601 datetime (naive ones are
+    taken as UTC), or None for no value
+    Raises: ValueError for a malformed value
+    """
+    if since in (None, ''):
+        return None
+    created_at = parse_datetime(since) if isinstance(since, str) else since
+    if created_at is None:
+        raise ValueError('since must be an ISO 8601 datetime')
+    if timezone.is_naive(created_at):
+        created_at = timezone.make_aware(created_at, dt_timezone.utc)
+    return created_at
+
+
+def parse_watermark(since_id):
+    """
+    Returns: the id of the last row of a previous export, or None for no value
+    Raises: ValueError for a malformed value
+    """
+    if since_id in (None, ''):
+        return None
+    try:
+        return int(since_id)
+    except (TypeError, ValueError):
+        raise ValueError('since_id must be an integer')
+
+
+def _converter(converters):
+    """
+    Returns: a function turning a raw row tuple into a list with converters
+    {column type: function} applied to its non-null values
+    """
+    positions = [
+        (index, converters[kind]) for index, kind in enumerate(COLUMN_TYPES)
+        if kind in converters
+    ]
+
+    def convert(row):
+        row = list(row)
+        for index, function in positions:
+            value = row[index]
+            if value is not None:
+                row[index] = function(value)
+        return row
+
+    return convert
+
+
+def csv_chunks(chunks):
+    """
+    Returns: an iterator of UTF-8 CSV text, a header line then one piece
+    per chunk of rows; booleans are written as true/false and JSON
+    columns as JSON text
+    """
+    convert = _converter({
+        'DateTimeField': isoformat,
+        'BooleanField': {True: 'true', False: 'false'}.__getitem__,
+        'JSONField': json.dumps,
+    })
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator='\n')
+    writer.writerow([name for name, _ in EXPORT_COLUMNS])
+    yield buffer.getvalue().encode('utf-8')
+
+    for rows in chunks:
+        buffer.seek(0)
+        buffer.truncate()
+        writer.writerows(map(convert, rows))
+        yield buffer.getvalue().encode('utf-8')
+
+
+def ndjson_chunks(chunks):
+    """
+    Returns: an iterator of UTF-8 NDJSON text, one piece per chunk of rows
+    """
+    names = [name for name, _ in EXPORT_COLUMNS]
+    convert = _converter({'DateTimeField': isoformat})
+    for rows in chunks:
+        yield ''.join(
+            json.dumps(dict(zip(names, convert(row))), separators=(',', ':')) + '\n'
+            for row in rows
+        ).encode('utf-8')
+
+
+class _Sink:
+    """
+    Write-only file handing back what was written since the last drain()
+    """
+    closed = False
+
+    def __init__(self):
+        self._parts = []
+        self._position = 0
+
+    def write(self, data):
+        data = bytes(data)
+        self._parts.append(data)
+        self._position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def drain(self):
+        data = b''.join(self._parts)
+        self._parts = []
+        return data
+
+
+def parquet_schema():
+    """
+    Returns: the pyarrow schema of exported rows (JSON columns as strings)
+    Raises: ValueError when pyarrow is not installed
+    """
+    try:
+        import pyarrow as pa
+    except ImportError:
+        raise ValueError('Parquet export requires pyarrow')
+
+    types = {
+        'AutoField': pa.int64(),
+        'BigAutoField': pa.int64(),
+        'IntegerField': pa.int64(),
+        'FloatField': pa.float64(),
+        'BooleanField': pa.bool_(),
+        'CharField': pa.string(),
+        'JSONField': pa.string(),
+        'DateTimeField': pa.timestamp('us', tz='UTC'),
+    }
+    return pa.schema([
+        (name, types[kind]) for (name, _), kind in zip(EXPORT_COLUMNS, COLUMN_TYPES)
+    ])
+
+
+def parquet_chunks(chunks):
+    """
+    Returns: an iterator of the bytes of a Parquet file, one row group per
+    chunk of rows
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    schema = parquet_schema()
+    converters = {'JSONField': json.dumps}
+    positions = [
+        (index, converters[kind]) for index, kind in enumerate(COLUMN_TYPES)
+        if kind in converters
+    ]
+    sink = _Sink()
+    writer = pq.ParquetWriter(sink, schema, compression='zstd')
+    for rows in chunks:
+        columns = [list(column) for column in zip(*rows)]
+        for index, function in positions:
+            columns[index] = [None if value is None else function(value) for value in columns[index]]
+        writer.write_table(pa.Table.from_arrays(
+            [pa.array(column, type=field.type) for column, field in zip(columns, schema)],
+            schema=schema,
+        ))
+        yield sink.drain()
+    writer.close()
+    yield sink.drain()
+
+
+WRITERS = {
+    'csv': csv_chunks,
+    'ndjson': ndjson_chunks,
+    'parquet': parquet_chunks,
+}
+
+
+def gzip_chunks(chunks, level=None):
+    """
+    Returns: an iterator of the pieces of a gzip file of the bytes in chunks
+    """
+    if level is None:
+        level = getattr(settings, 'EXPORT_GZIP_LEVEL', 1)
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+class AnalysisExport:
+    """
+    One export of the analyses in queryset (all of them by default) after
+    an optional watermark, iterated as the bytes of the output file
+    since: only analyses created after this datetime
+    since_id: the watermark, only analyses with a greater id
+
+    After a complete iteration, rows is the number of rows written and
+    watermark the id to start the next export from
+    """
+
+    def __init__(self, queryset=None, format='csv', since=None, since_id=None,
+                 gzip=False, chunk_size=None):
+        """
+        Raises: ValueError for an unknown format, a malformed since or
+        watermark, or a Parquet export without pyarrow
+        """
+        if format not in FORMATS:
+            raise ValueError(f"format must be one of: {', '.join(FORMATS)}")
+        if format == 'parquet':
+            parquet_schema()
+        if queryset is None:
+            queryset = ConversationAnalysis.objects.all()
+        self.format = format
+        self.gzip = gzip
+        self.chunk_size = chunk_size or getattr(settings, 'EXPORT_CHUNK_SIZE', 10000)
+        self.since = parse_since(since)
+        self.watermark = parse_watermark(since_id)
+        self.queryset = self._filter(queryset)
+        self.rows = 0
+
+    def _filter(self, queryset):
+        queryset = queryset.order_by('id')
+        if self.since is not None:
+            queryset = queryset.filter(created_at__gt=self.since)
+        if self.watermark is not None:
+            queryset = queryset.filter(id__gt=self.watermark)
+        return queryset.values_list(*(lookup for _, lookup in EXPORT_COLUMNS))
+
+    @property
+    def content_type(self):
+        return 'application/gzip' if self.gzip else CONTENT_TYPES[self.format]
+
+    @property
+    def filename(self):
+        return f"analyses.{self.format}{'.gz' if self.gzip else ''}"
+
+    def chunks(self):
+        """
+        Returns: an iterator of lists of up to chunk_size row tuples, read
+        with QuerySet.iterator() (with a server-side cursor where the
+        database has them)
+        """
+        id_index = [name for name, _ in EXPORT_COLUMNS].index('id')
+        rows = self.queryset.iterator(chunk_size=self.chunk_size)
+        while True:
+            chunk = list(islice(rows, self.chunk_size))
+            if not chunk:
+                return
+            self.rows += len(chunk)
+            self.watermark = chunk[-1][id_index]
+            yield chunk
+
+    def __iter__(self):
+        data = WRITERS[self.format](self.chunks())
+        if self.gzip:
+            data = gzip_chunks(data)
+        return iter(data)
@@ -0,0 +1,183 @@
+from django.db.models import prefetch_related_objects
+from django.utils.dateparse import parse_datetime
+
+from .models import Conversation, ConversationAnalysis, Message
+from .services import content_hash
+from .writer import prepare_analysis, write_analyses
+
+
+def stored_state(analyzer, conversation):
+    """
+    Running state of the conversation's analysis, if analyzer can extend it
+    Expects the analysis to be select_related (or it costs a query)
+    """
+    try:
+        state = conversation.analysis.running_state
+    except ConversationAnalysis.DoesNotExist:
+        return None
+    return state if analyzer.accepts_state(state) else None
+
+
+def _follows(state, messages):
+    """
+    Appended messages must sort after the last one folded into the state;
+    anything inserted earlier in the conversation needs a full recompute
+    """
+    if not messages or state['last_timestamp'] is None:
+        return True
+    first = messages[0]
+    return (first.timestamp, first.id) > (
+        parse_datetime(state['last_timestamp']), state['last_message_id']
+    )
+
+
+def _stored_fingerprint(conversation):
+    try:
+        return conversation.analysis.fingerprint
+    except ConversationAnalysis.DoesNotExist:
+        return None
+
+
+def _new_messages(states):
+    """
+    Messages added after each state, in one query
+    states: {conversation_id: state}
+    Returns: {conversation_id: [Message, ...]} in conversation order
+    """
+    new_messages = {conversation_id: [] for conversation_id in states}
+    if states:
+        oldest = min(state['last_message_id'] for state in states.values())
+        for message in Message.objects.filter(conversation_id__in=list(states), id__gt=oldest):
+            if message.id > states[message.conversation_id]['last_message_id']:
+                new_messages[message.conversation_id].append(message)
+    return new_messages
+
+
+def _extendable_states(analyzer, conversations):
+    states = {}
+    for conversation in conversations:
+        state = stored_state(analyzer, conversation)
+        if state is not None and state['last_message_id'] is not None:
+            states[conversation.id] = state
+    return states
+
+
+def split_by_state(analyzer, conversations):
+    """
+    Sort conversations into those that are already up to date, those
+    whose stored state can be extended and those that need a full analysis
+    conversations: Conversation objects with their analysis select_related
+    Returns: (incremental, full, unchanged) where incremental is a list of
+    (conversation, state, new_messages), full a list of conversations with
+    their messages prefetched and unchanged a list of conversations whose
+    analysis fingerprint still matches their messages
+    """
+    incremental = []
+    full = []
+    unchanged = []
+    states = _extendable_states(analyzer, conversations)
+    new_messages = _new_messages(states)
+
+    for conversation in conversations:
+        state = states.get(conversation.id)
+        if state is None:
+            full.append(conversation)
+            continue
+        messages = new_messages[conversation.id]
+        if not messages and _stored_fingerprint(conversation) == analyzer.fingerprint(state['content_hash']):
+            unchanged.append(conversation)
+        elif _follows(state, messages):
+            incremental.append((conversation, state, messages))
+        else:
+            full.append(conversation)
+
+    prefetch_related_objects(full, 'messages')
+
+    # Without a state the messages have to be read, but hashing them is
+    # still much cheaper than analyzing them
+    stale = []
+    for conversation in full:
+        stored = _stored_fingerprint(conversation)
+        if stored and stored == analyzer.fingerprint(content_hash(conversation.messages.all())):
+            unchanged.append(conversation)
+        else:
+            stale.append(conversation)
+
+    return incremental, stale, unchanged
+
+
+def is_up_to_date(analyzer, conversation):
+    """
+    Cheap check (no message is read) that the stored analysis matches the
+    conversation; False when that cannot be told without reading messages
+    """
+    states = _extendable_states(analyzer, [conversation])
+    if not states:
+        return False
+    state = states[conversation.id]
+    return (
+        not _new_messages(states)[conversation.id]
+        and _stored_fingerprint(conversation) == analyzer.fingerprint(state['content_hash'])
+    )
+
+
+def analyze(analyzer, conversation):
+    """
+    Analyze one conversation, reading only the messages appended since
+    its last analysis when its running state allows it
+    Returns: (analysis data, state), or None if the stored analysis is
+    already up to date
+    """
+    incremental, full, unchanged = split_by_state(analyzer, [conversation])
+
+    if unchanged:
+        return None
+
+    if incremental:
+        _, state, messages = incremental[0]
+        state = analyzer.extend_state(state, messages)
+        return analyzer.analyze_state(state), state
+
+    return analyzer.analyze_conversation(conversation, return_state=True)
+
+
+def get_conversation(conversation_id):
+    """
+    Conversation with its analysis (if any), ready for analyze()
+    """
+    return Conversation.objects.select_related('analysis').get(id=conversation_id)
+
+
+def save_analysis(conversation, analysis_data, state=None):
+    """
+    Store the analysis and its running state and mark the conversation analyzed
+    (see writer.py; batch jobs queue results on an AnalysisWriter instead)
+    Returns: the ConversationAnalysis
+    """
+    prepared = prepare_analysis(conversation, analysis_data, state)
+    write_analyses([prepared])
+    return prepared[1]
+
+
+def mark_analyzed(conversations):
+    """
+    Mark conversations whose analysis is already up to date as analyzed
+    """
+    ids = [conversation.id for conversation in conversations if not conversation.analyzed]
+    if ids:
+        Conversation.objects.filter(id__in=ids).update(analyzed=True)
+    for conversation in conversations:
+        conversation.analyzed = True
+
+
+def reanalyze(analyzer, conversation):
+    """
+    Bring the analysis of one conversation up to date, skipping the work
+    entirely when its fingerprint shows nothing changed
+    Returns: (ConversationAnalysis, whether it was recomputed)
+    """
+    result = analyze(analyzer, conversation)
+    if result is None:
+        mark_analyzed([conversation])
+        return conversation.analysis, False
+    return save_analysis(conversation, *result), True
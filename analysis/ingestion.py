@@ -0,0 +1,86 @@
+from django.conf import settings
+from django.db import transaction
+
+from .models import Conversation, Message
+from .serializers import ConversationCreateSerializer
+
+
+def get_batch_size():
+    return getattr(settings, 'BULK_INGEST_BATCH_SIZE', 200)
+
+
+def validate_conversations(items):
+    """
+    Validate raw conversation payloads one by one
+    Returns: (valid, errors) where valid is a list of (index, validated_data)
+    and errors is a list of {'index': int, 'errors': ...}
+    """
+    valid = []
+    errors = []
+
+    for index, item in enumerate(items):
+        if not isinstance(item, dict):
+            errors.append({'index': index, 'errors': {'non_field_errors': ['Expected a JSON object']}})
+            continue
+
+        serializer = ConversationCreateSerializer(data=item)
+        if serializer.is_valid():
+            valid.append((index, serializer.validated_data))
+        else:
+            errors.append({'index': index, 'errors': serializer.errors})
+
+    return valid, errors
+
+
+def bulk_insert_conversations(validated, batch_size=None):
+    """
+    Insert already validated conversations with batched INSERTs
+    Each batch of conversations is written in one transaction:
+    one INSERT for the conversations and a few for all their messages
+    Returns: list of created conversation ids, in input order
+    """
+    batch_size = batch_size or get_batch_size()
+    created_ids = []
+
+    for start in range(0, len(validated), batch_size):
+        batch = validated[start:start + batch_size]
+
+        with transaction.atomic():
+            conversations = Conversation.objects.bulk_create([
+                Conversation(title=data['title'], bot=data.get('bot', '')) for data in batch
+            ])
+
+            messages = [
+                Message(conversation=conversation, **message_data)
+                for conversation, data in zip(conversations, batch)
+                for message_data in data['messages']
+            ]
+            Message.objects.bulk_create(messages, batch_size=1000)
+
+        created_ids.extend(conversation.id for conversation in conversations)
+
+    return created_ids
+
+
+def ingest_conversations(items, batch_size=None):
+    """
+    Validate and bulk insert many conversations
+    Invalid items are reported and skipped, valid ones are still written
+    Returns: {'created': int, 'failed': int, 'results': [...]}
+    with one result per input item, sorted by index
+    """
+    valid, errors = validate_conversations(items)
+    created_ids = bulk_insert_conversations([data for _, data in valid], batch_size)
+
+    results = [
+        {'index': index, 'id': conversation_id}
+        for (index, _), conversation_id in zip(valid, created_ids)
+    ]
+    results.extend(errors)
+    results.sort(key=lambda result: result['index'])
+
+    return {
+        'created': len(created_ids),
+        'failed': len(errors),
+        'results': results,
+    }
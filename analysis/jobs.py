@@ -0,0 +1,178 @@
+import logging
+import os
+import socket
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import connections
+from django.db.models import Q
+from django.utils import timezone
+
+from .incremental import is_up_to_date
+from .models import AnalysisJob
+from .services import ConversationAnalyzer
+from .tasks import analyze_conversation_batch, analyze_single_conversation
+
+
+logger = logging.getLogger(__name__)
+
+# After a failed publish, skip the broker for this many seconds instead
+# of paying its connect timeout on every request
+BROKER_RETRY_DELAY = 30
+
+_broker_down_until = 0.0
+_local_executor = None
+_local_executor_lock = threading.Lock()
+
+
+def get_local_executor():
+    """
+    Process-wide thread pool that runs jobs when there is no broker
+    """
+    global _local_executor
+    if _local_executor is None:
+        with _local_executor_lock:
+            if _local_executor is None:
+                _local_executor = ThreadPoolExecutor(
+                    max_workers=getattr(settings, 'ANALYSIS_LOCAL_THREADS', 2),
+                    thread_name_prefix='analysis-job'
+                )
+    return _local_executor
+
+
+def local_worker():
+    """
+    Returns: host:pid identifying this process on local jobs
+    """
+    return f'{socket.gethostname()}:{os.getpid()}'
+
+
+def _is_running(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _run_locally(conversation_id, job_id, metrics):
+    try:
+        analyze_single_conversation(conversation_id, job_id, metrics)
+    except Exception:
+        # Already recorded on the job
+        pass
+    finally:
+        # Pool threads keep their own connections; don't leak them
+        connections.close_all()
+
+
+def _publish(task, args, task_id=None):
+    """
+    Queue a task on Celery
+    Returns: False if it has to run locally instead
+    """
+    global _broker_down_until
+    if not getattr(settings, 'CELERY_BROKER_URL', None) or time.monotonic() < _broker_down_until:
+        return False
+    try:
+        if getattr(settings, 'CELERY_TASK_ALWAYS_EAGER', False):
+            task.apply_async(args, task_id=task_id)
+            return True
+        # Fail fast when the broker is down, without Celery's connection retries
+        with task.app.connection_for_write() as connection:
+            connection.ensure_connection(max_retries=0)
+            task.apply_async(args, task_id=task_id, retry=False, connection=connection)
+    except Exception as e:
+        _broker_down_until = time.monotonic() + BROKER_RETRY_DELAY
+        label = f'{task.name} {task_id}' if task_id else task.name
+        logger.warning(f"Could not queue {label}, running it locally: {e}")
+        return False
+    return True
+
+
+def enqueue_analysis(conversation, analyzer=None):
+    """
+    Create an AnalysisJob for conversation and start it in the background:
+    on Celery when a broker is reachable (inline with CELERY_TASK_ALWAYS_EAGER),
+    otherwise in an in-process thread pool. If the stored analysis is
+    known to be up to date the job is recorded as succeeded right away
+    conversation: with its analysis select_related
+    analyzer: the ConversationAnalyzer whose metric selection the job uses
+    Returns: the AnalysisJob
+    """
+    analyzer = analyzer or ConversationAnalyzer()
+    if is_up_to_date(analyzer, conversation):
+        now = timezone.now()
+        return AnalysisJob.objects.create(
+            conversation=conversation,
+            status=AnalysisJob.SUCCEEDED,
+            started_at=now,
+            finished_at=now
+        )
+    
+    job = AnalysisJob.objects.create(conversation=conversation)
+    job_id = str(job.id)
+    
+    if not _publish(analyze_single_conversation, (conversation.id, job_id, analyzer.metric_names), job_id):
+        # Recorded so that fail_lost_jobs can tell when this process is gone
+        job.worker = local_worker()
+        job.save(update_fields=['worker'])
+        get_local_executor().submit(_run_locally, conversation.id, job_id, analyzer.metric_names)
+    
+    return job
+
+
+def enqueue_batch(conversation_ids):
+    """
+    Queue analyze_conversation_batch on Celery when a broker is reachable,
+    otherwise run it right here (the import command has nothing else to
+    do meanwhile, and would exit before a background thread finished)
+    Returns: the task's result when it ran here, else None
+    """
+    if not _publish(analyze_conversation_batch, (conversation_ids,)):
+        return analyze_conversation_batch(conversation_ids)
+    return None
+
+
+def fail_lost_jobs():
+    """
+    Mark local jobs that will never finish as failed: the local pool does
+    not survive its process, so a restart leaves them queued or running
+    forever. Lost are the jobs of processes of this host that are gone,
+    and any local job older than ANALYSIS_LOCAL_JOB_TIMEOUT seconds
+    (its host may be gone too)
+    Called when a server process starts (gunicorn.conf.py) and by
+    prune_analysis_jobs
+    Returns: number of jobs marked failed
+    """
+    pending = AnalysisJob.objects.filter(
+        status__in=[AnalysisJob.QUEUED, AnalysisJob.RUNNING]
+    ).exclude(worker='')
+    host = f'{socket.gethostname()}:'
+    gone = [
+        job_id
+        for job_id, worker in pending.filter(worker__startswith=host).values_list('id', 'worker')
+        if not _is_running(int(worker[len(host):]))
+    ]
+    expired = timezone.now() - timedelta(seconds=getattr(settings, 'ANALYSIS_LOCAL_JOB_TIMEOUT', 3600))
+    return pending.filter(Q(id__in=gone) | Q(created_at__lt=expired)).update(
+        status=AnalysisJob.FAILED,
+        error='Lost: the process running this job stopped before it finished',
+        finished_at=timezone.now()
+    )
+
+
+def prune_jobs(older_than):
+    """
+    Delete the jobs that finished before older_than
+    Returns: number of jobs deleted
+    """
+    deleted, _ = AnalysisJob.objects.filter(
+        status__in=[AnalysisJob.SUCCEEDED, AnalysisJob.FAILED], finished_at__lt=older_than
+    ).delete()
+    return deleted
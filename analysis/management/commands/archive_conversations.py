@@ -0,0 +1,49 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from analysis.archive import archive_conversations, archived_files, get_archive_dir, rescore_archive
+
+
+class Command(BaseCommand):
+    help = (
+        'Move the messages and analyses of analyzed conversations older than '
+        '--older-than days to compressed columnar files in ARCHIVE_DIR, leaving '
+        'the conversation rows behind as stubs; with --rescore, analyze the '
+        'archived conversations again with the current scoring rules'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--older-than', type=int, metavar='DAYS',
+            help='Archive conversations created more than DAYS days ago'
+        )
+        parser.add_argument(
+            '--chunk-size', type=int, default=None,
+            help='Conversations per archive file (default: ARCHIVE_CHUNK_SIZE)'
+        )
+        parser.add_argument(
+            '--rescore', action='store_true',
+            help='Re-score every archived conversation and update the archived analyses'
+        )
+
+    def handle(self, *args, **options):
+        if options['rescore']:
+            count = 0
+            for path in archived_files():
+                count += rescore_archive(path)
+            self.stdout.write(self.style.SUCCESS(f'Re-scored {count} archived conversations'))
+            return
+
+        if options['older_than'] is None or options['older_than'] < 0:
+            raise CommandError('--older-than DAYS is required (or --rescore)')
+        if options['chunk_size'] is not None and options['chunk_size'] < 1:
+            raise CommandError('--chunk-size must be at least 1')
+
+        cutoff = timezone.now() - timedelta(days=options['older_than'])
+        totals = archive_conversations(cutoff, chunk_size=options['chunk_size'])
+        self.stdout.write(self.style.SUCCESS(
+            f"Archived {totals['conversations']} conversations ({totals['messages']} messages) "
+            f"to {totals['files']} files in {get_archive_dir()}"
+        ))
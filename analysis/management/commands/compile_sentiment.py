@@ -0,0 +1,38 @@
+import time
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from analysis.sentiment import SentimentEngine
+
+
+class Command(BaseCommand):
+    help = (
+        'Compile the VADER lexicon and rule tables from NLTK into '
+        'SENTIMENT_ENGINE_FILE (run after upgrading NLTK)'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--output',
+            help='File to write (default: SENTIMENT_ENGINE_FILE)'
+        )
+
+    def handle(self, *args, **options):
+        path = options['output'] or getattr(settings, 'SENTIMENT_ENGINE_FILE', None)
+        if not path:
+            self.stderr.write('SENTIMENT_ENGINE_FILE is not set; pass --output')
+            return
+
+        start = time.perf_counter()
+        engine = SentimentEngine.from_nltk()
+        compiled = time.perf_counter() - start
+        engine.save(path)
+
+        start = time.perf_counter()
+        SentimentEngine.load(path)
+        loaded = time.perf_counter() - start
+        self.stdout.write(self.style.SUCCESS(
+            f'Compiled {len(engine.lexicon)} lexicon entries from NLTK {engine.nltk_version} '
+            f'to {path} ({compiled * 1000:.1f}ms from NLTK, {loaded * 1000:.1f}ms to load)'
+        ))
@@ -0,0 +1,106 @@
+import os
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from analysis.export import FORMATS, AnalysisExport
+
+
+def read_watermark(path):
+    """
+    Returns: the since_id recorded by write_watermark, or None
+    """
+    if not os.path.exists(path):
+        return None
+    with open(path) as handle:
+        # Files of earlier versions hold "<created_at> <id>"
+        return handle.read().split()[-1]
+
+
+def write_watermark(path, watermark):
+    """
+    Atomically record the id of the last exported row
+    """
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'w') as handle:
+        handle.write(str(watermark))
+    os.replace(tmp_path, path)
+
+
+class Command(BaseCommand):
+    help = (
+        'Export analyses, oldest first, as CSV, NDJSON or Parquet, streaming '
+        'them from the database; with --watermark-file, each run continues '
+        'after the last row of the previous one'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--format', choices=FORMATS, default=None,
+            help='Output format (default: from the --output suffix, else csv)'
+        )
+        parser.add_argument('--output', default='-', help='Output file (default: stdout)')
+        parser.add_argument(
+            '--gzip', action='store_true',
+            help='Gzip the output (implied by an --output ending in .gz)'
+        )
+        parser.add_argument('--since', help='Export analyses created after this ISO 8601 datetime')
+        parser.add_argument('--since-id', help='Export analyses with an id after this one')
+        parser.add_argument(
+            '--watermark-file',
+            help='Read --since-id from this file if it exists, and record the id of '
+                 'the last exported row in it after a complete export'
+        )
+        parser.add_argument(
+            '--chunk-size', type=int, default=None,
+            help='Rows read at a time (default: EXPORT_CHUNK_SIZE)'
+        )
+
+    def handle(self, *args, **options):
+        output = options['output']
+        compress = options['gzip'] or output.endswith('.gz')
+        format = options['format']
+        if format is None:
+            suffix = output.removesuffix('.gz').rsplit('.', 1)[-1]
+            format = suffix if suffix in FORMATS else 'csv'
+        if options['chunk_size'] is not None and options['chunk_size'] < 1:
+            raise CommandError('--chunk-size must be at least 1')
+
+        since, since_id = options['since'], options['since_id']
+        watermark_file = options['watermark_file']
+        if since_id is None and watermark_file:
+            since_id = read_watermark(watermark_file)
+
+        try:
+            export = AnalysisExport(
+                format=format, since=since, since_id=since_id,
+                gzip=compress, chunk_size=options['chunk_size'],
+            )
+        except ValueError as e:
+            raise CommandError(str(e))
+
+        if output == '-':
+            for data in export:
+                sys.stdout.buffer.write(data)
+            sys.stdout.buffer.flush()
+            log = self.stderr
+        else:
+            # Written next to the output and renamed into place once
+            # complete, so a failed run never leaves a truncated file
+            tmp_path = f'{output}.tmp'
+            try:
+                with open(tmp_path, 'wb') as handle:
+                    for data in export:
+                        handle.write(data)
+                os.replace(tmp_path, output)
+            finally:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+            log = self.stdout
+
+        if watermark_file and export.rows:
+            write_watermark(watermark_file, export.watermark)
+        log.write(self.style.SUCCESS(
+            f'Exported {export.rows} analyses to {output} as {format}'
+            f"{' (gzip)' if compress else ''}"
+        ))
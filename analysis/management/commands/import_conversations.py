@@ -0,0 +1,141 @@
+import json
+import os
+
+from django.core.management.base import BaseCommand, CommandError
+
+from analysis.ingestion import bulk_insert_conversations, get_batch_size, validate_conversations
+
+
+def iter_lines(path, offset=0):
+    """
+    Stream a file line by line starting at a byte offset
+    Yields: (line_number, end_offset, line) where line_number counts from
+    the start offset and end_offset is the byte offset just after the line,
+    i.e. where a resumed import would start
+    """
+    with open(path, 'rb') as handle:
+        handle.seek(offset)
+        line_number = 0
+        for raw_line in handle:
+            line_number += 1
+            offset += len(raw_line)
+            yield line_number, offset, raw_line
+
+
+def iter_batches(lines, batch_size):
+    """
+    Group parsed NDJSON lines into batches of batch_size items
+    Yields: (items, parse_errors, end_offset)
+    """
+    items = []
+    parse_errors = []
+    end_offset = None
+
+    for line_number, end_offset, raw_line in lines:
+        line = raw_line.strip()
+        if not line:
+            continue
+        try:
+            items.append(json.loads(line))
+        except ValueError as exc:
+            parse_errors.append(f'line {line_number}: {exc}')
+            continue
+
+        if len(items) >= batch_size:
+            yield items, parse_errors, end_offset
+            items, parse_errors = [], []
+
+    if items or parse_errors:
+        yield items, parse_errors, end_offset
+
+
+def read_checkpoint(path):
+    try:
+        with open(path) as handle:
+            return int(handle.read().strip() or 0)
+    except FileNotFoundError:
+        return 0
+
+
+def write_checkpoint(path, offset):
+    """
+    Atomically record the byte offset of the last committed batch
+    """
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'w') as handle:
+        handle.write(str(offset))
+    os.replace(tmp_path, path)
+
+
+class Command(BaseCommand):
+    help = (
+        'Import conversations from an NDJSON file (one {"title", "messages"} '
+        'object per line), streaming it in batches'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help='NDJSON file to import')
+        parser.add_argument(
+            '--batch-size', type=int, default=None,
+            help='Conversations committed per transaction (default: BULK_INGEST_BATCH_SIZE)'
+        )
+        parser.add_argument(
+            '--offset', type=int, default=None,
+            help='Byte offset to start reading from (overrides --checkpoint)'
+        )
+        parser.add_argument(
+            '--checkpoint',
+            help='File storing the byte offset after each committed batch; '
+                 'an existing checkpoint is resumed from'
+        )
+        parser.add_argument(
+            '--analyze', action='store_true',
+            help='Queue analysis for each imported batch (or analyze it '
+                 'in this process when no broker is reachable)'
+        )
+
+    def handle(self, *args, **options):
+        path = options['path']
+        if not os.path.exists(path):
+            raise CommandError(f'File not found: {path}')
+
+        batch_size = options['batch_size'] or get_batch_size()
+        if batch_size < 1:
+            raise CommandError('--batch-size must be positive')
+
+        checkpoint = options['checkpoint']
+        offset = options['offset']
+        if offset is None:
+            offset = read_checkpoint(checkpoint) if checkpoint else 0
+        if offset:
+            self.stdout.write(f'Resuming from byte offset {offset}')
+
+        if options['analyze']:
+            from analysis.jobs import enqueue_batch
+
+        created = failed = 0
+        for items, parse_errors, end_offset in iter_batches(iter_lines(path, offset), batch_size):
+            valid, errors = validate_conversations(items)
+            ids = bulk_insert_conversations([data for _, data in valid], batch_size)
+
+            for message in parse_errors:
+                self.stderr.write(f'Skipped {message}')
+            for error in errors:
+                self.stderr.write(f'Skipped invalid conversation: {json.dumps(error["errors"])}')
+
+            created += len(ids)
+            failed += len(parse_errors) + len(errors)
+
+            if checkpoint:
+                write_checkpoint(checkpoint, end_offset)
+            if ids and options['analyze']:
+                # Analyzed right here when no broker is reachable
+                result = enqueue_batch(ids)
+                if result:
+                    self.stdout.write(result)
+
+            self.stdout.write(f'Committed {created} conversations (offset {end_offset})')
+
+        self.stdout.write(self.style.SUCCESS(
+            f'Imported {created} conversations, skipped {failed}'
+        ))
@@ -0,0 +1,30 @@
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from analysis.jobs import fail_lost_jobs, prune_jobs
+
+
+class Command(BaseCommand):
+    help = (
+        'Mark lost local analysis jobs failed and delete old finished jobs '
+        '(also runs daily as a Celery Beat task)'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--days', type=int, default=None,
+            help='Keep jobs finished in the last DAYS days (default: ANALYSIS_JOB_RETENTION_DAYS)'
+        )
+
+    def handle(self, *args, **options):
+        days = options['days']
+        if days is None:
+            days = getattr(settings, 'ANALYSIS_JOB_RETENTION_DAYS', 7)
+        lost = fail_lost_jobs()
+        deleted = prune_jobs(timezone.now() - timedelta(days=days))
+        self.stdout.write(self.style.SUCCESS(
+            f'Deleted {deleted} finished jobs, marked {lost} lost jobs failed'
+        ))
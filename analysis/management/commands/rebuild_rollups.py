@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+
+from analysis.rollups import rebuild_rollups
+
+
+class Command(BaseCommand):
+    help = (
+        'Recompute the per-day, per-bot report rollups from the analysis table '
+        '(backfill, or repair after writes that bypassed the model signals)'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--chunk-size', type=int, default=10000,
+            help='Analyses read per database round trip'
+        )
+
+    def handle(self, *args, **options):
+        count = rebuild_rollups(chunk_size=options['chunk_size'])
+        self.stdout.write(self.style.SUCCESS(f'Rebuilt rollups from {count} analyses'))
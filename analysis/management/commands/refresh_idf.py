@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand
+
+from analysis.relevance import refresh_idf_table
+
+
+class Command(BaseCommand):
+    help = (
+        'Recompute the relevance IDF table from all messages '
+        '(also runs weekly as a Celery Beat task)'
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--chunk-size', type=int, default=2000,
+            help='Messages read per database round trip'
+        )
+
+    def handle(self, *args, **options):
+        statistics = refresh_idf_table(chunk_size=options['chunk_size'])
+        self.stdout.write(self.style.SUCCESS(
+            f'Built IDF table of {len(statistics.frequencies)} terms from {statistics.documents} messages'
+        ))
@@ -0,0 +1,129 @@
+import re
+from functools import lru_cache
+
+
+EMPTY = frozenset()
+
+
+class KeywordMatcher:
+    """
+    Finds which lexicons have a phrase occurring in a text, in one scan
+
+    All phrases of all lexicons are compiled into a single regex shaped
+    like a trie (e.g. 'sorry' and 'sorry, i can't' become
+    sorry(?:, i can't)?). The work per text position depends on the
+    phrase length, not on the number of phrases, so lexicons with
+    thousands of phrases cost about the same as small ones.
+
+    Below SCAN_THRESHOLD phrases, plain substring scans are faster than
+    the regex (str.__contains__ is very cheap), so small lexicons such as
+    the built-in ones are matched that way instead.
+
+    Matching is plain substring matching, the same as
+    any(phrase in text for phrase in lexicon); phrases are lowercased and
+    texts are expected to be lowercased by the caller.
+    """
+
+    SCAN_THRESHOLD = 100
+
+    def __init__(self, lexicons, scan_threshold=None):
+        """
+        lexicons: {'name': [phrase, ...], ...}
+        scan_threshold: overrides SCAN_THRESHOLD (0 always uses the regex)
+        """
+        trie = {}
+        names_by_phrase = {}
+        for name, phrases in lexicons.items():
+            for phrase in phrases:
+                phrase = phrase.lower()
+                if not phrase:
+                    continue
+                names_by_phrase.setdefault(phrase, set()).add(name)
+                node = trie
+                for char in phrase:
+                    node = node.setdefault(char, {})
+                node[''] = phrase
+
+        self.names = frozenset(lexicons)
+        self.phrase_count = len(names_by_phrase)
+        self._lexicons = [
+            (name, tuple(phrase for phrase, names in names_by_phrase.items() if name in names))
+            for name in lexicons
+        ]
+        if scan_threshold is None:
+            scan_threshold = self.SCAN_THRESHOLD
+        self._scan = self.phrase_count < scan_threshold
+        # At a given position the regex captures the longest phrase; every
+        # shorter phrase that is a prefix of it matched there too
+        self._names = {}
+        self._collect_names(trie, names_by_phrase, EMPTY)
+
+        pattern = _trie_pattern(trie)
+        self._pattern = re.compile(pattern) if pattern else None
+
+    def _collect_names(self, node, names_by_phrase, inherited):
+        if '' in node:
+            inherited = inherited | names_by_phrase[node['']]
+            self._names[node['']] = inherited
+        for char, child in node.items():
+            if char:
+                self._collect_names(child, names_by_phrase, inherited)
+
+    def match(self, text):
+        """
+        Returns: frozenset of lexicon names with at least one phrase in text
+        """
+        if self._pattern is None:
+            return EMPTY
+        if self._scan:
+            return frozenset(
+                name for name, phrases in self._lexicons
+                if any(phrase in text for phrase in phrases)
+            )
+
+        search = self._pattern.search
+        match = search(text)
+        if match is None:
+            return EMPTY
+
+        # Phrases may overlap, so resume right after each match start
+        found = self._names[match.group()]
+        match = search(text, match.start() + 1)
+        while match is not None and found != self.names:
+            found = found | self._names[match.group()]
+            match = search(text, match.start() + 1)
+        return found
+
+    def match_many(self, texts):
+        return [self.match(text) for text in texts]
+
+
+def _trie_pattern(node):
+    terminal = '' in node
+    branches = [
+        re.escape(char) + _trie_pattern(child)
+        for char, child in sorted(node.items())
+        if char
+    ]
+    if not branches:
+        return ''
+
+    pattern = '|'.join(branches)
+    if terminal:
+        return f'(?:{pattern})?'
+    if len(branches) > 1:
+        return f'(?:{pattern})'
+    return pattern
+
+
+@lru_cache(maxsize=32)
+def _cached_matcher(frozen_lexicons):
+    return KeywordMatcher({name: list(phrases) for name, phrases in frozen_lexicons})
+
+
+def get_matcher(lexicons):
+    """
+    Build a KeywordMatcher, reusing a compiled one for identical lexicons
+    """
+    frozen = tuple(sorted((name, tuple(phrases)) for name, phrases in lexicons.items()))
+    return _cached_matcher(frozen)
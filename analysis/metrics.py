@@ -0,0 +1,309 @@
+import threading
+import time
+from contextlib import contextmanager
+from functools import cached_property
+from importlib import import_module
+
+from django.conf import settings
+
+from .trajectory import pack
+
+
+# What a metric can read from a conversation
+INPUTS = ('ai_texts', 'user_texts', 'messages')
+
+
+class UnknownMetric(ValueError):
+    pass
+
+
+class Metric:
+    """
+    One analysis metric
+    name: what it is selected by (?metrics=name)
+    inputs: the parts of the conversation it reads, from INPUTS
+    fields: the ConversationAnalysis fields it produces
+    requires: metrics whose results it is computed from; they are run
+    first and their fields passed to compute
+    compute(analyzer, inputs, results) -> {field: value}, where inputs is
+    a MetricInputs and results the fields computed so far
+    """
+
+    def __init__(self, name, inputs, fields, compute, requires=()):
+        unknown = set(inputs) - set(INPUTS)
+        if unknown:
+            raise ValueError(f"Metric {name} reads unknown inputs: {', '.join(sorted(unknown))}")
+        self.name = name
+        self.inputs = tuple(inputs)
+        self.fields = tuple(fields)
+        self.compute = compute
+        self.requires = tuple(requires)
+
+    def __repr__(self):
+        return f'<Metric {self.name}>'
+
+    @property
+    def identity(self):
+        """
+        Where the metric's code lives, part of the fingerprints of
+        analyses computing it (see BUILTIN_METRICS)
+        """
+        return f'{self.name}={self.compute.__module__}.{self.compute.__qualname__}'
+
+
+class MetricInputs:
+    """
+    The inputs of one conversation, each built on first use and shared
+    by every metric that reads it
+    """
+
+    def __init__(self, analyzer, messages):
+        self.analyzer = analyzer
+        self.messages = messages
+        # Unrounded scores, which the overall score is weighted from
+        self.scores = {}
+
+    @cached_property
+    def ai_texts(self):
+        return [m.text for m in self.messages if m.sender == 'ai']
+
+    @cached_property
+    def user_texts(self):
+        return [m.text for m in self.messages if m.sender == 'user']
+
+    @cached_property
+    def user_sentiment(self):
+        # Scored once for the sentiment label, trajectory and escalation
+        return self.analyzer.sentiment_units(self.user_texts)
+
+    @cached_property
+    def ai_hits(self):
+        # One lexicon scan shared by empathy and accuracy
+        return self.analyzer.match_lexicons(self.ai_texts)
+
+
+class MetricRegistry:
+    """
+    Registered metrics, in the order they run, with the wall time and
+    number of conversations each has been computed for in this process
+    """
+
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+        self.reset_stats()
+
+    def register(self, metric, replace=False):
+        """
+        Add a metric; replace=True swaps out a registered one of the same name
+        """
+        if metric.name in self._metrics and not replace:
+            raise ValueError(f'Metric {metric.name} is already registered')
+        missing = [name for name in metric.requires if name not in self._metrics]
+        if missing:
+            raise ValueError(f"Metric {metric.name} requires unregistered metrics: {', '.join(missing)}")
+        self._metrics[metric.name] = metric
+        return metric
+
+    def names(self):
+        return list(self._metrics)
+
+    def fields(self):
+        return [field for metric in self._metrics.values() for field in metric.fields]
+
+    def resolve(self, names=None):
+        """
+        Metrics to run for a selection, with the metrics they require,
+        in registration order
+        names: metric names (or a comma separated string); None for all
+        Raises: UnknownMetric
+        """
+        if names is None:
+            return list(self._metrics.values())
+        if isinstance(names, str):
+            names = [name.strip() for name in names.split(',') if name.strip()]
+        elif not isinstance(names, (list, tuple)):
+            raise UnknownMetric('Metrics must be a list or a comma separated string of names')
+
+        unknown = [name for name in names if name not in self._metrics]
+        if unknown:
+            raise UnknownMetric(
+                f"Unknown metrics: {', '.join(map(str, unknown))} (available: {', '.join(self._metrics)})"
+            )
+
+        selected = set()
+        pending = list(names)
+        while pending:
+            name = pending.pop()
+            if name not in selected:
+                selected.add(name)
+                pending.extend(self._metrics[name].requires)
+        return [metric for name, metric in self._metrics.items() if name in selected]
+
+    def reset_stats(self):
+        with self._lock:
+            self._seconds = {}
+            self._calls = {}
+
+    def record(self, name, seconds, calls=1):
+        with self._lock:
+            self._seconds[name] = self._seconds.get(name, 0.0) + seconds
+            self._calls[name] = self._calls.get(name, 0) + calls
+
+    @contextmanager
+    def timed(self, name, calls=1):
+        """
+        Record the wall time of the block against metric name, for calls
+        conversations
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - start, calls)
+
+    def stats(self):
+        """
+        {metric: {'seconds': float, 'calls': int}} for every metric run so far
+        """
+        with self._lock:
+            return {
+                name: {'seconds': self._seconds[name], 'calls': self._calls[name]}
+                for name in self._seconds
+            }
+
+
+registry = MetricRegistry()
+
+
+def _sentiment(analyzer, inputs, results):
+    from .services import TREND_WINDOW
+
+    units = inputs.user_sentiment
+    return {
+        'sentiment': analyzer.sentiment_of(units)['label'],
+        **analyzer.trajectory_fields(pack(units), units[-TREND_WINDOW:]),
+    }
+
+
+def _clarity(analyzer, inputs, results):
+    inputs.scores['clarity'] = analyzer.analyze_clarity(inputs.ai_texts)
+    return {'clarity_score': round(inputs.scores['clarity'], 2)}
+
+
+def _relevance(analyzer, inputs, results):
+    inputs.scores['relevance'] = analyzer.analyze_relevance(inputs.ai_texts, inputs.user_texts)
+    return {'relevance_score': round(inputs.scores['relevance'], 2)}
+
+
+def _empathy(analyzer, inputs, results):
+    inputs.scores['empathy'] = analyzer.analyze_empathy(inputs.ai_texts, inputs.ai_hits)
+    return {'empathy_score': round(inputs.scores['empathy'], 2)}
+
+
+def _completeness(analyzer, inputs, results):
+    inputs.scores['completeness'] = analyzer.analyze_completeness(inputs.ai_texts)
+    return {'completeness_score': round(inputs.scores['completeness'], 2)}
+
+
+def _accuracy(analyzer, inputs, results):
+    inputs.scores['accuracy'] = analyzer.analyze_accuracy(inputs.ai_texts, inputs.ai_hits)
+    return {
+        'accuracy_score': round(inputs.scores['accuracy'], 2),
+        'fallback_count': analyzer.count_fallbacks(inputs.ai_texts, inputs.ai_hits),
+    }
+
+
+def _resolution(analyzer, inputs, results):
+    return {'resolution': analyzer.check_resolution(inputs.messages)}
+
+
+def _escalation(analyzer, inputs, results):
+    from .services import TREND_WINDOW
+
+    return {
+        'escalation_needed': analyzer.check_escalation(
+            {'label': results['sentiment']}, results['resolution'],
+            inputs.user_sentiment[-TREND_WINDOW:]
+        )
+    }
+
+
+def _response_time(analyzer, inputs, results):
+    return analyzer.response_time_stats(analyzer.calculate_response_time(inputs.messages))
+
+
+def _overall(analyzer, inputs, results):
+    return {'overall_score': round(analyzer.calculate_overall_score(inputs.scores), 2)}
+
+
+for _metric in (
+    Metric('sentiment', ['user_texts'], ['sentiment', 'sentiment_trajectory', 'sentiment_slope'], _sentiment),
+    Metric('clarity', ['ai_texts'], ['clarity_score'], _clarity),
+    Metric('relevance', ['ai_texts', 'user_texts'], ['relevance_score'], _relevance),
+    Metric('empathy', ['ai_texts'], ['empathy_score'], _empathy),
+    Metric('completeness', ['ai_texts'], ['completeness_score'], _completeness),
+    Metric('accuracy', ['ai_texts'], ['accuracy_score', 'fallback_count'], _accuracy),
+    Metric('resolution', ['messages'], ['resolution'], _resolution),
+    Metric('escalation', ['user_texts'], ['escalation_needed'], _escalation, requires=['sentiment', 'resolution']),
+    Metric(
+        'response_time', ['messages'],
+        [
+            'response_time_avg', 'response_time_p50', 'response_time_p95',
+            'response_time_max', 'response_count', 'latency_sketch',
+        ],
+        _response_time
+    ),
+    Metric(
+        'overall', [], ['overall_score'], _overall,
+        requires=['clarity', 'relevance', 'accuracy', 'completeness', 'empathy']
+    ),
+):
+    registry.register(_metric)
+
+# ConversationAnalyzer.analyze_batch and running states compute these
+# metrics with code of their own, versioned by ANALYZER_VERSION; metrics
+# registered by plugins, and built-ins replaced by them, only run through
+# ConversationAnalyzer.run_metrics
+BUILTIN_METRICS = frozenset(registry.resolve())
+
+
+def load_plugins():
+    """
+    Import the modules listed in ANALYSIS_METRIC_PLUGINS; each registers
+    its metrics with registry.register(Metric(...)) when imported
+    """
+    for path in getattr(settings, 'ANALYSIS_METRIC_PLUGINS', []):
+        import_module(path)
+
+
+def prometheus_text():
+    """
+    Metric timings of this process (and its sentiment cache counters) in
+    the Prometheus text exposition format
+    """
+    from .cache import get_sentiment_cache
+
+    stats = registry.stats()
+    lines = [
+        '# HELP analysis_metric_seconds_total Wall time spent computing each analysis metric',
+        '# TYPE analysis_metric_seconds_total counter',
+    ]
+    for name in registry.names():
+        seconds = stats.get(name, {}).get('seconds', 0.0)
+        lines.append(f'analysis_metric_seconds_total{{metric="{name}"}} {seconds:.6f}')
+    lines += [
+        '# HELP analysis_metric_calls_total Conversations each analysis metric was computed for',
+        '# TYPE analysis_metric_calls_total counter',
+    ]
+    for name in registry.names():
+        calls = stats.get(name, {}).get('calls', 0)
+        lines.append(f'analysis_metric_calls_total{{metric="{name}"}} {calls}')
+
+    cache = get_sentiment_cache().stats()
+    for counter in ('hits', 'misses', 'evictions', 'redis_errors'):
+        lines += [
+            f'# TYPE analysis_sentiment_cache_{counter}_total counter',
+            f'analysis_sentiment_cache_{counter}_total {cache[counter]}',
+        ]
+    return '\n'.join(lines) + '\n'
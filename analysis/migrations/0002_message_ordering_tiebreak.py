@@ -0,0 +1,17 @@
+# Generated by Django 4.2 on 2026-10-18 02:56
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('analysis', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AlterModelOptions(
+            name='message',
+            options={'ordering': ['timestamp', 'id']},
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 4.2 on 2026-10-18 03:05
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('analysis', '0002_message_ordering_tiebreak'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='conversation',
+            name='claim_token',
+            field=models.CharField(blank=True, max_length=32, null=True),
+        ),
+        migrations.AddField(
+            model_name='conversation',
+            name='claimed_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
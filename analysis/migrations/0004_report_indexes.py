@@ -0,0 +1,33 @@
+# Generated by Django 4.2 on 2026-10-18 03:09
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('analysis', '0003_conversation_claim'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='conversation',
+            index=models.Index(fields=['-created_at', '-id'], name='conversation_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='conversation',
+            index=models.Index(condition=models.Q(('analyzed', False)), fields=['id'], name='conversation_unanalyzed_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='conversationanalysis',
+            index=models.Index(fields=['-created_at', '-id'], name='analysis_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='conversationanalysis',
+            index=models.Index(fields=['sentiment', 'resolution', '-created_at', '-id'], name='analysis_filter_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['conversation', 'timestamp', 'id'], name='message_conversation_idx'),
+        ),
+    ]
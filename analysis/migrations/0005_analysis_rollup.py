@@ -0,0 +1,41 @@
+# Generated by Django 4.2 on 2026-10-18 03:10
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('analysis', '0004_report_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='AnalysisRollup',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField()),
+                ('bot', models.CharField(blank=True, default='', max_length=100)),
+                ('analyses', models.IntegerField(default=0)),
+                ('overall_score_sum', models.FloatField(default=0.0)),
+                ('positive', models.IntegerField(default=0)),
+                ('neutral', models.IntegerField(default=0)),
+                ('negative', models.IntegerField(default=0)),
+                ('resolved', models.IntegerField(default=0)),
+                ('escalated', models.IntegerField(default=0)),
+                ('fallback_total', models.IntegerField(default=0)),
+            ],
+            options={
+                'ordering': ['day', 'bot'],
+            },
+        ),
+        migrations.AddField(
+            model_name='conversation',
+            name='bot',
+            field=models.CharField(blank=True, default='', help_text='Bot/agent that handled the chat', max_length=100),
+        ),
+        migrations.AddConstraint(
+            model_name='analysisrollup',
+            constraint=models.UniqueConstraint(fields=('day', 'bot'), name='rollup_day_bot_unique'),
+        ),
+    ]
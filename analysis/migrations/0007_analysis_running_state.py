@@ -0,0 +1,18 @@
+# Generated by Django 4.2 on 2026-10-18 03:16
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('analysis', '0006_analysis_job'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='conversationanalysis',
+            name='running_state',
+            field=models.JSONField(blank=True, default=None, null=True),
+        ),
+    ]
@@ -0,0 +1,71 @@
+# Generated by Django 4.2 on 2026-10-18 03:19
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+def clear_mock_response_times(apps, schema_editor):
+    # Earlier analyses stored a random placeholder, not a measurement
+    ConversationAnalysis = apps.get_model('analysis', 'ConversationAnalysis')
+    ConversationAnalysis.objects.update(response_time_avg=None)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('analysis', '0007_analysis_running_state'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='analysisrollup',
+            name='latency_sketch',
+            field=models.JSONField(blank=True, default=None, null=True),
+        ),
+        migrations.AddField(
+            model_name='analysisrollup',
+            name='response_time_sum',
+            field=models.FloatField(default=0.0),
+        ),
+        migrations.AddField(
+            model_name='analysisrollup',
+            name='responses',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='conversationanalysis',
+            name='latency_sketch',
+            field=models.JSONField(blank=True, default=None, null=True),
+        ),
+        migrations.AddField(
+            model_name='conversationanalysis',
+            name='response_count',
+            field=models.IntegerField(default=0, help_text='Number of user -> AI responses measured'),
+        ),
+        migrations.AddField(
+            model_name='conversationanalysis',
+            name='response_time_max',
+            field=models.FloatField(blank=True, help_text='Slowest response seconds', null=True),
+        ),
+        migrations.AddField(
+            model_name='conversationanalysis',
+            name='response_time_p50',
+            field=models.FloatField(blank=True, help_text='Median response seconds', null=True),
+        ),
+        migrations.AddField(
+            model_name='conversationanalysis',
+            name='response_time_p95',
+            field=models.FloatField(blank=True, help_text='95th percentile response seconds', null=True),
+        ),
+        migrations.AlterField(
+            model_name='conversationanalysis',
+            name='response_time_avg',
+            field=models.FloatField(blank=True, help_text='Mean user -> AI response seconds', null=True),
+        ),
+        migrations.AlterField(
+            model_name='message',
+            name='timestamp',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+        migrations.RunPython(clear_mock_response_times, migrations.RunPython.noop),
+    ]
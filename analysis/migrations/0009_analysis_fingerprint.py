@@ -0,0 +1,23 @@
+# Generated by Django 4.2 on 2026-10-18 03:22
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('analysis', '0008_response_times'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='conversationanalysis',
+            name='analyzer_version',
+            field=models.IntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name='conversationanalysis',
+            name='fingerprint',
+            field=models.CharField(blank=True, default='', max_length=64),
+        ),
+    ]
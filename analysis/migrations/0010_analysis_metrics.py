@@ -0,0 +1,18 @@
+# Generated by Django 4.2 on 2026-10-18 03:27
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('analysis', '0009_analysis_fingerprint'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='conversationanalysis',
+            name='metrics',
+            field=models.JSONField(blank=True, default=None, null=True),
+        ),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 4.2 on 2026-10-18 03:31
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('analysis', '0010_analysis_metrics'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TermStatistics',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('documents', models.IntegerField(default=0, help_text='Messages counted')),
+                ('frequencies', models.JSONField(default=dict, help_text='Token -> number of messages containing it')),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'verbose_name_plural': 'Term statistics',
+            },
+        ),
+    ]
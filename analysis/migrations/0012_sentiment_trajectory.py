@@ -0,0 +1,23 @@
+# Generated by Django 4.2 on 2026-10-18 03:37
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('analysis', '0011_term_statistics'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='conversationanalysis',
+            name='sentiment_slope',
+            field=models.FloatField(blank=True, help_text='Change in sentiment per user message over the last few messages', null=True),
+        ),
+        migrations.AddField(
+            model_name='conversationanalysis',
+            name='sentiment_trajectory',
+            field=models.BinaryField(blank=True, default=None, null=True),
+        ),
+    ]
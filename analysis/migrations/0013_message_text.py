@@ -0,0 +1,27 @@
+# Generated by Django 4.2 on 2026-10-18 04:02
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('analysis', '0012_sentiment_trajectory'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MessageText',
+            fields=[
+                ('hash', models.CharField(help_text='texts.text_hash() of the text', max_length=32, primary_key=True, serialize=False)),
+                ('text', models.TextField(blank=True, default='', help_text='Empty when compressed')),
+                ('compressed', models.BinaryField(blank=True, default=None, help_text='zlib-compressed UTF-8 text', null=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='message',
+            name='stored_text',
+            field=models.ForeignKey(blank=True, db_column='text_hash', db_index=False, null=True, on_delete=django.db.models.deletion.PROTECT, related_name='+', to='analysis.messagetext'),
+        ),
+    ]
@@ -0,0 +1,23 @@
+# Generated by Django 4.2 on 2026-10-18 04:07
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('analysis', '0013_message_text'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='conversation',
+            name='archive',
+            field=models.CharField(blank=True, default='', help_text='Archive file name in ARCHIVE_DIR', max_length=255),
+        ),
+        migrations.AddField(
+            model_name='conversation',
+            name='archived_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
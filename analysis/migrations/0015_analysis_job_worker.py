@@ -0,0 +1,18 @@
+# Generated by Django 4.2 on 2026-10-18 05:16
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('analysis', '0014_conversation_archive'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='analysisjob',
+            name='worker',
+            field=models.CharField(blank=True, default='', max_length=255),
+        ),
+    ]
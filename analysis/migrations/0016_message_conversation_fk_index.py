@@ -0,0 +1,19 @@
+# Generated by Django 4.2 on 2026-10-18 05:17
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('analysis', '0015_analysis_job_worker'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='message',
+            name='conversation',
+            field=models.ForeignKey(db_index=False, on_delete=django.db.models.deletion.CASCADE, related_name='messages', to='analysis.conversation'),
+        ),
+    ]
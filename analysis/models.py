@@ -1,18 +1,124 @@
+import uuid
+
+from django.conf import settings
 from django.db import models
+from django.db.models.query import ModelIterable
+from django.utils import timezone
 
 class Conversation(models.Model):
     """
     Represents a chat conversation between user and AI
     """
     title = models.CharField(max_length=255)
+    bot = models.CharField(max_length=100, blank=True, default='', help_text="Bot/agent that handled the chat")
     created_at = models.DateTimeField(auto_now_add=True)
     analyzed = models.BooleanField(default=False)  
+    # Set by the nightly analysis while a chunk task owns this row, so
+    # overlapping runs never analyze the same conversation twice
+    claim_token = models.CharField(max_length=32, null=True, blank=True)
+    claimed_at = models.DateTimeField(null=True, blank=True)
+    # Set when the messages and analysis were moved to the archive file
+    # (see archive.py); the row stays behind as a stub
+    archived_at = models.DateTimeField(null=True, blank=True)
+    archive = models.CharField(max_length=255, blank=True, default='', help_text="Archive file name in ARCHIVE_DIR")
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # Remember the stored bot, so a save that changes it can move the
+        # analysis between rollup rows
+        if 'bot' in instance.__dict__:
+            instance._loaded_bot = instance.bot
+        return instance
 
     def __str__(self):
         return f"{self.title} (ID: {self.id})"
 
     class Meta:
         ordering = ['-created_at']  
+        indexes = [
+            # Keyset pagination of /api/conversations/list/
+            models.Index(fields=['-created_at', '-id'], name='conversation_created_idx'),
+            # Nightly scan for unanalyzed conversations, kept small by
+            # only covering the rows still to analyze
+            models.Index(
+                fields=['id'],
+                condition=models.Q(analyzed=False),
+                name='conversation_unanalyzed_idx',
+            ),
+        ]
+
+
+class MessageText(models.Model):
+    """
+    A message text stored once, however many messages share it
+    (with MESSAGE_TEXT_DEDUP, see analysis/texts.py)
+    """
+    hash = models.CharField(max_length=32, primary_key=True, help_text="texts.text_hash() of the text")
+    text = models.TextField(blank=True, default='', help_text="Empty when compressed")
+    compressed = models.BinaryField(null=True, blank=True, default=None, help_text="zlib-compressed UTF-8 text")
+
+    def get_text(self):
+        from .texts import decode_text
+
+        return decode_text(self.text, self.compressed)
+
+    def __str__(self):
+        return self.hash
+
+
+class MessageIterable(ModelIterable):
+    """
+    Loads messages and fills in the text of those stored in MessageText,
+    with one lookup per chunk of iterator() rows (per queryset otherwise)
+    """
+
+    def __iter__(self):
+        from .texts import load_texts
+
+        limit = self.chunk_size if self.chunked_fetch else None
+        messages = []
+        for message in super().__iter__():
+            messages.append(message)
+            if limit and len(messages) >= limit:
+                load_texts(messages)
+                yield from messages
+                messages = []
+        load_texts(messages)
+        yield from messages
+
+
+class MessageQuerySet(models.QuerySet):
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._iterable_class = MessageIterable
+
+    def bulk_create(self, objs, *args, **kwargs):
+        """
+        With MESSAGE_TEXT_DEDUP the texts go to MessageText first (see
+        texts.store_texts); the message objects keep their text in memory
+        """
+        if not getattr(settings, 'MESSAGE_TEXT_DEDUP', False):
+            return super().bulk_create(objs, *args, **kwargs)
+
+        from .texts import store_texts
+
+        objs = list(objs)
+        texts = [message.text for message in objs]
+        store_texts(objs)
+        try:
+            return super().bulk_create(objs, *args, **kwargs)
+        finally:
+            for message, text in zip(objs, texts):
+                message.text = text
+
+    def update(self, **kwargs):
+        # A new text replaces the stored one, which would otherwise be
+        # loaded over it
+        if 'text' in kwargs:
+            kwargs.setdefault('stored_text', None)
+        return super().update(**kwargs)
 
 
 class Message(models.Model):
@@ -22,17 +128,66 @@ class Message(models.Model):
     conversation = models.ForeignKey(
         Conversation, 
         on_delete=models.CASCADE, 
-        related_name="messages"
+        related_name="messages",
+        # message_conversation_idx (conversation, timestamp, id) starts
+        # with the column and serves every lookup by conversation
+        db_index=False,
     )
     sender = models.CharField(max_length=20) 
+    # Empty when the text is stored in MessageText; it is filled in again
+    # whenever messages are loaded
     text = models.TextField()
-    timestamp = models.DateTimeField(auto_now_add=True)
+    stored_text = models.ForeignKey(
+        MessageText,
+        on_delete=models.PROTECT,
+        null=True,
+        blank=True,
+        db_column='text_hash',
+        related_name='+',
+        # Texts are looked up by hash, never the messages of a text; an
+        # index would cost more than the deduplication saves
+        db_index=False,
+    )
+    # Defaults to the upload time; transcripts can supply the real one
+    timestamp = models.DateTimeField(default=timezone.now)
+
+    objects = MessageQuerySet.as_manager()
+
+    def save(self, *args, **kwargs):
+        """
+        A message whose text is stored in MessageText keeps the reference
+        (and an empty text field) only while its text is unchanged; an
+        edited text drops it and is saved inline
+        """
+        update_fields = kwargs.get('update_fields')
+        if (
+            self.stored_text_id is None or 'text' not in self.__dict__
+            or (update_fields is not None and 'text' not in update_fields)
+        ):
+            return super().save(*args, **kwargs)
+
+        text = self.text
+        if text and text != self.__dict__.get('_stored_text'):
+            self.stored_text_id = None
+            if update_fields is not None:
+                kwargs['update_fields'] = {*update_fields, 'stored_text'}
+            return super().save(*args, **kwargs)
+
+        self.text = ''
+        try:
+            return super().save(*args, **kwargs)
+        finally:
+            self.text = text
 
     def __str__(self):
         return f"{self.sender}: {self.text[:50]}..."
 
     class Meta:
-        ordering = ['timestamp']  
+        ordering = ['timestamp', 'id']
+        indexes = [
+            # Messages are always read per conversation in timestamp order
+            models.Index(fields=['conversation', 'timestamp', 'id'], name='message_conversation_idx'),
+        ]
 
 
 class ConversationAnalysis(models.Model):
@@ -60,8 +215,21 @@ class ConversationAnalysis(models.Model):
             ('negative', 'Negative'),
         ]
     )
+    # VADER compound score of every user message in order, packed as
+    # int16 ten-thousandths (see trajectory.py): two bytes per message
+    sentiment_trajectory = models.BinaryField(null=True, blank=True, default=None)
+    sentiment_slope = models.FloatField(
+        null=True, blank=True,
+        help_text="Change in sentiment per user message over the last few messages"
+    )
     empathy_score = models.FloatField(default=0.0, help_text="0.0 to 1.0")
-    response_time_avg = models.FloatField(default=0.0, help_text="Average seconds (mock)")
+    response_time_avg = models.FloatField(null=True, blank=True, help_text="Mean user -> AI response seconds")
+    response_time_p50 = models.FloatField(null=True, blank=True, help_text="Median response seconds")
+    response_time_p95 = models.FloatField(null=True, blank=True, help_text="95th percentile response seconds")
+    response_time_max = models.FloatField(null=True, blank=True, help_text="Slowest response seconds")
+    response_count = models.IntegerField(default=0, help_text="Number of user -> AI responses measured")
+    # QuantileSketch of the response times, merged into the fleet rollups
+    latency_sketch = models.JSONField(null=True, blank=True, default=None)
     
     resolution = models.BooleanField(default=False, help_text="Was issue resolved?")
     escalation_needed = models.BooleanField(default=False, help_text="Needs human escalation?")
@@ -71,6 +239,37 @@ class ConversationAnalysis(models.Model):
     overall_score = models.FloatField(default=0.0, help_text="0.0 to 1.0")
     
     created_at = models.DateTimeField(auto_now_add=True)
+    
+    # ConversationAnalyzer running state, so messages appended later can be
+    # analyzed without reading the earlier ones again
+    running_state = models.JSONField(null=True, blank=True, default=None)
+    
+    # Hash of the analyzed messages and the analyzer version: re-analyzing
+    # a conversation with the same fingerprint is skipped
+    fingerprint = models.CharField(max_length=64, blank=True, default='')
+    analyzer_version = models.IntegerField(null=True, blank=True)
+    
+    # Metrics computed (?metrics= / ANALYSIS_METRICS), None for all of
+    # them; the fields of the others are left at their defaults
+    metrics = models.JSONField(null=True, blank=True, default=None)
+
+    # Fields the summary rollups are computed from (metrics: partial
+    # analyses do not count)
+    ROLLUP_FIELDS = (
+        'created_at', 'overall_score', 'sentiment',
+        'resolution', 'escalation_needed', 'fallback_count',
+        'response_time_avg', 'response_count', 'latency_sketch', 'metrics',
+    )
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        # Remember what this row contributed to the rollups, so that an
+        # update can apply the difference without reading the row again
+        loaded = instance.__dict__
+        if all(name in loaded for name in cls.ROLLUP_FIELDS):
+            instance._rollup_snapshot = {name: loaded[name] for name in cls.ROLLUP_FIELDS}
+        return instance
 
     def __str__(self):
         return f"Analysis for: {self.conversation.title} (Score: {self.overall_score})"
@@ -78,3 +277,97 @@ class ConversationAnalysis(models.Model):
     class Meta:
         ordering = ['-created_at']
         verbose_name_plural = "Conversation Analyses"
+        indexes = [
+            # /api/reports/ pages, unfiltered and with its filters
+            models.Index(fields=['-created_at', '-id'], name='analysis_created_idx'),
+            models.Index(
+                fields=['sentiment', 'resolution', '-created_at', '-id'],
+                name='analysis_filter_idx',
+            ),
+        ]
+
+
+class AnalysisRollup(models.Model):
+    """
+    Running totals of ConversationAnalysis rows per day and bot
+    Kept up to date incrementally on every analysis write (see rollups.py),
+    so summary queries never scan the analysis table
+    """
+    day = models.DateField()
+    bot = models.CharField(max_length=100, blank=True, default='')
+    
+    analyses = models.IntegerField(default=0)
+    overall_score_sum = models.FloatField(default=0.0)
+    positive = models.IntegerField(default=0)
+    neutral = models.IntegerField(default=0)
+    negative = models.IntegerField(default=0)
+    resolved = models.IntegerField(default=0)
+    escalated = models.IntegerField(default=0)
+    fallback_total = models.IntegerField(default=0)
+    responses = models.IntegerField(default=0)
+    response_time_sum = models.FloatField(default=0.0)
+    latency_sketch = models.JSONField(null=True, blank=True, default=None)
+
+    def __str__(self):
+        return f"Rollup {self.day} {self.bot or '-'} ({self.analyses} analyses)"
+
+    class Meta:
+        ordering = ['day', 'bot']
+        constraints = [
+            models.UniqueConstraint(fields=['day', 'bot'], name='rollup_day_bot_unique'),
+        ]
+
+
+class AnalysisJob(models.Model):
+    """
+    One asynchronous POST /api/analyse/ request
+    The job id doubles as the Celery task id
+    """
+    QUEUED = 'queued'
+    RUNNING = 'running'
+    SUCCEEDED = 'succeeded'
+    FAILED = 'failed'
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    conversation = models.ForeignKey(
+        Conversation,
+        on_delete=models.CASCADE,
+        related_name='analysis_jobs'
+    )
+    status = models.CharField(
+        max_length=20,
+        default=QUEUED,
+        choices=[
+            (QUEUED, 'Queued'),
+            (RUNNING, 'Running'),
+            (SUCCEEDED, 'Succeeded'),
+            (FAILED, 'Failed'),
+        ]
+    )
+    error = models.TextField(blank=True, default='')
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+    # host:pid of the web process running the job in its local pool when
+    # there was no broker; empty for jobs queued on Celery
+    worker = models.CharField(max_length=255, blank=True, default='')
+
+    def __str__(self):
+        return f"Analysis job {self.id} ({self.status})"
+
+
+class TermStatistics(models.Model):
+    """
+    Document frequencies of message tokens, the IDF table relevance is
+    weighted with (see relevance.py)
+    Rebuilt periodically from all messages; only the latest row is used
+    """
+    documents = models.IntegerField(default=0, help_text="Messages counted")
+    frequencies = models.JSONField(default=dict, help_text="Token -> number of messages containing it")
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def __str__(self):
+        return f"Term statistics of {self.documents} messages ({self.created_at})"
+
+    class Meta:
+        verbose_name_plural = "Term statistics"
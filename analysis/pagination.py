@@ -0,0 +1,119 @@
+import base64
+import json
+
+from django.conf import settings
+from django.db.models import Q
+from django.http import StreamingHttpResponse
+from django.utils.dateparse import parse_datetime
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+def encode_cursor(row):
+    """
+    Opaque cursor pointing just after row in (-created_at, -id) order
+    """
+    position = f'{row.created_at.isoformat()}|{row.id}'
+    return base64.urlsafe_b64encode(position.encode()).decode()
+
+
+def decode_cursor(cursor):
+    try:
+        created_at, row_id = base64.urlsafe_b64decode(cursor.encode()).decode().split('|')
+        created_at = parse_datetime(created_at)
+        row_id = int(row_id)
+    except (ValueError, UnicodeError):
+        raise InvalidCursor(cursor)
+    if created_at is None:
+        raise InvalidCursor(cursor)
+    return created_at, row_id
+
+
+def keyset_filter(queryset, cursor):
+    """
+    Order newest first and, with a cursor, keep only the rows after it
+    Uses a (created_at, id) comparison rather than OFFSET, so every page
+    costs the same no matter how deep it is
+    """
+    queryset = queryset.order_by('-created_at', '-id')
+    if cursor:
+        created_at, row_id = decode_cursor(cursor)
+        queryset = queryset.filter(
+            Q(created_at__lt=created_at) | Q(created_at=created_at, id__lt=row_id)
+        )
+    return queryset
+
+
+def get_page_size(request):
+    default = getattr(settings, 'API_PAGE_SIZE', 100)
+    maximum = getattr(settings, 'API_MAX_PAGE_SIZE', 1000)
+    try:
+        limit = int(request.GET.get('limit', default))
+    except ValueError:
+        limit = default
+    return max(1, min(limit, maximum))
+
+
+def keyset_page(queryset, request, serializer_class):
+    """
+    One page of results in (-created_at, -id) order
+    Returns: {'results': [...], 'next_cursor': str or None}
+    """
+    limit = get_page_size(request)
+    queryset = keyset_filter(queryset, request.GET.get('cursor'))
+
+    rows = list(queryset[:limit + 1])
+    next_cursor = encode_cursor(rows[limit - 1]) if len(rows) > limit else None
+
+    return {
+        'results': serializer_class(rows[:limit], many=True).data,
+        'next_cursor': next_cursor,
+    }
+
+
+def ndjson_response(queryset, request, serializer_class):
+    """
+    Stream every row (after the optional cursor) as one JSON object per line
+    Rows are read with iterator(), so memory stays flat however many match
+    """
+    queryset = keyset_filter(queryset, request.GET.get('cursor'))
+    chunk_size = getattr(settings, 'API_STREAM_CHUNK_SIZE', 2000)
+
+    def rows():
+        for row in queryset.iterator(chunk_size=chunk_size):
+            yield json.dumps(serializer_class(row).data) + '\n'
+
+    return StreamingHttpResponse(rows(), content_type='application/x-ndjson')
+
+
+async def akeyset_page(queryset, request, serializer_class):
+    """
+    keyset_page for async views, read with the async ORM
+    """
+    limit = get_page_size(request)
+    queryset = keyset_filter(queryset, request.GET.get('cursor'))
+
+    rows = [row async for row in queryset[:limit + 1]]
+    next_cursor = encode_cursor(rows[limit - 1]) if len(rows) > limit else None
+
+    return {
+        'results': serializer_class(rows[:limit], many=True).data,
+        'next_cursor': next_cursor,
+    }
+
+
+def andjson_response(queryset, request, serializer_class):
+    """
+    ndjson_response for async views: rows are streamed from aiterator(),
+    so a slow client never holds a thread
+    """
+    queryset = keyset_filter(queryset, request.GET.get('cursor'))
+    chunk_size = getattr(settings, 'API_STREAM_CHUNK_SIZE', 2000)
+
+    async def rows():
+        async for row in queryset.aiterator(chunk_size=chunk_size):
+            yield json.dumps(serializer_class(row).data) + '\n'
+
+    return StreamingHttpResponse(rows(), content_type='application/x-ndjson')
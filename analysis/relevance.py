@@ -0,0 +1,230 @@
+import math
+import re
+import sys
+import threading
+import time
+from collections import Counter
+
+import numpy as np
+from django.conf import settings
+
+
+STOPWORDS = frozenset('''
+a about after again all also am an and any are as at be been before being
+but by can could did do does doing for from had has have having he her here
+him his how i if in into is it its just me more most my no not now of on
+once only or other our out over own same she should so some such than that
+the their them then there these they this those through to too under until
+up very was we were what when where which while who why will with would you
+your
+'''.split())
+
+# Words, numbers and contractions ("don't"); punctuation never sticks to a
+# token, so "help?" and "help" match
+_TOKEN = re.compile(r"[^\W_]+(?:'[^\W_]+)*")
+
+
+def find_tokens(text):
+    """
+    Lowercased tokens of text, stopwords included
+    """
+    return _TOKEN.findall(text.lower())
+
+
+def tokenize(text):
+    """
+    Lowercased, interned content tokens of text, stopwords removed
+    """
+    return [sys.intern(token) for token in find_tokens(text) if token not in STOPWORDS]
+
+
+def count_terms(texts, counts=None):
+    """
+    Content token counts of texts, each text tokenized once
+    Occurrences are counted first, so stopword filtering and interning
+    cost one step per distinct token rather than per occurrence
+    counts: existing {token: count} to add to (it is not modified)
+    Returns: {token: count}
+    """
+    tokens = []
+    for text in texts:
+        tokens += find_tokens(text)
+    found = Counter(tokens)
+    for token in STOPWORDS.intersection(found):
+        del found[token]
+
+    if not counts:
+        return {sys.intern(token): count for token, count in found.items()}
+    counts = dict(counts)
+    for token, count in found.items():
+        token = sys.intern(token)
+        counts[token] = counts.get(token, 0) + count
+    return counts
+
+
+_SMALL_TF = [0.0] + [1.0 + math.log(count) for count in range(1, 256)]
+
+
+def sublinear_tf(count):
+    """
+    1 + ln(count): repeating a word adds less and less weight
+    """
+    if count < 256:
+        return _SMALL_TF[count]
+    return 1.0 + math.log(count)
+
+
+def _cosine(dot, user_norm, ai_norm):
+    if not user_norm or not ai_norm:
+        return 0.0
+    return dot / (math.sqrt(user_norm) * math.sqrt(ai_norm))
+
+
+class IdfTable:
+    """
+    Inverse document frequencies of message tokens
+
+    idf = ln((1 + documents) / (1 + df)) + 1, so tokens that are rare in
+    the corpus weigh more and unseen ones weigh the most. An empty table
+    weighs every token 1 (plain term-frequency cosine).
+    version identifies the table; it is part of analysis fingerprints
+    """
+
+    def __init__(self, documents=0, frequencies=None, version=0):
+        self.documents = documents
+        self.frequencies = frequencies or {}
+        self.version = version
+        self.default = math.log(1 + documents) + 1
+        self._idf = {
+            token: math.log((1 + documents) / (1 + df)) + 1
+            for token, df in self.frequencies.items()
+        }
+
+    def idf(self, token):
+        return self._idf.get(token, self.default)
+
+    def weights(self, tokens):
+        """
+        IDF of each token, as an array aligned with tokens
+        """
+        idf = self._idf
+        default = self.default
+        return np.fromiter((idf.get(token, default) for token in tokens), dtype=np.float64, count=len(tokens))
+
+    def vector(self, counts):
+        """
+        Sparse TF-IDF vector {token: weight} of term counts
+        """
+        idf = self._idf
+        default = self.default
+        return {token: sublinear_tf(count) * idf.get(token, default) for token, count in counts.items()}
+
+    def score(self, user_counts, ai_counts):
+        """
+        Cosine similarity of the TF-IDF vectors of two term counts
+        Sums are exact (math.fsum), so the result does not depend on the
+        order terms are visited in and score_segments gives the same value
+        """
+        user = self.vector(user_counts)
+        ai = self.vector(ai_counts)
+        if len(ai) < len(user):
+            user, ai = ai, user
+        dot = math.fsum([weight * ai[token] for token, weight in user.items() if token in ai])
+        return _cosine(
+            dot,
+            math.fsum([weight * weight for weight in user.values()]),
+            math.fsum([weight * weight for weight in ai.values()]),
+        )
+
+    def score_segments(self, n, size, tokens, user_keys, user_counts, ai_keys, ai_counts):
+        """
+        score() of n conversations at once
+        tokens: the vocabulary, id -> token
+        user_keys / ai_keys: sorted unique conversation * size + token id
+        user_counts / ai_counts: occurrences of each key
+        Returns: list of n cosine similarities
+        """
+        # Same math.log values as score(), looked up by count
+        largest = int(max(user_counts.max(initial=0), ai_counts.max(initial=0)))
+        tf_table = np.array([0.0] + [sublinear_tf(count) for count in range(1, largest + 1)])
+        idf = self.weights(tokens)
+        user_weights = tf_table[user_counts] * idf[user_keys % size]
+        ai_weights = tf_table[ai_counts] * idf[ai_keys % size]
+        common, user_index, ai_index = np.intersect1d(
+            user_keys, ai_keys, assume_unique=True, return_indices=True
+        )
+
+        def sums(keys, values):
+            bounds = np.searchsorted(keys // size, np.arange(n + 1))
+            return [math.fsum(values[bounds[i]:bounds[i + 1]].tolist()) for i in range(n)]
+
+        dots = sums(common, user_weights[user_index] * ai_weights[ai_index])
+        user_norms = sums(user_keys, user_weights * user_weights)
+        ai_norms = sums(ai_keys, ai_weights * ai_weights)
+        return [_cosine(*values) for values in zip(dots, user_norms, ai_norms)]
+
+
+def build_idf_table(texts, min_df=2, max_terms=100000):
+    """
+    Document frequencies over texts (one document per message), keeping
+    the max_terms most frequent tokens seen in at least min_df documents
+    Returns: (documents, {token: df})
+    """
+    frequencies = Counter()
+    documents = 0
+    for text in texts:
+        frequencies.update(set(tokenize(text)))
+        documents += 1
+    kept = [(token, df) for token, df in frequencies.most_common(max_terms) if df >= min_df]
+    return documents, dict(kept)
+
+
+def refresh_idf_table(chunk_size=2000):
+    """
+    Recompute the IDF table from every message and store it as the
+    current TermStatistics row (older rows are deleted)
+    Returns: the new TermStatistics
+    """
+    from .models import Message, TermStatistics
+
+    # Model instances rather than values_list, so texts stored in
+    # MessageText are filled in
+    messages = Message.objects.only('text', 'stored_text').iterator(chunk_size=chunk_size)
+    documents, frequencies = build_idf_table(
+        (message.text for message in messages),
+        min_df=getattr(settings, 'RELEVANCE_IDF_MIN_DF', 2),
+        max_terms=getattr(settings, 'RELEVANCE_IDF_MAX_TERMS', 100000),
+    )
+    statistics = TermStatistics.objects.create(documents=documents, frequencies=frequencies)
+    TermStatistics.objects.filter(id__lt=statistics.id).delete()
+    return statistics
+
+
+_idf_table = IdfTable()
+_idf_checked_at = None
+_idf_lock = threading.Lock()
+
+
+def get_idf_table():
+    """
+    Process-wide IdfTable from the latest TermStatistics row
+    The database is checked for a newer table at most every
+    RELEVANCE_IDF_RELOAD seconds; until a table has been built every
+    token weighs 1
+    """
+    global _idf_table, _idf_checked_at
+    reload = getattr(settings, 'RELEVANCE_IDF_RELOAD', 300)
+    now = time.monotonic()
+    if _idf_checked_at is not None and now - _idf_checked_at < reload:
+        return _idf_table
+
+    from .models import TermStatistics
+
+    with _idf_lock:
+        if _idf_checked_at is None or now - _idf_checked_at >= reload:
+            latest = TermStatistics.objects.order_by('-id').values_list('id', flat=True).first()
+            if latest is not None and latest != _idf_table.version:
+                statistics = TermStatistics.objects.get(id=latest)
+                _idf_table = IdfTable(statistics.documents, statistics.frequencies, statistics.id)
+            _idf_checked_at = now
+    return _idf_table
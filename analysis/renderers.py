@@ -0,0 +1,52 @@
+import json
+
+from rest_framework.renderers import BaseRenderer
+
+
+class NDJSONRenderer(BaseRenderer):
+    """
+    Renders a list as newline-delimited JSON (one object per line)
+    Large list endpoints bypass it and stream their rows directly; it is
+    registered so that ?format=ndjson and Accept: application/x-ndjson
+    are negotiated
+    """
+    media_type = 'application/x-ndjson'
+    format = 'ndjson'
+    charset = 'utf-8'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        if not isinstance(data, list):
+            data = [data]
+        return ''.join(json.dumps(item) + '\n' for item in data).encode(self.charset)
+
+
+class ExportRenderer(BaseRenderer):
+    """
+    A file format of /api/reports/export/, registered so that ?format= and
+    Accept are negotiated; the view streams the file itself (see
+    export.py), so only error responses are rendered here, as JSON
+    """
+    charset = None
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        response = (renderer_context or {}).get('response')
+        if response is not None:
+            response['Content-Type'] = 'application/json'
+        return json.dumps(data).encode('utf-8')
+
+
+class CSVExportRenderer(ExportRenderer):
+    media_type = 'text/csv'
+    format = 'csv'
+
+
+class NDJSONExportRenderer(ExportRenderer):
+    media_type = 'application/x-ndjson'
+    format = 'ndjson'
+
+
+class ParquetExportRenderer(ExportRenderer):
+    media_type = 'application/vnd.apache.parquet'
+    format = 'parquet'
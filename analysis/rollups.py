@@ -0,0 +1,227 @@
+from collections import defaultdict
+
+from django.db import transaction
+from django.db.models import DateField, F
+from django.db.models.functions import Trunc
+from django.utils import timezone
+
+from .models import AnalysisRollup, ConversationAnalysis
+from .sketch import QuantileSketch
+
+
+ROLLUP_COUNTERS = (
+    'analyses', 'overall_score_sum', 'positive', 'neutral', 'negative',
+    'resolved', 'escalated', 'fallback_total', 'responses', 'response_time_sum',
+)
+
+
+def rollup_key(created_at, bot):
+    return timezone.localtime(created_at).date(), bot or ''
+
+
+def contribution(values, sign=1):
+    """
+    What one analysis adds to its rollup row (sign=-1 to remove it)
+    values: mapping with the ConversationAnalysis.ROLLUP_FIELDS
+    """
+    sentiment = values['sentiment']
+    return {
+        'analyses': sign,
+        'overall_score_sum': sign * values['overall_score'],
+        'positive': sign * (sentiment == 'positive'),
+        'neutral': sign * (sentiment == 'neutral'),
+        'negative': sign * (sentiment == 'negative'),
+        'resolved': sign * bool(values['resolution']),
+        'escalated': sign * bool(values['escalation_needed']),
+        'fallback_total': sign * values['fallback_count'],
+        'responses': sign * values['response_count'],
+        'response_time_sum': sign * (values['response_time_avg'] or 0.0) * values['response_count'],
+    }
+
+
+def analysis_values(analysis):
+    return {name: getattr(analysis, name) for name in ConversationAnalysis.ROLLUP_FIELDS}
+
+
+class RollupDeltas:
+    """
+    Accumulates rollup changes per (day, bot) and applies them with one
+    atomic F() update per touched row (plus an INSERT the first time a
+    day/bot pair is seen)
+
+    Latency sketches cannot be added in SQL; rows whose sketch changes are
+    locked, merged in Python and written back in the same UPDATE
+    """
+
+    def __init__(self):
+        self._deltas = defaultdict(lambda: dict.fromkeys(ROLLUP_COUNTERS, 0))
+        self._sketches = defaultdict(QuantileSketch)
+
+    def add(self, values, bot, sign=1):
+        # The fields a partial analysis did not compute hold their
+        # defaults (overall_score 0.0, sentiment neutral, ...), which
+        # would drag the fleet averages; only full analyses count
+        if values['metrics'] is not None:
+            return
+        key = rollup_key(values['created_at'], bot)
+        delta = self._deltas[key]
+        for name, value in contribution(values, sign).items():
+            delta[name] += value
+        if values['latency_sketch']:
+            self._sketches[key].merge(QuantileSketch.from_dict(values['latency_sketch']), sign)
+
+    def apply(self):
+        # Rows are updated (so locked) in key order: two transactions that
+        # touch the same rows always take their locks in the same order,
+        # and cannot deadlock
+        for (day, bot), delta in sorted(self._deltas.items()):
+            sketch = self._sketches.get((day, bot))
+            if sketch:
+                self._apply_with_sketch(day, bot, delta, sketch)
+                continue
+            if not any(delta.values()):
+                continue
+            changes = {name: F(name) + value for name, value in delta.items() if value}
+            rows = AnalysisRollup.objects.filter(day=day, bot=bot)
+            if not rows.update(**changes):
+                AnalysisRollup.objects.get_or_create(day=day, bot=bot)
+                rows.update(**changes)
+        self._deltas.clear()
+        self._sketches.clear()
+
+    def _apply_with_sketch(self, day, bot, delta, sketch):
+        # No savepoint of its own: this runs inside the analysis save
+        with transaction.atomic(savepoint=False):
+            row, _ = AnalysisRollup.objects.select_for_update().get_or_create(day=day, bot=bot)
+            merged = QuantileSketch.from_dict(row.latency_sketch).merge(sketch)
+            AnalysisRollup.objects.filter(pk=row.pk).update(
+                latency_sketch=merged.to_dict() if merged else None,
+                **{name: F(name) + value for name, value in delta.items() if value}
+            )
+
+
+def record_analysis_saved(analysis, previous=None):
+    """
+    Update the rollups for a saved analysis
+    previous: the analysis' ROLLUP_FIELDS before this save, if it existed
+    """
+    bot = analysis.conversation.bot
+    deltas = RollupDeltas()
+    if previous is not None:
+        deltas.add(previous, bot, sign=-1)
+    deltas.add(analysis_values(analysis), bot)
+    deltas.apply()
+
+
+def record_bot_changed(conversation, previous_bot):
+    """
+    Move the conversation's analysis (if any) from the rollup row of
+    previous_bot to the one of its current bot
+    """
+    values = (
+        ConversationAnalysis.objects
+        .filter(conversation=conversation)
+        .values(*ConversationAnalysis.ROLLUP_FIELDS)
+        .first()
+    )
+    if values is None:
+        return
+    deltas = RollupDeltas()
+    deltas.add(values, previous_bot, sign=-1)
+    deltas.add(values, conversation.bot)
+    deltas.apply()
+
+
+def record_analysis_deleted(analysis, bot):
+    deltas = RollupDeltas()
+    deltas.add(analysis_values(analysis), bot, sign=-1)
+    deltas.apply()
+
+
+def rebuild_rollups(chunk_size=10000):
+    """
+    Recompute every rollup row from the analysis table and the archives
+    Returns: number of analyses counted
+    """
+    from .archive import iter_archives, stub_bots
+
+    AnalysisRollup.objects.all().delete()
+    deltas = RollupDeltas()
+    count = 0
+    rows = ConversationAnalysis.objects.values(
+        *ConversationAnalysis.ROLLUP_FIELDS, 'conversation__bot'
+    ).order_by().iterator(chunk_size=chunk_size)
+    for values in rows:
+        deltas.add(values, values['conversation__bot'])
+        count += 1
+        if count % chunk_size == 0:
+            deltas.apply()
+    deltas.apply()
+    # Archived analyses keep counting, one archive file at a time
+    for archive in iter_archives():
+        rows = archive.analysis_values(ConversationAnalysis.ROLLUP_FIELDS)
+        bots = stub_bots([values['conversation_id'] for values in rows])
+        for values in rows:
+            deltas.add(values, bots.get(values['conversation_id'], ''))
+        count += len(rows)
+        deltas.apply()
+    return count
+
+
+SUMMARY_BUCKETS = ('day', 'week', 'month', 'year')
+
+
+def summarize(rollups, bucket='day', by_bot=False):
+    """
+    Aggregate rollup rows into time buckets (optionally per bot)
+    The rows are few (one per day and bot) and their latency sketches
+    have to be merged in Python, so they are read in one query and
+    grouped here
+    Returns: list of dicts, oldest bucket first
+    """
+    rows = (
+        rollups
+        .annotate(period=Trunc('day', bucket, output_field=DateField()))
+        .values('period', 'bot', 'latency_sketch', *ROLLUP_COUNTERS)
+        .order_by('period', 'bot')
+    )
+    
+    groups = {}
+    for row in rows:
+        key = (row['period'], row['bot']) if by_bot else (row['period'],)
+        totals, sketch = groups.setdefault(key, (dict.fromkeys(ROLLUP_COUNTERS, 0), QuantileSketch()))
+        for name in ROLLUP_COUNTERS:
+            totals[name] += row[name]
+        if row['latency_sketch']:
+            sketch.merge(QuantileSketch.from_dict(row['latency_sketch']))
+    
+    results = []
+    for key, (totals, sketch) in sorted(groups.items()):
+        analyses = totals['analyses']
+        if not analyses:
+            continue
+        result = {'period': key[0].isoformat()}
+        if by_bot:
+            result['bot'] = key[1]
+        responses = totals['responses']
+        result.update({
+            'analyses': analyses,
+            'avg_overall_score': round(totals['overall_score_sum'] / analyses, 4),
+            'sentiment': {
+                'positive': totals['positive'],
+                'neutral': totals['neutral'],
+                'negative': totals['negative'],
+            },
+            'resolution_rate': round(totals['resolved'] / analyses, 4),
+            'escalation_rate': round(totals['escalated'] / analyses, 4),
+            'fallback_total': totals['fallback_total'],
+            'response_time': {
+                'responses': responses,
+                'mean': round(totals['response_time_sum'] / responses, 2),
+                'p50': round(sketch.quantile(0.5), 2),
+                'p95': round(sketch.quantile(0.95), 2),
+                'p99': round(sketch.quantile(0.99), 2),
+            } if responses and sketch else None,
+        })
+        results.append(result)
+    return results
@@ -0,0 +1,369 @@
+import importlib.util
+import logging
+import marshal
+import math
+import os
+import string
+import sys
+import tempfile
+import threading
+
+from django.conf import settings
+
+
+logger = logging.getLogger(__name__)
+
+# Bumped whenever the layout of the compiled tables changes
+FORMAT_VERSION = 1
+
+_PUNCTUATION = frozenset(string.punctuation)
+_REMOVE_PUNCTUATION = str.maketrans('', '', string.punctuation)
+_INTENSIFIED = ('so', 'this')
+
+
+def nltk_version():
+    """
+    Version of the installed NLTK
+    Importing nltk takes hundreds of milliseconds, so when it is not
+    imported yet the version is read from the VERSION file nltk itself
+    reads it from
+    """
+    if 'nltk' not in sys.modules:
+        spec = importlib.util.find_spec('nltk')
+        if spec is not None and spec.origin:
+            try:
+                with open(os.path.join(os.path.dirname(spec.origin), 'VERSION')) as f:
+                    return f.read().strip()
+            except OSError:
+                pass
+    import nltk
+    return nltk.__version__
+
+
+def compile_tables():
+    """
+    VADER's lexicon and rule tables, read once from NLTK and flattened into
+    builtins marshal can store
+    Multi-word boosters and idioms become tuples of words, so they are
+    matched against tokens without joining strings
+    Raises: LookupError if the NLTK vader_lexicon data is not installed
+    """
+    from nltk.sentiment.vader import SentimentIntensityAnalyzer
+
+    analyzer = SentimentIntensityAnalyzer()
+    constants = analyzer.constants
+    # Tokens never contain spaces, so a lowercased token only ever finds
+    # the one-word boosters, and "kind of"-style bigrams only match as pairs
+    boosters = {}
+    booster_pairs = set()
+    for phrase, scalar in constants.BOOSTER_DICT.items():
+        words = tuple(phrase.split(' '))
+        if len(words) == 1:
+            boosters[phrase] = scalar
+        elif len(words) == 2:
+            booster_pairs.add(words)
+
+    return {
+        'format': FORMAT_VERSION,
+        'nltk_version': nltk_version(),
+        'lexicon': analyzer.lexicon,
+        'negations': frozenset(constants.NEGATE),
+        'boosters': boosters,
+        'booster_pairs': frozenset(booster_pairs),
+        'idioms': {tuple(idiom.split(' ')): value for idiom, value in constants.SPECIAL_CASE_IDIOMS.items()},
+        'punctuation': frozenset(constants.PUNC_LIST),
+        'b_decr': constants.B_DECR,
+        'c_incr': constants.C_INCR,
+        'n_scalar': constants.N_SCALAR,
+    }
+
+
+class SentimentEngine:
+    """
+    VADER compound scores from precompiled tables, matching NLTK's
+    SentimentIntensityAnalyzer.polarity_scores(text)['compound']
+
+    The rules are NLTK's, quirks included (a repeated word is scored in the
+    context of its first occurrence), and every float operation happens in
+    the same order, so scores are identical. What changes is the per-text
+    work: NLTK builds a dict of every punctuation/word combination of the
+    text and looks words up by linear search, where this tokenizes in one
+    pass and lowercases each token once.
+    """
+
+    def __init__(self, tables):
+        self.tables = tables
+        self.nltk_version = tables['nltk_version']
+        self.lexicon = tables['lexicon']
+        self.negations = tables['negations']
+        self.boosters = tables['boosters']
+        self.booster_pairs = tables['booster_pairs']
+        self.idioms = tables['idioms']
+        self.punctuation = tables['punctuation']
+        self.b_decr = tables['b_decr']
+        self.c_incr = tables['c_incr']
+        self.n_scalar = tables['n_scalar']
+        # 'least' negates the next word only when it is not a lexicon word
+        self._least_negates = 'least' not in self.lexicon
+
+    @classmethod
+    def from_nltk(cls):
+        return cls(compile_tables())
+
+    @classmethod
+    def load(cls, path):
+        """
+        Raises: OSError if path cannot be read, ValueError if it holds no
+        tables or tables of another format or NLTK version
+        """
+        with open(path, 'rb') as f:
+            data = f.read()
+        try:
+            # Much faster than marshal.load(f), which reads in small pieces
+            tables = marshal.loads(data)
+        except (EOFError, TypeError) as e:
+            raise ValueError(f'{path} is not a compiled sentiment lexicon: {e}')
+        if not isinstance(tables, dict) or tables.get('format') != FORMAT_VERSION:
+            raise ValueError(f'{path} is not a compiled sentiment lexicon of format {FORMAT_VERSION}')
+
+        installed = nltk_version()
+        if tables['nltk_version'] != installed:
+            raise ValueError(f'{path} was compiled from NLTK {tables["nltk_version"]}, not {installed}')
+        return cls(tables)
+
+    def save(self, path):
+        """
+        Write the tables to path atomically, so concurrent readers never
+        see a partial file
+        """
+        directory = os.path.dirname(os.path.abspath(path))
+        fd, temporary = tempfile.mkstemp(dir=directory, prefix='.sentiment-')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                marshal.dump(self.tables, f)
+            # mkstemp creates the file readable by its owner only
+            os.chmod(temporary, 0o644)
+            os.replace(temporary, path)
+        except BaseException:
+            os.unlink(temporary)
+            raise
+
+    def tokens(self, text):
+        """
+        VADER's words and emoticons: whitespace-separated tokens of at least
+        two characters; a word with one PUNC_LIST entry stuck before or
+        after it loses it, if the word also occurs in the text with all
+        punctuation removed
+        """
+        words = None
+        tokens = []
+        for token in text.split():
+            if len(token) < 2:
+                continue
+            if token[0] in _PUNCTUATION:
+                start = len(token) - len(token.lstrip(string.punctuation))
+                affix, word = token[:start], token[start:]
+            elif token[-1] in _PUNCTUATION:
+                end = len(token.rstrip(string.punctuation))
+                word, affix = token[:end], token[end:]
+            else:
+                tokens.append(token)
+                continue
+            if affix in self.punctuation:
+                if words is None:
+                    words = {part for part in text.translate(_REMOVE_PUNCTUATION).split() if len(part) > 1}
+                if word in words:
+                    token = word
+            tokens.append(token)
+        return tokens
+
+    def compound(self, text):
+        """
+        VADER compound score of text, rounded to 4 decimals like NLTK's
+        """
+        tokens = self.tokens(text)
+        if not tokens:
+            return 0.0
+        lexicon = self.lexicon
+        boosters = self.boosters
+        count = len(tokens)
+        lowered = [token.lower() for token in tokens]
+        capitals = sum(1 for token in tokens if token.isupper())
+        is_cap_diff = 0 < count - capitals < count
+
+        first = {}
+        for index, token in enumerate(tokens):
+            first.setdefault(token, index)
+
+        sentiments = []
+        for token in tokens:
+            i = first[token]
+            word = lowered[i]
+            valence = lexicon.get(word)
+            if (
+                valence is None
+                or word in boosters
+                or (word == 'kind' and i < count - 1 and lowered[i + 1] == 'of')
+            ):
+                sentiments.append(0)
+            else:
+                sentiments.append(self._valence(valence, tokens, lowered, i, is_cap_diff))
+
+        if 'but' in lowered:
+            but = lowered.index('but')
+            for index, sentiment in enumerate(sentiments):
+                if index < but:
+                    sentiments[index] = sentiment * 0.5
+                elif index > but:
+                    sentiments[index] = sentiment * 1.5
+
+        total = float(sum(sentiments))
+        if total:
+            emphasis = min(text.count('!'), 4) * 0.292
+            questions = text.count('?')
+            if questions > 1:
+                emphasis = emphasis + (questions * 0.18 if questions <= 3 else 0.96)
+            if total > 0:
+                total += emphasis
+            else:
+                total -= emphasis
+        return round(total / math.sqrt(total * total + 15), 4)
+
+    def _valence(self, valence, tokens, lowered, i, is_cap_diff):
+        lexicon = self.lexicon
+        n_scalar = self.n_scalar
+        if is_cap_diff and tokens[i].isupper():
+            if valence > 0:
+                valence += self.c_incr
+            else:
+                valence -= self.c_incr
+
+        # The three preceding words, unless they are sentiment words
+        # themselves, may boost, dampen or negate this one
+        for distance in (1, 2, 3):
+            j = i - distance
+            if j < 0 or lowered[j] in lexicon:
+                continue
+            scalar = self.boosters.get(lowered[j], 0.0)
+            if scalar:
+                if valence < 0:
+                    scalar *= -1
+                if is_cap_diff and tokens[j].isupper():
+                    if valence > 0:
+                        scalar += self.c_incr
+                    else:
+                        scalar -= self.c_incr
+                if distance == 2:
+                    scalar = scalar * 0.95
+                elif distance == 3:
+                    scalar = scalar * 0.9
+            valence = valence + scalar
+
+            if distance == 1:
+                if self._negates(lowered[j]):
+                    valence = valence * n_scalar
+            elif distance == 2:
+                if tokens[j] == 'never' and tokens[i - 1] in _INTENSIFIED:
+                    valence = valence * 1.5
+                elif self._negates(lowered[j]):
+                    valence = valence * n_scalar
+            else:
+                if (tokens[j] == 'never' and tokens[i - 2] in _INTENSIFIED) or tokens[i - 1] in _INTENSIFIED:
+                    valence = valence * 1.25
+                elif self._negates(lowered[j]):
+                    valence = valence * n_scalar
+                valence = self._idioms(valence, tokens, i)
+
+        if i > 0 and self._least_negates and lowered[i - 1] == 'least':
+            if i == 1 or lowered[i - 2] not in ('at', 'very'):
+                valence = valence * n_scalar
+        return valence
+
+    def _negates(self, word):
+        return word in self.negations or "n't" in word
+
+    def _idioms(self, valence, tokens, i):
+        # Only reached with i >= 3
+        idioms = self.idioms
+        for sequence in (
+            (tokens[i - 1], tokens[i]),
+            (tokens[i - 2], tokens[i - 1], tokens[i]),
+            (tokens[i - 2], tokens[i - 1]),
+            (tokens[i - 3], tokens[i - 2], tokens[i - 1]),
+            (tokens[i - 3], tokens[i - 2]),
+        ):
+            if sequence in idioms:
+                valence = idioms[sequence]
+                break
+        if len(tokens) - 1 > i:
+            sequence = (tokens[i], tokens[i + 1])
+            if sequence in idioms:
+                valence = idioms[sequence]
+        if len(tokens) - 1 > i + 1:
+            sequence = (tokens[i], tokens[i + 1], tokens[i + 2])
+            if sequence in idioms:
+                valence = idioms[sequence]
+        if (tokens[i - 3], tokens[i - 2]) in self.booster_pairs or (tokens[i - 2], tokens[i - 1]) in self.booster_pairs:
+            valence = valence + self.b_decr
+        return valence
+
+    def score_many(self, texts):
+        """
+        Compound score of each text; a text repeated in the batch is
+        scored once
+        Returns: list of floats in the order of texts
+        """
+        scores = {}
+        compound = self.compound
+        for text in texts:
+            if text not in scores:
+                scores[text] = compound(text)
+        return [scores[text] for text in texts]
+
+
+_sentiment_engine = None
+_sentiment_engine_lock = threading.Lock()
+
+
+def _reset_lock_after_fork():
+    # A fork while another thread held the lock would leave it locked forever
+    global _sentiment_engine_lock
+    _sentiment_engine_lock = threading.Lock()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_lock_after_fork)
+
+
+def load_sentiment_engine(path=None):
+    """
+    SentimentEngine from the compiled tables at path (SENTIMENT_ENGINE_FILE
+    by default), compiled from NLTK in memory if the file is missing or
+    stale; only manage.py compile_sentiment writes the file
+    Raises: LookupError if the tables must be compiled and the NLTK
+    vader_lexicon data is not installed
+    """
+    if path is None:
+        path = getattr(settings, 'SENTIMENT_ENGINE_FILE', None)
+    if path:
+        try:
+            return SentimentEngine.load(path)
+        except FileNotFoundError:
+            logger.warning(f"{path} is missing, compiling the sentiment lexicon; run manage.py compile_sentiment")
+        except (OSError, ValueError) as e:
+            logger.warning(f"Compiling the sentiment lexicon ({e}); run manage.py compile_sentiment")
+    return SentimentEngine.from_nltk()
+
+
+def get_sentiment_engine():
+    """
+    Process-wide SentimentEngine, loaded on first use
+    It is read-only afterwards, so it is safe to share between threads
+    Server and worker processes load it at startup (see services.preload)
+    """
+    global _sentiment_engine
+    if _sentiment_engine is None:
+        with _sentiment_engine_lock:
+            if _sentiment_engine is None:
+                _sentiment_engine = load_sentiment_engine()
+    return _sentiment_engine
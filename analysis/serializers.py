@@ -1,5 +1,6 @@
+from django.db import transaction
 from rest_framework import serializers
-from .models import Conversation, Message, ConversationAnalysis
+from .models import AnalysisJob, Conversation, Message, ConversationAnalysis
 
 
 class MessageSerializer(serializers.ModelSerializer):
@@ -8,7 +9,7 @@ class MessageSerializer(serializers.ModelSerializer):
     """
     class Meta:
         model = Message
-        fields = ['sender', 'text']
+        fields = ['sender', 'text', 'timestamp']
 
 
 class ConversationCreateSerializer(serializers.ModelSerializer):
@@ -19,14 +20,17 @@ class ConversationCreateSerializer(serializers.ModelSerializer):
     
     class Meta:
         model = Conversation
-        fields = ['title', 'messages']
+        fields = ['title', 'bot', 'messages']
     
     def create(self, validated_data):
         messages_data = validated_data.pop('messages')
-        conversation = Conversation.objects.create(**validated_data)
         
-        for message_data in messages_data:
-            Message.objects.create(conversation=conversation, **message_data)
+        with transaction.atomic():
+            conversation = Conversation.objects.create(**validated_data)
+            Message.objects.bulk_create([
+                Message(conversation=conversation, **message_data)
+                for message_data in messages_data
+            ])
         
         return conversation
 
@@ -37,7 +41,7 @@ class ConversationListSerializer(serializers.ModelSerializer):
     """
     class Meta:
         model = Conversation
-        fields = ['id', 'title', 'created_at', 'analyzed']
+        fields = ['id', 'title', 'bot', 'created_at', 'analyzed', 'archived_at']
 
 
 class AnalysisSerializer(serializers.ModelSerializer):
@@ -57,12 +61,39 @@ class AnalysisSerializer(serializers.ModelSerializer):
             'accuracy_score',
             'completeness_score',
             'sentiment',
+            'sentiment_slope',
             'empathy_score',
             'response_time_avg',
+            'response_time_p50',
+            'response_time_p95',
+            'response_time_max',
+            'response_count',
             'resolution',
             'escalation_needed',
             'fallback_count',
             'overall_score',
+            'metrics',
+            'fingerprint',
+            'analyzer_version',
             'created_at',
         ]
         read_only_fields = ['created_at']
+
+
+class AnalysisJobSerializer(serializers.ModelSerializer):
+    """
+    Serializer for asynchronous analysis jobs
+    """
+    job_id = serializers.UUIDField(source='id', read_only=True)
+    
+    class Meta:
+        model = AnalysisJob
+        fields = [
+            'job_id',
+            'conversation',
+            'status',
+            'error',
+            'created_at',
+            'started_at',
+            'finished_at',
+        ]
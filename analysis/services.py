@@ -1,5 +1,172 @@
-from nltk.sentiment.vader import SentimentIntensityAnalyzer
-import random
+from django.conf import settings
+from datetime import datetime, timedelta, timezone
+from itertools import chain
+import hashlib
+import logging
+import numpy as np
+import re
+
+from .cache import get_sentiment_cache
+from .matching import get_matcher
+from .metrics import BUILTIN_METRICS, MetricInputs, registry
+from .relevance import STOPWORDS, count_terms, find_tokens, get_idf_table
+from .sentiment import get_sentiment_engine
+from .sketch import QuantileSketch
+from . import trajectory
+
+
+logger = logging.getLogger(__name__)
+
+
+EMPATHY_KEYWORDS = [
+    'sorry', 'understand', 'help', 'appreciate', 
+    'apologize', 'thank', 'care', 'concern',
+    'happy', 'glad', 'pleasure', 'welcome'
+]
+
+FALLBACK_PHRASES = [
+    "i don't know", 
+    "i'm not sure", 
+    "i cannot",
+    "sorry, i can't", 
+    "don't understand",
+    "unable to help",
+    "not able to"
+]
+
+RESOLUTION_KEYWORDS = [
+    'thank', 'thanks', 'resolved', 'fixed', 
+    'solved', 'great', 'perfect', 'awesome',
+    'helped', 'appreciate', 'done'
+]
+
+# VADER compound scores are rounded to 4 decimals, so they are summed as
+# integer ten-thousandths: the mean is then exact and independent of
+# summation order, which lets analyze_batch reproduce it bit for bit
+SENTIMENT_SCALE = 10000
+SENTIMENT_THRESHOLD = 500  # 0.05 in SENTIMENT_SCALE units
+
+# Escalation also follows the trend of the last TREND_WINDOW user
+# messages: a steady decline that ends on a negative message escalates
+# even while the conversation's mean sentiment is not negative yet
+TREND_WINDOW = 5
+TREND_MIN_MESSAGES = 3
+TREND_SLOPE = -0.1  # compound score per user message
+
+CLARITY_SHORT = 0.4
+CLARITY_GOOD = 0.9
+CLARITY_LONG = 0.7
+
+# Bumped whenever the layout or meaning of the running state changes;
+# states of another version are rebuilt from all messages
+STATE_VERSION = 5
+
+# Bumped whenever the scores computed from the same messages change; part
+# of every analysis fingerprint, so older analyses are recomputed
+ANALYZER_VERSION = 3
+
+# Accuracy drops from 1.0 to 0.7 as the share of fallback answers grows
+ACCURACY_FALLBACK_PENALTY = 0.3
+
+_EPOCH = datetime(1970, 1, 1, tzinfo=timezone.utc)
+_MICROSECOND = timedelta(microseconds=1)
+
+
+def _micros(timestamp):
+    """
+    Exact integer microseconds since the epoch
+    """
+    if timestamp.tzinfo is None:
+        timestamp = timestamp.replace(tzinfo=timezone.utc)
+    return (timestamp - _EPOCH) // _MICROSECOND
+
+
+DEFAULT_LEXICONS = {
+    'empathy': EMPATHY_KEYWORDS,
+    'fallback': FALLBACK_PHRASES,
+    'resolution': RESOLUTION_KEYWORDS,
+}
+
+
+def warm_up():
+    """
+    Load the sentiment lexicon and compile the default keyword matcher now
+    instead of on the first analysis request
+    """
+    get_sentiment_engine()
+    get_matcher(DEFAULT_LEXICONS)
+
+
+def preload():
+    """
+    warm_up, unless ANALYSIS_PRELOAD is off; called by the server and worker
+    entry points (gunicorn post_fork in gunicorn.conf.py, celery
+    worker_process_init), never on import, so management commands load
+    nothing they do not use
+    """
+    if not getattr(settings, 'ANALYSIS_PRELOAD', True):
+        return
+    try:
+        warm_up()
+    except LookupError as e:
+        logger.warning(f"Could not preload the VADER lexicon: {e}")
+
+
+def content_hash(messages, previous=''):
+    """
+    Chained hash of the ordered (sender, timestamp, text) of messages
+    previous: the content_hash of the preceding messages, to continue from
+    Returns: hex digest
+    """
+    digest = bytes.fromhex(previous)
+    for m in messages:
+        h = hashlib.blake2b(digest, digest_size=16)
+        h.update(f'{m.sender}\x00{_micros(m.timestamp)}\x00'.encode('utf-8'))
+        h.update(m.text.encode('utf-8'))
+        digest = h.digest()
+    return digest.hex()
+
+
+def lexicon_key(lexicons):
+    """
+    Short stable hash identifying a set of lexicons
+    """
+    frozen = sorted((name, sorted(phrases)) for name, phrases in lexicons.items())
+    return hashlib.blake2b(repr(frozen).encode('utf-8'), digest_size=8).hexdigest()
+
+
+def _distinct(texts):
+    """
+    Distinct texts in order of first occurrence, and the position of each
+    text among them
+    Texts loaded from MessageText share one string object per hash, so
+    each distinct text is only hashed once
+    Returns: (list of texts, int64 array aligned with texts)
+    """
+    positions = {}
+    index = np.fromiter(
+        (positions.setdefault(text, len(positions)) for text in texts),
+        dtype=np.int64, count=len(texts)
+    )
+    return list(positions), index
+
+
+class _Vocabulary(dict):
+    """
+    Token -> integer id, assigning the next id to unseen tokens
+    """
+    def __missing__(self, token):
+        token_id = self[token] = len(self)
+        return token_id
+
+
+OVERALL_WEIGHTS = {
+    'clarity': 0.20,
+    'relevance': 0.25,
+    'accuracy': 0.20,
+    'completeness': 0.20,
+    'empathy': 0.15,
+}
 
 
 class ConversationAnalyzer:
@@ -7,28 +174,481 @@ class ConversationAnalyzer:
     Analyzes conversations and returns scores for 10+ parameters
     """
     
-    def __init__(self):
-        self.sia = SentimentIntensityAnalyzer()
+    def __init__(self, lexicons=None, metrics=None):
+        """
+        lexicons: optional {'empathy'|'fallback'|'resolution': [phrase, ...]}
+        replacing the default keyword lists, e.g. a tenant's custom lexicon
+        metrics: optional metric names to compute (see analysis.metrics),
+        by default ANALYSIS_METRICS or every registered metric
+        Raises: UnknownMetric
+        """
+        lexicons = {**DEFAULT_LEXICONS, **(lexicons or {})}
+        if metrics is None:
+            metrics = getattr(settings, 'ANALYSIS_METRICS', None)
+        self.sentiment_engine = get_sentiment_engine()
+        self.matcher = get_matcher(lexicons)
+        self.lexicon_key = lexicon_key(lexicons)
+        self.sentiment_cache = get_sentiment_cache()
+        # One IDF table for everything this analyzer scores
+        self.idf = get_idf_table()
+        self.metrics = registry.resolve(metrics)
+        # None when every metric is computed
+        self.metric_names = None
+        if len(self.metrics) < len(registry.names()):
+            self.metric_names = [metric.name for metric in self.metrics]
+        # Plugin metrics and replaced built-ins
+        self.plugins = [metric for metric in self.metrics if metric not in BUILTIN_METRICS]
+    
+    @property
+    def partial(self):
+        """
+        Whether only some metrics are computed
+        """
+        return self.metric_names is not None
+    
+    @property
+    def builtin(self):
+        """
+        Whether exactly the built-in metrics are computed; otherwise
+        analyses have no running state and are not batched, as
+        analyze_batch and analyze_state only compute the built-in metrics
+        """
+        return not self.partial and not self.plugins
     
-    def analyze_conversation(self, conversation):
+    def analyze_conversation(self, conversation, return_state=False):
         """
         Main analysis function
-        Returns a dictionary with all analysis scores
+        Returns a dictionary with all analysis scores, or with
+        return_state=True an (analysis, running state) pair (the state is
+        None unless the analyzer is builtin)
         """
         messages = conversation.messages.all()
+        if return_state:
+            if not self.builtin:
+                return self.run_metrics(messages), None
+            state = self.extend_state(self.new_state(), messages)
+            return self.analyze_state(state), state
+        
+        return self.run_metrics(messages)
+    
+    def run_metrics(self, messages):
+        """
+        Run the selected metrics on messages one by one, timing each
+        Returns: the analysis dictionary, with only the selected metrics' fields
+        """
+        inputs = MetricInputs(self, messages)
+        results = {}
+        for metric in self.metrics:
+            with registry.timed(metric.name):
+                results.update(metric.compute(self, inputs, results))
+        
+        results.update({
+            'metrics': self.metric_names,
+            'fingerprint': self.fingerprint(content_hash(messages)),
+            'analyzer_version': ANALYZER_VERSION,
+        })
+        return results
+    
+    def fingerprint(self, content):
+        """
+        Identifies an analysis of the given content_hash by this analyzer:
+        equal fingerprints mean recomputing would give the same result
+        """
+        key = f'{ANALYZER_VERSION}:{self.lexicon_key}:{self.idf.version}:{content}'
+        if self.partial:
+            key += ':' + ','.join(self.metric_names)
+        if self.plugins:
+            key += ':' + ','.join(metric.identity for metric in self.plugins)
+        return hashlib.blake2b(key.encode('utf-8'), digest_size=16).hexdigest()
+    
+    def analyze_batch(self, conversations, return_state=False):
+        """
+        Analyze many conversations at once
+        Every distinct message text is lowercased, tokenized and scanned
+        for keywords exactly once; the per-conversation metrics are then computed
+        together with NumPy segment operations
+        Returns a list of dictionaries, identical to calling
+        analyze_conversation on each conversation in order (with
+        return_state=True, a list of (analysis, running state) pairs)
+        An analyzer that is not builtin just analyzes the conversations
+        one by one
+        """
+        conversations = list(conversations)
+        n = len(conversations)
+        if not n:
+            return []
+        if not self.builtin:
+            return [self.analyze_conversation(c, return_state) for c in conversations]
+        
+        # Flatten all messages once; every per-message feature below is a
+        # flat list/array aligned with these, grouped by conv_index
+        per_conversation_messages = [list(c.messages.all()) for c in conversations]
+        message_counts = np.fromiter(map(len, per_conversation_messages), dtype=np.int64, count=n)
+        conv_index = np.repeat(np.arange(n), message_counts)
+        flat = list(chain.from_iterable(per_conversation_messages))
+        senders = np.array([m.sender for m in flat], dtype=object)
+        texts = [m.text for m in flat]
+        ai = senders == 'ai'
+        user = senders == 'user'
+        lengths = np.fromiter(map(len, texts), dtype=np.int64, count=len(texts))
+        
+        ai_conv = conv_index[ai]
+        user_conv = conv_index[user]
+        ai_texts = [text for text, is_ai in zip(texts, ai) if is_ai]
+        user_texts = [text for text, is_user in zip(texts, user) if is_user]
+        # Templated replies and canned phrases repeat across a batch, so
+        # per-text results are computed once per distinct text
+        ai_distinct, ai_text_index = _distinct(ai_texts)
+        user_distinct, user_text_index = _distinct(user_texts)
+        
+        def per_conversation(index, weights=None):
+            return np.bincount(index, weights=weights, minlength=n)
+        
+        def hits(name, matches):
+            return np.fromiter((name in found for found in matches), dtype=bool, count=len(matches))
+        
+        ai_count = per_conversation(ai_conv)
+        user_count = per_conversation(user_conv)
+        has_ai = ai_count > 0
+        has_user = user_count > 0
+        safe_ai = np.where(has_ai, ai_count, 1)
+        
+        # Clarity: length histogram per conversation
+        ai_lengths = lengths[ai]
+        with registry.timed('clarity', n):
+            short = per_conversation(ai_conv, ai_lengths < 20)
+            good = per_conversation(ai_conv, (ai_lengths >= 20) & (ai_lengths <= 200))
+            long = per_conversation(ai_conv, ai_lengths > 200)
+            clarity = np.where(
+                has_ai,
+                (CLARITY_SHORT * short + CLARITY_GOOD * good + CLARITY_LONG * long) / safe_ai,
+                0.5
+            )
+        
+        # Completeness: mean AI message length
+        with registry.timed('completeness', n):
+            avg_length = per_conversation(ai_conv, ai_lengths) / safe_ai
+            completeness = np.where(
+                has_ai,
+                np.select([avg_length > 100, avg_length > 50, avg_length > 20], [0.9, 0.7, 0.5], 0.3),
+                0.0
+            )
+        
+        # Empathy and fallbacks: one lexicon scan per distinct AI message
+        with registry.timed('empathy', n):
+            distinct_hits = self.matcher.match_many([text.lower() for text in ai_distinct])
+            empathy_hits = hits('empathy', distinct_hits)[ai_text_index]
+            empathy = np.where(
+                has_ai,
+                np.minimum(per_conversation(ai_conv, empathy_hits) / safe_ai, 1.0),
+                0.0
+            )
+        with registry.timed('accuracy', n):
+            fallback_count = per_conversation(ai_conv, hits('fallback', distinct_hits)[ai_text_index])
+            accuracy = np.where(
+                has_ai,
+                1.0 - ACCURACY_FALLBACK_PENALTY * fallback_count / safe_ai,
+                0.0
+            )
+        
+        # Resolution: keyword hit in the last two messages
+        with registry.timed('resolution', n):
+            resolved = np.array(
+                [self.check_resolution(messages) for messages in per_conversation_messages],
+                dtype=bool
+            )
+        
+        # Sentiment: exact integer sums of compound scores
+        with registry.timed('sentiment', n):
+            distinct_units = self.sentiment_units(user_distinct)
+            sentiment_units = [distinct_units[i] for i in user_text_index.tolist()]
+            sentiment_total = per_conversation(user_conv, np.array(sentiment_units, dtype=np.float64))
+            # user_conv is sorted, so each conversation's scores are a slice
+            user_bounds = np.concatenate(([0], np.cumsum(user_count))).tolist()
+            user_units = [sentiment_units[user_bounds[i]:user_bounds[i + 1]] for i in range(n)]
+            trajectories = [trajectory.pack(units) for units in user_units]
+        
+        # Relevance: TF-IDF cosine of the user and AI sides, from the
+        # counts of unique (conversation, token id) keys per sender.
+        # Stopwords are interned first so they can be dropped by id
+        vocabulary = _Vocabulary((word, i) for i, word in enumerate(STOPWORDS))
+        
+        def term_keys(distinct, text_index, index):
+            # Tokens get ids in order of first occurrence either way, as a
+            # repeated text brings no new tokens
+            distinct_ids = [
+                np.fromiter(map(vocabulary.__getitem__, tokens), dtype=np.int64, count=len(tokens))
+                for tokens in map(find_tokens, distinct)
+            ]
+            if not len(text_index):
+                return index, np.zeros(0, dtype=np.int64)
+            lengths = np.fromiter(map(len, distinct_ids), dtype=np.int64, count=len(distinct_ids))
+            ids = np.concatenate([distinct_ids[i] for i in text_index.tolist()])
+            owners = np.repeat(index, lengths[text_index])
+            keep = ids >= len(STOPWORDS)
+            return owners[keep], ids[keep]
+        
+        with registry.timed('relevance', n):
+            user_owner, user_ids = term_keys(user_distinct, user_text_index, user_conv)
+            ai_owner, ai_ids = term_keys(ai_distinct, ai_text_index, ai_conv)
+            vocabulary_size = len(vocabulary)
+            user_keys, user_terms = np.unique(user_owner * vocabulary_size + user_ids, return_counts=True)
+            ai_keys, ai_terms = np.unique(ai_owner * vocabulary_size + ai_ids, return_counts=True)
+            similarity = np.array(self.idf.score_segments(
+                n, vocabulary_size, list(vocabulary), user_keys, user_terms, ai_keys, ai_terms
+            ))
+            has_user_terms = per_conversation(user_keys // vocabulary_size) > 0
+            relevance = np.where(
+                has_ai & has_user & has_user_terms,
+                np.maximum(np.minimum(similarity, 1.0), 0.3),
+                0.5
+            )
+        
+        # Response times and content hashes: one ordered pass per conversation
+        with registry.timed('response_time', n):
+            latencies = [self.calculate_response_time(messages) for messages in per_conversation_messages]
+        hashes = [content_hash(messages) for messages in per_conversation_messages]
+        
+        if return_state:
+            states = self._batch_states(
+                per_conversation_messages, vocabulary, vocabulary_size,
+                user_keys, user_terms, ai_keys, ai_terms,
+                ai_count, user_count, sentiment_total, trajectories, short, good, long,
+                per_conversation(ai_conv, ai_lengths),
+                per_conversation(ai_conv, empathy_hits), fallback_count,
+                latencies, hashes,
+            )
+        
+        results = []
+        for i in range(n):
+            if has_user[i]:
+                sentiment_result = self._sentiment_label(int(sentiment_total[i]), int(user_count[i]))
+            else:
+                sentiment_result = {'label': 'neutral', 'score': 0.0}
+            resolution = bool(resolved[i])
+            recent = user_units[i][-TREND_WINDOW:]
+            
+            overall_score = self.calculate_overall_score({
+                'clarity': float(clarity[i]),
+                'relevance': float(relevance[i]),
+                'accuracy': float(accuracy[i]),
+                'completeness': float(completeness[i]),
+                'empathy': float(empathy[i]),
+            })
+            
+            results.append({
+                'clarity_score': round(float(clarity[i]), 2),
+                'relevance_score': round(float(relevance[i]), 2),
+                'accuracy_score': round(float(accuracy[i]), 2),
+                'completeness_score': round(float(completeness[i]), 2),
+                'sentiment': sentiment_result['label'],
+                **self.trajectory_fields(trajectories[i], recent),
+                'empathy_score': round(float(empathy[i]), 2),
+                **self.response_time_stats(latencies[i]),
+                'resolution': resolution,
+                'escalation_needed': self.check_escalation(sentiment_result, resolution, recent),
+                'fallback_count': int(fallback_count[i]),
+                'overall_score': round(overall_score, 2),
+                'metrics': None,
+                'fingerprint': self.fingerprint(hashes[i]),
+                'analyzer_version': ANALYZER_VERSION,
+            })
+        
+        if return_state:
+            return list(zip(results, states))
+        return results
+    
+    def _batch_states(self, per_conversation_messages, vocabulary, vocabulary_size,
+                      user_keys, user_terms, ai_keys, ai_terms,
+                      ai_count, user_count, sentiment_total, trajectories,
+                      short, good, long, ai_length_total, empathy_hits, fallback_count,
+                      latencies, hashes):
+        """
+        Running states of a batch, from the per-conversation arrays of analyze_batch
+        """
+        n = len(per_conversation_messages)
+        tokens = np.array(list(vocabulary), dtype=object)
+        bounds = np.arange(n + 1) * vocabulary_size
+        
+        def terms(keys, counts):
+            starts = np.searchsorted(keys, bounds)
+            return [
+                dict(zip(
+                    tokens[keys[starts[i]:starts[i + 1]] % vocabulary_size].tolist(),
+                    counts[starts[i]:starts[i + 1]].tolist()
+                ))
+                for i in range(n)
+            ]
+        
+        user_terms = terms(user_keys, user_terms)
+        ai_terms = terms(ai_keys, ai_terms)
+        
+        states = []
+        for i, messages in enumerate(per_conversation_messages):
+            state = self.new_state()
+            state.update({
+                'ai_count': int(ai_count[i]),
+                'user_count': int(user_count[i]),
+                'sentiment_total': int(sentiment_total[i]),
+                'sentiment_trajectory': trajectory.to_text(trajectories[i]),
+                'clarity': [int(short[i]), int(good[i]), int(long[i])],
+                'ai_length_total': int(ai_length_total[i]),
+                'empathy_hits': int(empathy_hits[i]),
+                'fallback_hits': int(fallback_count[i]),
+                'user_terms': user_terms[i],
+                'ai_terms': ai_terms[i],
+                'latency': latencies[i],
+                'content_hash': hashes[i],
+            })
+            self._advance_position(state, messages)
+            states.append(state)
+        return states
+    
+    def new_state(self):
+        """
+        Running state of a conversation with no messages
+
+        The state holds everything the scores are computed from (counts,
+        integer sums, the packed sentiment trajectory, the relevance term
+        counts, the last two messages and the response time pass, see
+        calculate_response_time),
+        so new messages can be folded in with extend_state without
+        reading the earlier ones again. It is a plain JSON-serializable dict
+        """
+        return {
+            'version': STATE_VERSION,
+            'lexicons': self.lexicon_key,
+            'message_count': 0,
+            'last_message_id': None,
+            'last_timestamp': None,
+            'tail': [],
+            'ai_count': 0,
+            'user_count': 0,
+            'sentiment_total': 0,
+            'sentiment_trajectory': '',
+            'clarity': [0, 0, 0],
+            'ai_length_total': 0,
+            'empathy_hits': 0,
+            'fallback_hits': 0,
+            'user_terms': {},
+            'ai_terms': {},
+            'latency': self.calculate_response_time([]),
+            'content_hash': content_hash([]),
+        }
+    
+    def accepts_state(self, state):
+        """
+        Whether state was built by a compatible analyzer and can be extended
+        """
+        return (
+            self.builtin
+            and isinstance(state, dict)
+            and state.get('version') == STATE_VERSION
+            and state.get('lexicons') == self.lexicon_key
+        )
+    
+    def extend_state(self, state, messages):
+        """
+        Fold messages into a running state
+        messages must come after every message already in the state, in
+        conversation order. Costs O(len(messages)) plus loading the
+        relevance term counts, however long the conversation already is
+        Returns: the new state (state itself is not modified)
+        """
+        messages = list(messages)
+        state = {**state, 'clarity': list(state['clarity'])}
         ai_messages = [m.text for m in messages if m.sender == 'ai']
         user_messages = [m.text for m in messages if m.sender == 'user']
         
-        sentiment_result = self.analyze_sentiment(user_messages)
-        clarity = self.analyze_clarity(ai_messages)
-        relevance = self.analyze_relevance(ai_messages, user_messages)
-        empathy = self.analyze_empathy(ai_messages)
-        completeness = self.analyze_completeness(ai_messages)
-        accuracy = self.analyze_accuracy(ai_messages)
-        fallback_count = self.count_fallbacks(ai_messages)
-        resolution = self.check_resolution(messages)
-        escalation_needed = self.check_escalation(sentiment_result, resolution)
-        response_time = self.calculate_response_time()
+        state['ai_count'] += len(ai_messages)
+        state['user_count'] += len(user_messages)
+        
+        with registry.timed('sentiment'):
+            units = self.sentiment_units(user_messages)
+            state['sentiment_total'] += sum(units)
+            if units:
+                state['sentiment_trajectory'] = trajectory.to_text(
+                    trajectory.from_text(state['sentiment_trajectory']) + trajectory.pack(units)
+                )
+        
+        with registry.timed('clarity'):
+            clarity = state['clarity']
+            for msg in ai_messages:
+                length = len(msg)
+                if 20 <= length <= 200:
+                    clarity[1] += 1
+                elif length < 20:
+                    clarity[0] += 1
+                else:
+                    clarity[2] += 1
+        
+        with registry.timed('completeness'):
+            state['ai_length_total'] += sum(map(len, ai_messages))
+        
+        with registry.timed('empathy'):
+            ai_hits = self.match_lexicons(ai_messages)
+            state['empathy_hits'] += sum(1 for found in ai_hits if 'empathy' in found)
+        with registry.timed('accuracy'):
+            state['fallback_hits'] += sum(1 for found in ai_hits if 'fallback' in found)
+        
+        with registry.timed('relevance'):
+            state['user_terms'] = count_terms(user_messages, state['user_terms'])
+            state['ai_terms'] = count_terms(ai_messages, state['ai_terms'])
+        
+        with registry.timed('response_time'):
+            state['latency'] = self.calculate_response_time(messages, state['latency'])
+        state['content_hash'] = content_hash(messages, state['content_hash'])
+        
+        self._advance_position(state, messages)
+        return state
+    
+    def _advance_position(self, state, messages):
+        if not messages:
+            return
+        last = messages[-1]
+        state['message_count'] += len(messages)
+        state['last_message_id'] = last.id
+        state['last_timestamp'] = last.timestamp.isoformat() if last.timestamp else None
+        state['tail'] = (state['tail'] + [m.text.lower() for m in messages[-2:]])[-2:]
+    
+    def analyze_state(self, state):
+        """
+        Scores of a running state
+        Returns the same dictionary as analyze_conversation on all the
+        messages folded into the state
+        """
+        ai_count = state['ai_count']
+        user_count = state['user_count']
+        
+        if user_count:
+            sentiment_result = self._sentiment_label(state['sentiment_total'], user_count)
+        else:
+            sentiment_result = {'label': 'neutral', 'score': 0.0}
+        packed = trajectory.from_text(state['sentiment_trajectory'])
+        recent = trajectory.unpack(packed, last=TREND_WINDOW)
+        
+        if ai_count:
+            clarity = self._clarity(*state['clarity'], ai_count)
+            empathy = min(state['empathy_hits'] / ai_count, 1.0)
+            completeness = self._completeness(state['ai_length_total'] / ai_count)
+        else:
+            clarity = 0.5
+            empathy = 0.0
+            completeness = 0.0
+        
+        if ai_count and user_count:
+            relevance = self._relevance(state['user_terms'], state['ai_terms'])
+        else:
+            relevance = 0.5
+        
+        accuracy = self._accuracy(state['fallback_hits'], ai_count)
+        with registry.timed('resolution'):
+            resolution = (
+                state['message_count'] >= 2
+                and 'resolution' in self.matcher.match(' '.join(state['tail']))
+            )
+        escalation_needed = self.check_escalation(sentiment_result, resolution, recent)
+        response_times = self.response_time_stats(state['latency'])
         
         overall_score = self.calculate_overall_score({
             'clarity': clarity,
@@ -44,12 +664,16 @@ class ConversationAnalyzer:
             'accuracy_score': round(accuracy, 2),
             'completeness_score': round(completeness, 2),
             'sentiment': sentiment_result['label'],
+            **self.trajectory_fields(packed, recent),
             'empathy_score': round(empathy, 2),
-            'response_time_avg': round(response_time, 2),
+            **response_times,
             'resolution': resolution,
             'escalation_needed': escalation_needed,
-            'fallback_count': fallback_count,
+            'fallback_count': state['fallback_hits'],
             'overall_score': round(overall_score, 2),
+            'metrics': None,
+            'fingerprint': self.fingerprint(state['content_hash']),
+            'analyzer_version': ANALYZER_VERSION,
         }
     
     def analyze_sentiment(self, user_messages):
@@ -57,19 +681,63 @@ class ConversationAnalyzer:
         Analyze user sentiment using VADER
         Returns: {'label': 'positive/neutral/negative', 'score': float}
         """
-        if not user_messages:
+        return self.sentiment_of(self.sentiment_units(user_messages))
+    
+    def sentiment_units(self, texts):
+        """
+        Compound score of each text in SENTIMENT_SCALE units
+        Returns: list of ints
+        """
+        return [round(compound * SENTIMENT_SCALE) for compound in self.compound_scores(texts)]
+    
+    def sentiment_of(self, units):
+        """
+        Sentiment of the user messages with the given sentiment_units
+        Returns: {'label': 'positive/neutral/negative', 'score': float}
+        """
+        if not units:
             return {'label': 'neutral', 'score': 0.0}
+        return self._sentiment_label(sum(units), len(units))
+    
+    def trajectory_fields(self, packed, recent):
+        """
+        Sentiment trajectory fields of an analysis
+        packed: trajectory.pack() of every user message's score
+        recent: the last TREND_WINDOW of those scores
+        """
+        slope = trajectory.slope(recent, SENTIMENT_SCALE)
+        return {
+            'sentiment_trajectory': packed or None,
+            'sentiment_slope': round(slope, 4) if slope is not None else None,
+        }
+    
+    def is_worsening(self, recent):
+        """
+        Whether the last user messages' scores decline steadily and end negative
+        recent: the last TREND_WINDOW sentiment_units of the user messages
+        """
+        if len(recent) < TREND_MIN_MESSAGES or recent[-1] >= -SENTIMENT_THRESHOLD:
+            return False
+        return trajectory.slope(recent, SENTIMENT_SCALE) <= TREND_SLOPE
+    
+    def compound_scores(self, texts):
+        """
+        VADER compound score of each text, through the sentiment cache
+        Returns: list of floats
+        """
+        if not self.sentiment_cache.enabled:
+            return self.sentiment_engine.score_many(texts)
+        return self.sentiment_cache.get_many(texts, self.sentiment_engine.score_many)
+    
+    def _sentiment_label(self, total, count):
+        """
+        Turn a sum of compound scores (in SENTIMENT_SCALE units) into a label
+        """
+        avg_score = total / (SENTIMENT_SCALE * count)
         
-        scores = []
-        for msg in user_messages:
-            sentiment = self.sia.polarity_scores(msg)
-            scores.append(sentiment['compound'])
-        
-        avg_score = sum(scores) / len(scores)
-        
-        if avg_score > 0.05:
+        if total > SENTIMENT_THRESHOLD * count:
             return {'label': 'positive', 'score': avg_score}
-        elif avg_score < -0.05:
+        elif total < -SENTIMENT_THRESHOLD * count:
             return {'label': 'negative', 'score': avg_score}
         else:
             return {'label': 'neutral', 'score': avg_score}
@@ -82,61 +750,57 @@ class ConversationAnalyzer:
         if not ai_messages:
             return 0.5
         
-        clarity_scores = []
+        short = good = long = 0
         for msg in ai_messages:
             length = len(msg)
            
             if 20 <= length <= 200:
-                clarity_scores.append(0.9)
+                good += 1
             elif length < 20:
-                clarity_scores.append(0.4) 
+                short += 1
             else:
-                clarity_scores.append(0.7) 
+                long += 1
         
-        return sum(clarity_scores) / len(clarity_scores)
+        return self._clarity(short, good, long, len(ai_messages))
+    
+    def _clarity(self, short, good, long, count):
+        return (CLARITY_SHORT * short + CLARITY_GOOD * good + CLARITY_LONG * long) / count
     
     def analyze_relevance(self, ai_messages, user_messages):
         """
-        Check if AI stayed on topic by analyzing keyword overlap
-        Range: 0.0 to 1.0
+        Check if AI stayed on topic: cosine similarity of the TF-IDF
+        vectors of the user and AI messages (see relevance.py)
+        Range: 0.3 to 1.0, or 0.5 when either side has nothing to compare
         """
         if not ai_messages or not user_messages:
             return 0.5
         
-        user_words = set(' '.join(user_messages).lower().split())
-        ai_words = set(' '.join(ai_messages).lower().split())
-        
-        stopwords = {'the', 'a', 'an', 'is', 'are', 'was', 'were', 'i', 'you', 'can', 'will'}
-        user_words -= stopwords
-        ai_words -= stopwords
-        
-        if not user_words:
+        return self._relevance(count_terms(user_messages), count_terms(ai_messages))
+    
+    def _relevance(self, user_terms, ai_terms):
+        if not user_terms:
             return 0.5
-        
-        overlap = len(user_words.intersection(ai_words))
-        relevance = min(overlap / len(user_words), 1.0)
-        
-        return max(relevance, 0.3)  
+        return max(min(self.idf.score(user_terms, ai_terms), 1.0), 0.3)
     
-    def analyze_empathy(self, ai_messages):
+    def match_lexicons(self, texts):
+        """
+        Scan each text once for all lexicons
+        Returns: list of frozensets of lexicon names found, one per text
+        """
+        return self.matcher.match_many([text.lower() for text in texts])
+    
+    def analyze_empathy(self, ai_messages, hits=None):
         """
         Detect empathy keywords in AI responses
+        hits: optional precomputed match_lexicons(ai_messages)
         Range: 0.0 to 1.0
         """
-        empathy_keywords = [
-            'sorry', 'understand', 'help', 'appreciate', 
-            'apologize', 'thank', 'care', 'concern',
-            'happy', 'glad', 'pleasure', 'welcome'
-        ]
-        
         if not ai_messages:
             return 0.0
         
-        empathy_count = 0
-        for msg in ai_messages:
-            msg_lower = msg.lower()
-            if any(keyword in msg_lower for keyword in empathy_keywords):
-                empathy_count += 1
+        if hits is None:
+            hits = self.match_lexicons(ai_messages)
+        empathy_count = sum(1 for found in hits if 'empathy' in found)
         
         return min(empathy_count / len(ai_messages), 1.0)
     
@@ -151,6 +815,9 @@ class ConversationAnalyzer:
         
         avg_length = sum(len(msg) for msg in ai_messages) / len(ai_messages)
         
+        return self._completeness(avg_length)
+    
+    def _completeness(self, avg_length):
         if avg_length > 100:
             return 0.9
         elif avg_length > 50:
@@ -160,35 +827,33 @@ class ConversationAnalyzer:
         else:
             return 0.3
     
-    def analyze_accuracy(self, ai_messages):
+    def analyze_accuracy(self, ai_messages, hits=None):
         """
-        Mock accuracy scoring (in real-world, would use fact-checking)
-        Range: 0.0 to 1.0
+        Estimate answer accuracy from how often the AI fell back to
+        "I don't know"-style answers (a fact-checking model would replace this)
+        hits: optional precomputed match_lexicons(ai_messages)
+        Range: 0.7 to 1.0, or 0.0 without AI messages
         """
-        return random.uniform(0.7, 1.0)
+        if not ai_messages:
+            return 0.0
+        
+        return self._accuracy(self.count_fallbacks(ai_messages, hits), len(ai_messages))
+    
+    def _accuracy(self, fallbacks, count):
+        if not count:
+            return 0.0
+        return 1.0 - ACCURACY_FALLBACK_PENALTY * fallbacks / count
     
-    def count_fallbacks(self, ai_messages):
+    def count_fallbacks(self, ai_messages, hits=None):
         """
         Count fallback responses (AI admitting it doesn't know)
+        hits: optional precomputed match_lexicons(ai_messages)
         Returns: integer count
         """
-        fallback_phrases = [
-            "i don't know", 
-            "i'm not sure", 
-            "i cannot",
-            "sorry, i can't", 
-            "don't understand",
-            "unable to help",
-            "not able to"
-        ]
-        
-        count = 0
-        for msg in ai_messages:
-            msg_lower = msg.lower()
-            if any(phrase in msg_lower for phrase in fallback_phrases):
-                count += 1
+        if hits is None:
+            hits = self.match_lexicons(ai_messages)
         
-        return count
+        return sum(1 for found in hits if 'fallback' in found)
     
     def check_resolution(self, messages):
         """
@@ -205,44 +870,95 @@ class ConversationAnalyzer:
             return False
         
         last_messages = [m.text.lower() for m in messages_list[-2:]]
-        resolution_keywords = [
-            'thank', 'thanks', 'resolved', 'fixed', 
-            'solved', 'great', 'perfect', 'awesome',
-            'helped', 'appreciate', 'done'
-        ]
         
-        return any(keyword in ' '.join(last_messages) for keyword in resolution_keywords)
+        return 'resolution' in self.matcher.match(' '.join(last_messages))
     
-    def check_escalation(self, sentiment_result, resolution):
+    def check_escalation(self, sentiment_result, resolution, recent=()):
         """
         Determine if escalation to human is needed
-        Criteria: negative sentiment AND not resolved
+        Criteria: not resolved AND (negative sentiment OR worsening trend,
+        see is_worsening)
+        recent: the last TREND_WINDOW sentiment_units of the user messages
         Returns: boolean
         """
-        if sentiment_result['label'] == 'negative' and not resolution:
-            return True
-        return False
+        if resolution:
+            return False
+        return sentiment_result['label'] == 'negative' or self.is_worsening(list(recent))
+    
+    def calculate_response_time(self, messages, latency=None):
+        """
+        Measure user -> AI response times in one ordered pass
+        A response time runs from the first user message of a turn to the
+        first AI message after it; negative gaps (clock skew) count as 0
+        latency: running totals to continue from, as returned by an
+        earlier call on the preceding messages
+        Returns: running totals {'pending_us', 'count', 'total_us',
+        'max_us', 'sketch'}, in exact integer microseconds
+        """
+        if latency is None:
+            latency = {'pending_us': None, 'count': 0, 'total_us': 0, 'max_us': 0, 'sketch': None}
+        pending = latency['pending_us']
+        count = latency['count']
+        total = latency['total_us']
+        longest = latency['max_us']
+        sketch = QuantileSketch.from_dict(latency['sketch'])
+        
+        for m in messages:
+            if m.sender == 'user':
+                if pending is None:
+                    pending = _micros(m.timestamp)
+            elif m.sender == 'ai' and pending is not None:
+                elapsed = max(_micros(m.timestamp) - pending, 0)
+                count += 1
+                total += elapsed
+                longest = max(longest, elapsed)
+                sketch.add(elapsed / 1e6)
+                pending = None
+        
+        return {
+            'pending_us': pending,
+            'count': count,
+            'total_us': total,
+            'max_us': longest,
+            'sketch': sketch.to_dict() if sketch else None,
+        }
     
-    def calculate_response_time(self):
+    def response_time_stats(self, latency):
         """
-        Mock response time calculation
-        In production, would use actual timestamp differences
-        Returns: float (seconds)
+        Response time fields of an analysis, from calculate_response_time
+        Mean and max are exact; p50 and p95 come from the quantile sketch
+        (within QuantileSketch.RELATIVE_ACCURACY). All None without any
+        user -> AI exchange
         """
-        return random.uniform(5.0, 30.0)
+        count = latency['count']
+        if not count:
+            return {
+                'response_time_avg': None,
+                'response_time_p50': None,
+                'response_time_p95': None,
+                'response_time_max': None,
+                'response_count': 0,
+                'latency_sketch': None,
+            }
+        
+        sketch = QuantileSketch.from_dict(latency['sketch'])
+        longest = latency['max_us'] / 1e6
+        return {
+            'response_time_avg': round(latency['total_us'] / count / 1e6, 2),
+            'response_time_p50': round(min(sketch.quantile(0.5), longest), 2),
+            'response_time_p95': round(min(sketch.quantile(0.95), longest), 2),
+            'response_time_max': round(longest, 2),
+            'response_count': count,
+            'latency_sketch': latency['sketch'],
+        }
     
     def calculate_overall_score(self, scores):
         """
         Calculate weighted average of all quality metrics
         Range: 0.0 to 1.0
         """
-        weights = {
-            'clarity': 0.20,
-            'relevance': 0.25,
-            'accuracy': 0.20,
-            'completeness': 0.20,
-            'empathy': 0.15,
-        }
-        
-        total = sum(scores[key] * weights[key] for key in scores)
+        # Summed in a fixed order, so every path gets the same float
+        total = 0.0
+        for key, weight in OVERALL_WEIGHTS.items():
+            total += scores[key] * weight
         return total
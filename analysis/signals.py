@@ -0,0 +1,84 @@
+from django.db.models import QuerySet
+from django.db.models.signals import post_delete, post_save, pre_delete, pre_save
+from django.dispatch import receiver
+
+from .models import Conversation, ConversationAnalysis, Message
+from .rollups import analysis_values, record_analysis_deleted, record_analysis_saved, record_bot_changed
+
+
+@receiver(pre_save, sender=ConversationAnalysis)
+def remember_previous_rollup_values(sender, instance, raw=False, **kwargs):
+    """
+    Find what the row contributed before this save: from the snapshot
+    taken when it was loaded, or from the database as a fallback
+    """
+    if raw or instance._state.adding:
+        instance._rollup_previous = None
+        return
+    
+    previous = getattr(instance, '_rollup_snapshot', None)
+    if previous is None:
+        previous = (
+            ConversationAnalysis.objects
+            .filter(pk=instance.pk)
+            .values(*ConversationAnalysis.ROLLUP_FIELDS)
+            .first()
+        )
+    instance._rollup_previous = previous
+
+
+@receiver(post_save, sender=ConversationAnalysis)
+def update_rollups_on_save(sender, instance, raw=False, **kwargs):
+    if raw:
+        return
+    record_analysis_saved(instance, getattr(instance, '_rollup_previous', None))
+    instance._rollup_snapshot = analysis_values(instance)
+
+
+@receiver(pre_delete, sender=ConversationAnalysis)
+def remember_bot_before_delete(sender, instance, **kwargs):
+    # Sent before anything is deleted, also when the conversation itself
+    # is being deleted and the analysis goes with it
+    instance._rollup_bot = instance.conversation.bot
+
+
+@receiver(post_delete, sender=ConversationAnalysis)
+def update_rollups_on_delete(sender, instance, **kwargs):
+    record_analysis_deleted(instance, instance._rollup_bot)
+
+
+@receiver(post_save, sender=Conversation)
+def move_rollups_on_bot_change(sender, instance, created=False, raw=False, **kwargs):
+    # Only conversations loaded from the database know their stored bot;
+    # the nightly task saves them without touching it, at no extra query
+    previous_bot = getattr(instance, '_loaded_bot', None)
+    if raw or created or previous_bot is None:
+        return
+    if previous_bot != instance.bot:
+        record_bot_changed(instance, previous_bot)
+    instance._loaded_bot = instance.bot
+
+
+def _invalidate_analysis(conversation_id):
+    """
+    The running state assumes messages are only ever appended; after an
+    edit or delete it is dropped and the conversation queued again, so
+    the next analysis reads all messages (and its fingerprint changes)
+    """
+    ConversationAnalysis.objects.filter(conversation_id=conversation_id).update(running_state=None)
+    Conversation.objects.filter(id=conversation_id).update(analyzed=False)
+
+
+@receiver(post_save, sender=Message)
+def invalidate_analysis_on_message_edit(sender, instance, created=False, raw=False, **kwargs):
+    if raw or created:
+        return
+    _invalidate_analysis(instance.conversation_id)
+
+
+@receiver(post_delete, sender=Message)
+def invalidate_analysis_on_message_delete(sender, instance, origin=None, **kwargs):
+    # Nothing to do when the whole conversation is being deleted
+    if isinstance(origin, Conversation) or (isinstance(origin, QuerySet) and origin.model is Conversation):
+        return
+    _invalidate_analysis(instance.conversation_id)
@@ -0,0 +1,91 @@
+import math
+
+
+class QuantileSketch:
+    """
+    Mergeable quantile sketch with bounded relative error
+
+    Values are counted in logarithmic buckets (as in DDSketch): bucket i
+    holds the values in (gamma^(i-1), gamma^i], so any quantile is returned
+    within RELATIVE_ACCURACY of the true value, whatever the distribution.
+    Sketches of different conversations, days or bots are combined by
+    adding their bucket counts (and taken apart again by subtracting
+    them), so fleet-wide percentiles never need the raw samples.
+
+    Values below MIN_VALUE (including 0) share a single zero bucket.
+    """
+
+    RELATIVE_ACCURACY = 0.01
+    MIN_VALUE = 1e-3
+
+    GAMMA = (1 + RELATIVE_ACCURACY) / (1 - RELATIVE_ACCURACY)
+    LOG_GAMMA = math.log(GAMMA)
+
+    def __init__(self, buckets=None, zero_count=0):
+        self.buckets = dict(buckets or {})
+        self.zero_count = zero_count
+
+    @property
+    def count(self):
+        return self.zero_count + sum(self.buckets.values())
+
+    def __bool__(self):
+        return bool(self.zero_count or self.buckets)
+
+    def add(self, value, count=1):
+        if value < self.MIN_VALUE:
+            self.zero_count += count
+            return
+        index = math.ceil(math.log(value) / self.LOG_GAMMA)
+        self.buckets[index] = self.buckets.get(index, 0) + count
+
+    def merge(self, other, sign=1):
+        """
+        Add other's counts to this sketch (sign=-1 removes them)
+        Returns: self
+        """
+        self.zero_count += sign * other.zero_count
+        for index, count in other.buckets.items():
+            total = self.buckets.get(index, 0) + sign * count
+            if total:
+                self.buckets[index] = total
+            else:
+                self.buckets.pop(index, None)
+        return self
+
+    def quantile(self, q):
+        """
+        Value at quantile q (0.0 to 1.0) by nearest rank, or None for an
+        empty sketch
+        """
+        count = self.count
+        if count <= 0:
+            return None
+        rank = max(math.ceil(q * count), 1)
+
+        seen = self.zero_count
+        if seen >= rank:
+            return 0.0
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            if seen >= rank:
+                return 2 * self.GAMMA ** index / (self.GAMMA + 1)
+        return 2 * self.GAMMA ** max(self.buckets) / (self.GAMMA + 1)
+
+    def to_dict(self):
+        """
+        Compact JSON-serializable form: {'zero': n, 'buckets': {'index': n}}
+        """
+        return {
+            'zero': self.zero_count,
+            'buckets': {str(index): count for index, count in self.buckets.items()},
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        if not data:
+            return cls()
+        return cls(
+            buckets={int(index): count for index, count in data['buckets'].items()},
+            zero_count=data['zero'],
+        )
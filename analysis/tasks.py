@@ -1,59 +1,260 @@
-from celery import shared_task
-from .models import Conversation, ConversationAnalysis
+import uuid
+from concurrent.futures import ProcessPoolExecutor
+from datetime import timedelta
+
+from celery import chord, shared_task
+from django.conf import settings
+from django.db import connections
+from django.db.models import Q
+from django.utils import timezone
+from .incremental import get_conversation, mark_analyzed, reanalyze, split_by_state
+from .models import AnalysisJob, Conversation
+from .relevance import refresh_idf_table
 from .services import ConversationAnalyzer
+from .writer import AnalysisWriter
 
 
-@shared_task
-def analyze_all_new_conversations():
+def _iter_chunks(conversations, size):
     """
-    Celery task: Analyze all unanalyzed conversations
-    This runs daily at midnight via Celery Beat
+    Yield lists of conversations with their analysis (and running state)
+    joined in
+    """
+    ids = list(conversations.values_list('id', flat=True))
+    for start in range(0, len(ids), size):
+        yield list(
+            Conversation.objects
+            .filter(id__in=ids[start:start + size])
+            .select_related('analysis')
+        )
+
+
+def _analyze_conversations(analyzer, conversations):
+    """
+    Analyze and save each conversation that has messages
+    Conversations whose analysis fingerprint still matches are only marked
+    analyzed; those with a usable running state only have their new
+    messages analyzed; the others are analyzed in chunks with
+    ConversationAnalyzer.analyze_batch, and if a chunk fails, its
+    conversations are retried one by one. Results are saved in batches by
+    an AnalysisWriter
+    Returns: number of conversations analyzed (or found up to date)
     """
-    conversations = Conversation.objects.filter(analyzed=False)
-    analyzer = ConversationAnalyzer()
+    size = getattr(settings, 'ANALYSIS_BATCH_SIZE', 500)
     
     count = 0
-    for conversation in conversations:
-        if not conversation.messages.exists():
-            continue
-        
-        try:
-            analysis_data = analyzer.analyze_conversation(conversation)
+    with AnalysisWriter() as writer:
+        for chunk in _iter_chunks(conversations, size):
+            incremental, chunk, unchanged = split_by_state(analyzer, chunk)
             
-            ConversationAnalysis.objects.update_or_create(
-                conversation=conversation,
-                defaults=analysis_data
-            )
+            mark_analyzed(unchanged)
+            count += len(unchanged)
             
-            conversation.analyzed = True
-            conversation.save()
+            for conversation, state, messages in incremental:
+                try:
+                    state = analyzer.extend_state(state, messages)
+                    writer.add(conversation, analyzer.analyze_state(state), state)
+                except Exception as e:
+                    print(f"Error analyzing conversation {conversation.id}: {str(e)}")
             
-            count += 1
-        except Exception as e:
-            print(f"Error analyzing conversation {conversation.id}: {str(e)}")
+            chunk = [conversation for conversation in chunk if conversation.messages.all()]
+            
+            try:
+                results = analyzer.analyze_batch(chunk, return_state=True)
+            except Exception as e:
+                print(f"Error analyzing batch, falling back to single analysis: {str(e)}")
+                results = None
+            
+            for index, conversation in enumerate(chunk):
+                try:
+                    if results is None:
+                        analysis_data, state = analyzer.analyze_conversation(conversation, return_state=True)
+                    else:
+                        analysis_data, state = results[index]
+                    
+                    writer.add(conversation, analysis_data, state)
+                except Exception as e:
+                    print(f"Error analyzing conversation {conversation.id}: {str(e)}")
     
-    return f"Successfully analyzed {count} conversations"
+    return count + writer.written
+
+
+def _id_ranges(queryset, size):
+    """
+    Split the ids of a queryset into (first_id, last_id) ranges of up to size ids
+    """
+    ids = list(queryset.order_by('id').values_list('id', flat=True))
+    return [
+        (ids[start], ids[min(start + size, len(ids)) - 1])
+        for start in range(0, len(ids), size)
+    ]
+
+
+def _use_local_pool():
+    """
+    Without a broker (or with eager tasks) chunks run in a local process pool
+    """
+    return not getattr(settings, 'CELERY_BROKER_URL', None) or getattr(settings, 'CELERY_TASK_ALWAYS_EAGER', False)
+
+
+def _analyze_range_in_process(first_id, last_id):
+    """
+    ProcessPoolExecutor entry point for one chunk
+    """
+    import django
+    django.setup()
+    return analyze_conversation_range(first_id, last_id)
 
 
 @shared_task
-def analyze_single_conversation(conversation_id):
+def analyze_all_new_conversations():
     """
-    Celery task: Analyze a single conversation asynchronously
+    Celery task: Analyze all unanalyzed conversations
+    This runs daily at midnight via Celery Beat
+    
+    Unanalyzed ids are split into key ranges of ANALYSIS_CHUNK_SIZE; each
+    range is analyzed by its own analyze_conversation_range task (a Celery
+    chord, whose callback totals the counts) or, without a broker, in a
+    local process pool
     """
+    ranges = _id_ranges(
+        Conversation.objects.filter(analyzed=False),
+        getattr(settings, 'ANALYSIS_CHUNK_SIZE', 1000)
+    )
+    if not ranges:
+        return "Successfully analyzed 0 conversations"
+    
+    if _use_local_pool():
+        # Children must open their own database connections
+        connections.close_all()
+        workers = getattr(settings, 'ANALYSIS_LOCAL_WORKERS', None)
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            counts = list(executor.map(_analyze_range_in_process, *zip(*ranges)))
+        return collect_analysis_counts(counts)
+    
+    chord([
+        analyze_conversation_range.s(first_id, last_id)
+        for first_id, last_id in ranges
+    ])(collect_analysis_counts.s())
+    
+    return f"Dispatched {len(ranges)} analysis chunks"
+
+
+def _analyze_claimed(conversations):
+    """
+    Claim the unanalyzed conversations of a queryset and analyze them
+
+    Rows are claimed first with a single conditional UPDATE, so a run
+    overlapping with another one only gets the rows nobody else holds.
+    Claims older than ANALYSIS_CLAIM_TIMEOUT seconds (a crashed worker)
+    can be taken over
+    Returns: number of conversations analyzed
+    """
+    token = uuid.uuid4().hex
+    now = timezone.now()
+    expired = now - timedelta(seconds=getattr(settings, 'ANALYSIS_CLAIM_TIMEOUT', 3600))
+    
+    conversations.filter(
+        Q(claim_token__isnull=True) | Q(claimed_at__lt=expired),
+        analyzed=False,
+    ).update(claim_token=token, claimed_at=now)
+    
     try:
-        conversation = Conversation.objects.get(id=conversation_id)
-        analyzer = ConversationAnalyzer()
-        
-        analysis_data = analyzer.analyze_conversation(conversation)
-        
-        ConversationAnalysis.objects.update_or_create(
-            conversation=conversation,
-            defaults=analysis_data
+        return _analyze_conversations(
+            ConversationAnalyzer(),
+            Conversation.objects.filter(claim_token=token, analyzed=False)
         )
-        
-        conversation.analyzed = True
-        conversation.save()
-        
-        return f"Analyzed conversation {conversation_id}"
+    finally:
+        Conversation.objects.filter(claim_token=token).update(claim_token=None, claimed_at=None)
+
+
+@shared_task
+def analyze_conversation_range(first_id, last_id):
+    """
+    Celery task: Analyze the unanalyzed conversations with ids in [first_id, last_id]
+    Conversations claimed by another run are skipped (see _analyze_claimed)
+    Returns: number of conversations analyzed
+    """
+    return _analyze_claimed(Conversation.objects.filter(id__range=(first_id, last_id)))
+
+
+@shared_task
+def collect_analysis_counts(counts):
+    """
+    Celery task: Chord callback totalling the chunk counts
+    """
+    return f"Successfully analyzed {sum(counts)} conversations"
+
+
+@shared_task
+def analyze_conversation_batch(conversation_ids):
+    """
+    Celery task: Analyze a batch of conversations by id
+    Queued by the import_conversations command after each imported batch;
+    conversations the nightly run already claimed are left to it (see
+    _analyze_claimed)
+    """
+    count = _analyze_claimed(Conversation.objects.filter(id__in=conversation_ids))
+    
+    return f"Successfully analyzed {count} of {len(conversation_ids)} conversations"
+
+
+@shared_task
+def refresh_relevance_idf():
+    """
+    Celery task: Rebuild the relevance IDF table from all messages
+    Runs weekly via Celery Beat
+    """
+    statistics = refresh_idf_table()
+    return f"Built IDF table of {len(statistics.frequencies)} terms from {statistics.documents} messages"
+
+
+def _set_job_status(job_id, status, error=''):
+    if job_id is None:
+        return
+    fields = {'status': status, 'error': error}
+    if status == AnalysisJob.RUNNING:
+        fields['started_at'] = timezone.now()
+    else:
+        fields['finished_at'] = timezone.now()
+    AnalysisJob.objects.filter(id=job_id).update(**fields)
+
+
+@shared_task
+def analyze_single_conversation(conversation_id, job_id=None, metrics=None):
+    """
+    Celery task: Analyze a single conversation asynchronously
+    With a job_id (queued by POST /api/analyse/ in async mode) the
+    AnalysisJob row tracks its progress; metrics selects the metrics to
+    compute (None for ANALYSIS_METRICS / all)
+    """
+    _set_job_status(job_id, AnalysisJob.RUNNING)
+    try:
+        conversation = get_conversation(conversation_id)
+        _, recomputed = reanalyze(ConversationAnalyzer(metrics=metrics), conversation)
     except Conversation.DoesNotExist:
+        _set_job_status(job_id, AnalysisJob.FAILED, f'Conversation {conversation_id} not found')
         return f"Conversation {conversation_id} not found"
+    except Exception as e:
+        print(f"Error analyzing conversation {conversation_id}: {str(e)}")
+        _set_job_status(job_id, AnalysisJob.FAILED, str(e))
+        raise
+    
+    _set_job_status(job_id, AnalysisJob.SUCCEEDED)
+    if not recomputed:
+        return f"Conversation {conversation_id} already up to date"
+    return f"Analyzed conversation {conversation_id}"
+
+
+@shared_task
+def prune_analysis_jobs():
+    """
+    Celery task: Fail lost local jobs and delete the jobs that finished
+    more than ANALYSIS_JOB_RETENTION_DAYS days ago
+    Runs daily via Celery Beat
+    """
+    # jobs imports this module
+    from .jobs import fail_lost_jobs, prune_jobs
+
+    lost = fail_lost_jobs()
+    deleted = prune_jobs(timezone.now() - timedelta(days=getattr(settings, 'ANALYSIS_JOB_RETENTION_DAYS', 7)))
+    return f"Deleted {deleted} finished jobs, marked {lost} lost jobs failed"
@@ -1,3 +1,1304 @@
-from django.test import TestCase
+import csv
+import gzip
+import io
+import json
+import math
+import os
+import random
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import timedelta
+from unittest import mock
 
-# Create your tests here.
+from asgiref.sync import async_to_sync
+
+from django.core.management import call_command
+from django.db import connection
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from . import jobs, relevance, sentiment, tasks
+from .archive import archive_conversations, archived_files, iter_archives, rescore_archive
+from .cache import SentimentCache, text_key
+from .ingestion import ingest_conversations
+from .metrics import Metric, registry
+from .management.commands import import_conversations as import_command
+from .models import (
+    AnalysisJob, AnalysisRollup, Conversation, ConversationAnalysis, Message, MessageText, TermStatistics,
+)
+from .rollups import ROLLUP_COUNTERS, RollupDeltas, rebuild_rollups, summarize
+from .sentiment import SentimentEngine, load_sentiment_engine
+from .relevance import IdfTable, count_terms, find_tokens, get_idf_table, refresh_idf_table, tokenize
+from .services import ANALYZER_VERSION, ConversationAnalyzer
+from .sketch import QuantileSketch
+from .tasks import analyze_conversation_range
+from .writer import AnalysisWriter, prepare_analysis, write_analyses
+
+
+def conversation_payload(index, turns):
+    return {
+        'title': f'Conversation {index}',
+        'messages': [
+            {
+                'sender': 'user' if turn % 2 == 0 else 'ai',
+                'text': f'Turn {turn}: thanks, I still need help with order {index}',
+            }
+            for turn in range(turns)
+        ],
+    }
+
+
+def create_conversations(count, turns=6):
+    result = ingest_conversations([conversation_payload(i, turns) for i in range(count)])
+    return [item['id'] for item in result['results']]
+
+
+def create_analyses(count):
+    ids = create_conversations(count)
+    analyzer = ConversationAnalyzer()
+    for conversation in Conversation.objects.filter(id__in=ids).prefetch_related('messages'):
+        ConversationAnalysis.objects.create(
+            conversation=conversation,
+            **analyzer.analyze_conversation(conversation)
+        )
+
+
+def create_transcripts(transcripts, gap=30):
+    """
+    transcripts: one list of (sender, text) or (sender, text, seconds
+    since the previous message) per conversation
+    Returns: the conversations, with their messages prefetched
+    """
+    start = timezone.now() - timedelta(days=1)
+    ids = []
+    for index, transcript in enumerate(transcripts):
+        conversation = Conversation.objects.create(title=f'Transcript {index}')
+        timestamp = start
+        messages = []
+        for sender, text, *seconds in transcript:
+            timestamp += timedelta(seconds=seconds[0] if seconds else gap)
+            messages.append(Message(conversation=conversation, sender=sender, text=text, timestamp=timestamp))
+        Message.objects.bulk_create(messages)
+        ids.append(conversation.id)
+    return list(Conversation.objects.filter(id__in=ids).order_by('id').prefetch_related('messages'))
+
+
+LONG_TEXT = ' '.join(
+    ['I understand the problem with your order and I am happy to help you fix it today'] * 40
+)
+
+# Conversations covering the edge cases of every metric
+TRANSCRIPTS = [
+    [],
+    [('user', 'Hello, is anyone there?'), ('user', 'This is terrible, nobody answers!')],
+    [('ai', 'Hello! How can I help you today?')],
+    [
+        ('user', 'Can you cancel my subscription?'),
+        ('ai', "I'm not sure. I don't know how to do that."),
+        ('user', 'That is not helpful at all.'),
+        ('ai', "Sorry, I can't help with that, I am not able to access accounts."),
+    ],
+    [('user', 'My order arrived broken. ' * 30), ('ai', LONG_TEXT), ('user', 'Thanks, that fixed it!')],
+    [
+        ('user', 'Where is my order?', 0),
+        ('ai', 'I understand. Let me check that for you.', 4),
+        ('user', 'Where is my order?', 600),
+        ('ai', 'I understand. Let me check that for you.', 95),
+        ('user', 'Great, thanks!', 10),
+        ('ai', 'Happy to help, you are welcome.', 1),
+    ],
+    [('user', 'Where is my order?'), ('ai', 'I understand. Let me check that for you.')],
+    [('ai', 'Hi!'), ('user', 'ok'), ('ai', 'Anything else?'), ('ai', 'Glad I could help.')],
+]
+
+
+def nearest_rank(values, q):
+    values = sorted(values)
+    return values[max(math.ceil(len(values) * q), 1) - 1]
+
+
+def latency_transcript(gaps):
+    """
+    Returns: a transcript whose response times are gaps (in seconds)
+    """
+    return [message for gap in gaps for message in (('user', 'Where is my order?', 5), ('ai', 'Let me check.', gap))]
+
+
+class QueryBudgetTestCase(TestCase):
+    """
+    Every endpoint and task gets a fixed query budget that must not grow
+    with the number of rows, messages or analyses involved
+    """
+
+    @contextmanager
+    def assertMaxQueries(self, budget):
+        with CaptureQueriesContext(connection) as captured:
+            yield
+        if len(captured) > budget:
+            queries = '\n'.join(query['sql'] for query in captured.captured_queries)
+            self.fail(f'{len(captured)} queries, budget is {budget}:\n{queries}')
+
+
+class EndpointQueryBudgetTests(QueryBudgetTestCase):
+
+    def test_upload_conversation(self):
+        for turns in (2, 60):
+            with self.assertMaxQueries(4):
+                response = self.client.post(
+                    '/api/conversations/',
+                    json.dumps(conversation_payload(0, turns)),
+                    content_type='application/json'
+                )
+            self.assertEqual(response.status_code, 201)
+
+    def test_bulk_upload_conversations(self):
+        for count in (2, 20):
+            payload = [conversation_payload(i, 10) for i in range(count)]
+            # SQLite allows 999 parameters per statement, so the 200
+            # messages of the larger upload take two INSERTs
+            with self.assertMaxQueries(5):
+                response = self.client.post(
+                    '/api/conversations/bulk/',
+                    json.dumps(payload),
+                    content_type='application/json'
+                )
+            self.assertEqual(response.json()['created'], count)
+
+    def test_append_messages(self):
+        for turns in (2, 60):
+            conversation_id = create_conversations(1, turns)[0]
+            self.client.post(
+                '/api/analyse/',
+                json.dumps({'conversation_id': conversation_id}),
+                content_type='application/json'
+            )
+            payload = conversation_payload(0, 4)['messages']
+            # Including the locked read of what the analysis contributed
+            with self.assertMaxQueries(12):
+                response = self.client.post(
+                    f'/api/conversations/{conversation_id}/messages/',
+                    json.dumps({'messages': payload, 'analyze': True}),
+                    content_type='application/json'
+                )
+            self.assertEqual(response.status_code, 201)
+
+    def test_analyse(self):
+        for turns in (2, 60):
+            conversation_id = create_conversations(1, turns)[0]
+            # The first analysis of the day also creates its rollup row
+            with self.assertMaxQueries(15):
+                response = self.client.post(
+                    '/api/analyse/',
+                    json.dumps({'conversation_id': conversation_id}),
+                    content_type='application/json'
+                )
+            self.assertEqual(response.status_code, 200)
+
+    def test_analyse_selected_metrics(self):
+        for turns in (2, 60):
+            conversation_id = create_conversations(1, turns)[0]
+            with self.assertMaxQueries(15):
+                response = self.client.post(
+                    '/api/analyse/?metrics=clarity,sentiment',
+                    json.dumps({'conversation_id': conversation_id}),
+                    content_type='application/json'
+                )
+            self.assertEqual(response.json()['analysis']['metrics'], ['sentiment', 'clarity'])
+
+    def test_prometheus_metrics(self):
+        with self.assertMaxQueries(0):
+            response = self.client.get('/metrics')
+        self.assertEqual(response.status_code, 200)
+
+    def test_analysis_job_status(self):
+        create_analyses(1)
+        job = AnalysisJob.objects.create(
+            conversation=Conversation.objects.get(),
+            status=AnalysisJob.SUCCEEDED
+        )
+        with self.assertMaxQueries(2):
+            response = self.client.get(f'/api/analyse/{job.id}/')
+        self.assertEqual(response.json()['status'], AnalysisJob.SUCCEEDED)
+        self.assertIsNotNone(response.json()['analysis'])
+
+    def test_analyse_unchanged(self):
+        for turns in (2, 60):
+            conversation_id = create_conversations(1, turns)[0]
+            payload = json.dumps({'conversation_id': conversation_id})
+            self.client.post('/api/analyse/', payload, content_type='application/json')
+            # Same fingerprint: nothing is recomputed or written
+            with self.assertMaxQueries(2):
+                response = self.client.post('/api/analyse/', payload, content_type='application/json')
+            self.assertTrue(response.json()['cached'])
+
+    def test_reports(self):
+        for count in (2, 30):
+            create_analyses(count)
+            with self.assertMaxQueries(10):
+                response = self.client.get('/api/reports/')
+            self.assertEqual(response.status_code, 200)
+
+    def test_sentiment_trajectory(self):
+        for count in (2, 30):
+            create_analyses(count)
+            conversation_id = ConversationAnalysis.objects.latest('id').conversation_id
+            with self.assertMaxQueries(1):
+                response = self.client.get(f'/api/conversations/{conversation_id}/sentiment/')
+            self.assertEqual(len(response.json()['scores']), 3)
+
+    def test_reports_summary(self):
+        for count in (2, 30):
+            create_analyses(count)
+            with self.assertMaxQueries(10):
+                response = self.client.get('/api/reports/summary/?bucket=week&group_by=bot')
+            self.assertEqual(response.status_code, 200)
+
+    def test_async_upload_conversation(self):
+        # async_to_sync runs the async ORM's queries on this thread, so
+        # they are captured on the test connection
+        post = async_to_sync(self.async_client.post)
+        for turns in (2, 60):
+            # Plus the savepoint of its transaction
+            with self.assertMaxQueries(4):
+                response = post(
+                    '/api/async/conversations/',
+                    json.dumps(conversation_payload(0, turns)),
+                    content_type='application/json'
+                )
+            self.assertEqual(response.status_code, 201)
+
+        # The conversation and its messages are written together or not at all
+        with mock.patch.object(Message.objects, 'bulk_create', side_effect=RuntimeError):
+            with self.assertRaises(RuntimeError):
+                post('/api/async/conversations/', json.dumps(conversation_payload(1, 4)), content_type='application/json')
+        self.assertEqual(Conversation.objects.count(), 2)
+
+    def test_async_reports(self):
+        get = async_to_sync(self.async_client.get)
+        for count in (2, 30):
+            create_analyses(count)
+            with self.assertMaxQueries(10):
+                response = get('/api/async/reports/')
+            self.assertEqual(response.status_code, 200)
+
+    def test_list_conversations(self):
+        for count in (2, 30):
+            create_conversations(count)
+            with self.assertMaxQueries(10):
+                response = self.client.get('/api/conversations/list/')
+            self.assertEqual(response.status_code, 200)
+
+
+class TaskQueryBudgetTests(QueryBudgetTestCase):
+
+    # Reading a chunk costs a fixed number of queries, and so does
+    # writing its results: one transaction locking the conversations and
+    # reading their analyses' rollup values, a bulk upsert, an id lookup
+    # for new rows, one UPDATE marking the conversations analyzed and a
+    # locked rollup read and update (to merge the latency sketch), plus
+    # the rollup row of a new day/bot pair
+    CHUNK_READ_QUERIES = 6
+    WRITE_QUERIES = 9
+    ROLLUP_ROW_QUERIES = 3
+
+    def test_analyze_conversation_range(self):
+        for count in (2, 40):
+            ids = create_conversations(count)
+            budget = self.CHUNK_READ_QUERIES + self.WRITE_QUERIES + self.ROLLUP_ROW_QUERIES
+            with self.assertMaxQueries(budget):
+                analyzed = analyze_conversation_range(ids[0], ids[-1])
+            self.assertEqual(analyzed, count)
+
+
+class ImportCommandTests(TestCase):
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        self.directory = directory.name
+        self.path = os.path.join(directory.name, 'chats.jsonl')
+        lines = [json.dumps(conversation_payload(i, 2)) for i in range(7)]
+        lines.insert(2, '{not json')
+        lines.insert(5, json.dumps({'title': 'No text', 'messages': [{'sender': 'user'}]}))
+        lines.insert(6, '')
+        with open(self.path, 'w') as handle:
+            handle.write('\n'.join(lines) + '\n')
+
+    def import_file(self, **options):
+        stdout, stderr = io.StringIO(), io.StringIO()
+        call_command('import_conversations', self.path, batch_size=3, stdout=stdout, stderr=stderr, **options)
+        return stdout.getvalue(), stderr.getvalue()
+
+    def titles(self):
+        return list(Conversation.objects.order_by('id').values_list('title', flat=True))
+
+    def test_import(self):
+        checkpoint = os.path.join(self.directory, 'chats.ckpt')
+        stdout, stderr = self.import_file(checkpoint=checkpoint)
+
+        self.assertEqual(self.titles(), [f'Conversation {i}' for i in range(7)])
+        self.assertEqual(Message.objects.count(), 14)
+        self.assertIn('Skipped line 3: ', stderr)
+        self.assertIn('Skipped invalid conversation: {"messages"', stderr)
+        self.assertEqual(stdout.count('Committed '), 3)
+        self.assertIn('Imported 7 conversations, skipped 2', stdout)
+        with open(checkpoint) as handle:
+            self.assertEqual(int(handle.read()), os.path.getsize(self.path))
+
+    def test_resume_after_interrupted_import(self):
+        checkpoint = os.path.join(self.directory, 'chats.ckpt')
+        insert = import_command.bulk_insert_conversations
+        calls = []
+
+        def crash_on_second_batch(validated, batch_size=None):
+            calls.append(len(validated))
+            if len(calls) == 2:
+                raise RuntimeError('killed')
+            return insert(validated, batch_size)
+
+        with mock.patch.object(import_command, 'bulk_insert_conversations', side_effect=crash_on_second_batch):
+            with self.assertRaises(RuntimeError):
+                self.import_file(checkpoint=checkpoint)
+        self.assertEqual(self.titles(), [f'Conversation {i}' for i in range(3)])
+
+        stdout, _ = self.import_file(checkpoint=checkpoint)
+        self.assertIn('Resuming from byte offset', stdout)
+        self.assertEqual(self.titles(), [f'Conversation {i}' for i in range(7)])
+
+    def test_offset(self):
+        with open(self.path, 'rb') as handle:
+            offset = sum(len(handle.readline()) for _ in range(4))
+        self.import_file(offset=offset)
+        self.assertEqual(self.titles(), [f'Conversation {i}' for i in range(3, 7)])
+
+    def test_analyze(self):
+        with mock.patch.object(jobs, '_publish', return_value=True) as publish:
+            self.import_file(analyze=True)
+        ids = list(Conversation.objects.order_by('id').values_list('id', flat=True))
+        # Batches count parsed items: the invalid conversation is in the second
+        self.assertEqual(
+            [call.args for call in publish.call_args_list],
+            [(tasks.analyze_conversation_batch, (batch,)) for batch in (ids[:3], ids[3:5], ids[5:])]
+        )
+        self.assertFalse(ConversationAnalysis.objects.exists())
+
+    @override_settings(CELERY_BROKER_URL=None)
+    def test_analyze_without_broker(self):
+        stdout, _ = self.import_file(analyze=True)
+        self.assertIn('Successfully analyzed 2 of 2 conversations', stdout)
+        self.assertEqual(ConversationAnalysis.objects.count(), 7)
+        self.assertFalse(Conversation.objects.filter(analyzed=False).exists())
+
+
+class ClaimTests(TestCase):
+
+    def claims(self, ids):
+        return list(Conversation.objects.filter(id__in=ids).order_by('id').values_list('claim_token', flat=True))
+
+    def test_overlapping_runs(self):
+        ids = create_conversations(15)
+        analyzed = []
+        counts = []
+        analyze_chunk = tasks._analyze_conversations
+
+        def run(analyzer, conversations):
+            analyzed.append(list(conversations.order_by('id').values_list('id', flat=True)))
+            if len(analyzed) == 1:
+                # A second run over an overlapping range starts while the
+                # first one holds its claims
+                counts.append(analyze_conversation_range(ids[5], ids[-1]))
+            return analyze_chunk(analyzer, conversations)
+
+        with mock.patch.object(tasks, '_analyze_conversations', side_effect=run):
+            counts.append(analyze_conversation_range(ids[0], ids[9]))
+
+        self.assertEqual(analyzed, [ids[:10], ids[10:]])
+        self.assertEqual(counts, [5, 10])
+        self.assertEqual(ConversationAnalysis.objects.count(), 15)
+        self.assertEqual(self.claims(ids), [None] * 15)
+
+    def test_stale_claim_is_taken_over(self):
+        ids = create_conversations(6)
+        now = timezone.now()
+        Conversation.objects.filter(id__in=ids[:2]).update(claim_token='crashed', claimed_at=now - timedelta(hours=2))
+        Conversation.objects.filter(id__in=ids[2:4]).update(claim_token='running', claimed_at=now)
+
+        with self.settings(ANALYSIS_CLAIM_TIMEOUT=3600):
+            self.assertEqual(analyze_conversation_range(ids[0], ids[-1]), 4)
+        analyzed = Conversation.objects.filter(id__in=ids, analyzed=True).order_by('id').values_list('id', flat=True)
+        self.assertEqual(list(analyzed), ids[:2] + ids[4:])
+        # The live claim is left to its owner
+        self.assertEqual(self.claims(ids), [None, None, 'running', 'running', None, None])
+
+    def test_batch_skips_claimed_rows(self):
+        ids = create_conversations(4)
+        Conversation.objects.filter(id__in=ids[:2]).update(claim_token='nightly', claimed_at=timezone.now())
+
+        self.assertEqual(tasks.analyze_conversation_batch(ids), 'Successfully analyzed 2 of 4 conversations')
+        analyzed = Conversation.objects.filter(id__in=ids, analyzed=True).order_by('id').values_list('id', flat=True)
+        self.assertEqual(list(analyzed), ids[2:])
+        self.assertEqual(self.claims(ids), ['nightly', 'nightly', None, None])
+
+    def test_claims_released_on_failure(self):
+        ids = create_conversations(4)
+        with mock.patch.object(tasks, '_analyze_conversations', side_effect=RuntimeError('worker died')):
+            with self.assertRaises(RuntimeError):
+                analyze_conversation_range(ids[0], ids[-1])
+        self.assertEqual(self.claims(ids), [None] * 4)
+        self.assertFalse(Conversation.objects.filter(id__in=ids, analyzed=True).exists())
+
+        # The next run picks them up at once
+        self.assertEqual(analyze_conversation_range(ids[0], ids[-1]), 4)
+
+
+class JobTests(TestCase):
+
+    def job(self, worker='', status=AnalysisJob.QUEUED, age=0):
+        job = AnalysisJob.objects.create(conversation=self.conversation, status=status, worker=worker)
+        AnalysisJob.objects.filter(id=job.id).update(
+            created_at=timezone.now() - timedelta(seconds=age),
+            finished_at=None if status in (AnalysisJob.QUEUED, AnalysisJob.RUNNING) else timezone.now() - timedelta(seconds=age)
+        )
+        return job.id
+
+    def statuses(self, ids):
+        return [AnalysisJob.objects.get(id=job_id).status for job_id in ids]
+
+    def setUp(self):
+        self.conversation = Conversation.objects.get(id=create_conversations(1)[0])
+
+    @override_settings(CELERY_BROKER_URL=None)
+    def test_local_jobs_record_their_process(self):
+        with mock.patch.object(jobs, 'get_local_executor') as executor:
+            job = jobs.enqueue_analysis(Conversation.objects.select_related('analysis').get())
+        executor.return_value.submit.assert_called_once()
+        self.assertEqual(AnalysisJob.objects.get(id=job.id).worker, jobs.local_worker())
+
+    @override_settings(ANALYSIS_LOCAL_JOB_TIMEOUT=3600)
+    def test_lost_jobs_fail(self):
+        host = jobs.local_worker().split(':')[0]
+        ids = [
+            self.job(jobs.local_worker(), AnalysisJob.RUNNING),
+            self.job(f'{host}:{os.getpid() + 1}'),
+            self.job(f'{host}:{os.getpid() + 1}', AnalysisJob.SUCCEEDED),
+            self.job('gone-host:1', age=7200),
+            self.job('other-host:1'),
+            self.job('', age=7200),
+        ]
+        with mock.patch.object(jobs, '_is_running', side_effect=lambda pid: pid == os.getpid()):
+            self.assertEqual(jobs.fail_lost_jobs(), 2)
+        self.assertEqual(self.statuses(ids), [
+            AnalysisJob.RUNNING, AnalysisJob.FAILED, AnalysisJob.SUCCEEDED,
+            AnalysisJob.FAILED, AnalysisJob.QUEUED, AnalysisJob.QUEUED,
+        ])
+        self.assertTrue(AnalysisJob.objects.get(id=ids[1]).error.startswith('Lost'))
+
+    def test_prune_jobs(self):
+        day = 24 * 3600
+        kept = [self.job(status=AnalysisJob.SUCCEEDED, age=day), self.job(age=30 * day)]
+        self.job(status=AnalysisJob.SUCCEEDED, age=8 * day)
+        self.job(status=AnalysisJob.FAILED, age=8 * day)
+
+        stdout = io.StringIO()
+        call_command('prune_jobs', stdout=stdout)
+        self.assertIn('Deleted 2 finished jobs', stdout.getvalue())
+        self.assertEqual(sorted(AnalysisJob.objects.values_list('id', flat=True)), sorted(kept))
+
+
+# The texts of conversation_payload are about 45 characters long
+@override_settings(MESSAGE_TEXT_DEDUP=True, MESSAGE_TEXT_MIN_LENGTH=32)
+class MessageTextTests(QueryBudgetTestCase):
+
+    def test_upload_stores_each_text_once(self):
+        payload = [conversation_payload(i, 10) for i in range(20)]
+        for _ in range(2):
+            # Plus one hash lookup and one insert of the new texts
+            with self.assertMaxQueries(7):
+                response = self.client.post(
+                    '/api/conversations/bulk/',
+                    json.dumps(payload),
+                    content_type='application/json'
+                )
+            self.assertEqual(response.json()['created'], 20)
+        self.assertEqual(MessageText.objects.count(), 200)
+
+    def test_analysis_matches_inline_texts(self):
+        with self.settings(MESSAGE_TEXT_DEDUP=False):
+            inline = create_conversations(3, 20)
+        stored = create_conversations(3, 20)
+        analyzer = ConversationAnalyzer()
+        results = {}
+        for conversation in Conversation.objects.filter(id__in=inline + stored).prefetch_related('messages'):
+            results[conversation.id] = analyzer.analyze_conversation(conversation)
+            # Covers the message timestamps, which differ
+            del results[conversation.id]['fingerprint']
+        for inline_id, stored_id in zip(inline, stored):
+            self.assertEqual(results[inline_id], results[stored_id])
+
+        budget = TaskQueryBudgetTests.CHUNK_READ_QUERIES + 1
+        budget += TaskQueryBudgetTests.WRITE_QUERIES + TaskQueryBudgetTests.ROLLUP_ROW_QUERIES
+        with self.assertMaxQueries(budget):
+            analyze_conversation_range(stored[0], stored[-1])
+
+    def test_edited_text_is_kept(self):
+        ids = create_conversations(1, 3)
+        first, second, third = Message.objects.filter(conversation_id=ids[0])
+        original = second.text
+
+        # Unchanged: still stored by hash
+        second.save()
+        self.assertEqual(Message.objects.filter(id=second.id).values_list('text', flat=True).get(), '')
+        self.assertEqual(Message.objects.get(id=second.id).text, original)
+
+        first.text = 'edited text'
+        first.save()
+        third.text = 'edited with update_fields'
+        third.save(update_fields=['text'])
+        Message.objects.filter(id=second.id).update(text='updated text')
+
+        texts = [message.text for message in Message.objects.filter(conversation_id=ids[0])]
+        self.assertEqual(texts, ['edited text', 'updated text', 'edited with update_fields'])
+        self.assertFalse(Message.objects.filter(conversation_id=ids[0], stored_text__isnull=False).exists())
+
+
+class AnalysisWriterTests(TestCase):
+
+    def test_failed_rows_are_logged(self):
+        conversations = create_transcripts(TRANSCRIPTS[3:6])
+        analyzer = ConversationAnalyzer()
+        writer = AnalysisWriter(max_rows=10)
+        for conversation in conversations:
+            writer.add(conversation, analyzer.analyze_conversation(conversation))
+
+        def write(prepared):
+            if len(prepared) > 1 or prepared[0][0].id == conversations[1].id:
+                raise RuntimeError('disk full')
+            return write_analyses(prepared)
+
+        with mock.patch('analysis.writer.write_analyses', side_effect=write):
+            with self.assertLogs('analysis.writer') as logs:
+                self.assertEqual(writer.flush(), 2)
+        self.assertEqual([record.levelname for record in logs.records], ['WARNING', 'ERROR'])
+        self.assertIn(f'conversation {conversations[1].id}', logs.records[1].getMessage())
+        self.assertIn('disk full', logs.output[1])
+        self.assertEqual(ConversationAnalysis.objects.count(), 2)
+
+
+class RollupTests(TestCase):
+
+    def test_rows_updated_in_key_order(self):
+        values = dict.fromkeys(ConversationAnalysis.ROLLUP_FIELDS, 0)
+        values.update(sentiment='neutral', latency_sketch=None, resolution=False, escalation_needed=False, metrics=None)
+        deltas = RollupDeltas()
+        for days_ago, bot in [(1, 'b'), (3, 'b'), (1, 'a'), (2, '')]:
+            deltas.add(dict(values, created_at=timezone.now() - timedelta(days=days_ago)), bot)
+        deltas.apply()
+
+        # Rows are created as they are first updated
+        today = timezone.localdate()
+        expected = [(today - timedelta(days=days_ago), bot) for days_ago, bot in [(3, 'b'), (2, ''), (1, 'a'), (1, 'b')]]
+        self.assertEqual(list(AnalysisRollup.objects.order_by('id').values_list('day', 'bot')), expected)
+
+
+    def test_interleaved_writes(self):
+        conversation_id = create_conversations(1)[0]
+        analyzer = ConversationAnalyzer()
+
+        def load():
+            return Conversation.objects.select_related('analysis').prefetch_related('messages').get(id=conversation_id)
+
+        write_analyses([prepare_analysis(load(), analyzer.analyze_conversation(load()))])
+        # Both load the analysis before either writes, like the API and the
+        # nightly task analyzing the same conversation at once
+        first, second = load(), load()
+        result = analyzer.analyze_conversation(first)
+        write_analyses([prepare_analysis(first, {**result, 'overall_score': 0.25, 'fallback_count': 3})])
+        write_analyses([prepare_analysis(second, {**result, 'overall_score': 0.75, 'fallback_count': 1})])
+
+        rollup = AnalysisRollup.objects.values('analyses', 'overall_score_sum', 'fallback_total').get()
+        self.assertEqual(rollup, {'analyses': 1, 'overall_score_sum': 0.75, 'fallback_total': 1})
+
+    def test_latency_sketches_merged(self):
+        gaps = [[1, 2, 3, 40], [5, 8, 13, 21, 34], [0.5, 90]]
+        conversations = create_transcripts([latency_transcript(g) for g in gaps])
+        analyzer = ConversationAnalyzer()
+        write_analyses([prepare_analysis(c, analyzer.analyze_conversation(c)) for c in conversations])
+
+        expected = QuantileSketch()
+        for sketch in ConversationAnalysis.objects.values_list('latency_sketch', flat=True):
+            expected.merge(QuantileSketch.from_dict(sketch))
+        rollup = AnalysisRollup.objects.get()
+        self.assertEqual(QuantileSketch.from_dict(rollup.latency_sketch).buckets, expected.buckets)
+        self.assertEqual(rollup.responses, 11)
+
+        values = [gap for g in gaps for gap in g]
+        latency = summarize(AnalysisRollup.objects.all())[0]['response_time']
+        self.assertEqual(latency['responses'], len(values))
+        self.assertAlmostEqual(latency['mean'], sum(values) / len(values), places=2)
+        for q in (0.5, 0.95, 0.99):
+            exact = nearest_rank(values, q)
+            self.assertLessEqual(abs(latency[f'p{round(q * 100)}'] - exact), exact * QuantileSketch.RELATIVE_ACCURACY + 0.005)
+
+        # Re-analyzing takes the previous sketch out before adding the new one
+        conversations = create_transcripts([latency_transcript([7])])
+        write_analyses([prepare_analysis(conversations[0], analyzer.analyze_conversation(conversations[0]))])
+        conversation = Conversation.objects.select_related('analysis').prefetch_related('messages').get(id=conversations[0].id)
+        write_analyses([prepare_analysis(conversation, analyzer.analyze_conversation(conversation))])
+        expected.add(7)
+        self.assertEqual(QuantileSketch.from_dict(AnalysisRollup.objects.get().latency_sketch).buckets, expected.buckets)
+
+    def test_partial_analyses_not_counted(self):
+        conversations = create_transcripts(TRANSCRIPTS[3:6])
+        ids = [conversation.id for conversation in conversations]
+        Conversation.objects.filter(id__in=ids).update(bot='a')
+
+        def analyse(conversation_id, metrics=None):
+            body = {'conversation_id': conversation_id}
+            if metrics:
+                body['metrics'] = metrics
+            self.client.post('/api/analyse/', json.dumps(body), content_type='application/json')
+
+        for conversation_id in ids[:2]:
+            analyse(conversation_id)
+        summary = summarize(AnalysisRollup.objects.all(), by_bot=True)
+        self.assertEqual(summary[0]['analyses'], 2)
+
+        # Its overall_score (0.0) and resolution (False) are defaults, not scores
+        analyse(ids[2], ['sentiment'])
+        self.assertEqual(ConversationAnalysis.objects.get(conversation_id=ids[2]).metrics, ['sentiment'])
+        self.assertEqual(summarize(AnalysisRollup.objects.all(), by_bot=True), summary)
+        rebuild_rollups()
+        self.assertEqual(summarize(AnalysisRollup.objects.all(), by_bot=True), summary)
+
+        analyse(ids[2])
+        self.assertEqual(summarize(AnalysisRollup.objects.all(), by_bot=True)[0]['analyses'], 3)
+        analyse(ids[2], ['sentiment'])
+        self.assertEqual(summarize(AnalysisRollup.objects.all(), by_bot=True), summary)
+
+
+class ArchiveTests(QueryBudgetTestCase):
+
+    # Per archive file: the next conversation ids, their analyses and
+    # messages, and a transaction (savepoint in tests) stubbing the
+    # conversations, checking their analyses did not change and deleting
+    # their rows
+    FILE_QUERIES = 9
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        archive_dir = override_settings(ARCHIVE_DIR=directory.name)
+        archive_dir.enable()
+        self.addCleanup(archive_dir.disable)
+
+    def test_archive_and_rescore(self):
+        ids = create_conversations(30)
+        analyze_conversation_range(ids[0], ids[-1])
+        scores = dict(ConversationAnalysis.objects.values_list('conversation_id', 'overall_score'))
+        rollups = list(AnalysisRollup.objects.values_list('analyses', 'fallback_total'))
+
+        with self.assertMaxQueries(2 * self.FILE_QUERIES + 1):
+            totals = archive_conversations(timezone.now() + timedelta(seconds=1), chunk_size=20)
+        self.assertEqual(totals, {'conversations': 30, 'messages': 180, 'files': 2})
+        self.assertFalse(Message.objects.exists())
+        self.assertFalse(ConversationAnalysis.objects.exists())
+        # Deleting the archived messages does not count as editing them
+        self.assertEqual(Conversation.objects.filter(archived_at__isnull=False, analyzed=True).count(), 30)
+        # Archived analyses keep counting in the summaries
+        self.assertEqual(list(AnalysisRollup.objects.values_list('analyses', 'fallback_total')), rollups)
+
+        archived = {}
+        for archive in iter_archives():
+            self.assertEqual(len(archive.conversations()), len(archive.conversation_ids))
+            archived.update((i, analysis.overall_score) for i, analysis in archive.analyses().items())
+        self.assertEqual(archived, scores)
+
+        self.assertEqual(sum(rescore_archive(path) for path in archived_files()), 30)
+        rescored = {}
+        for archive in iter_archives():
+            rescored.update((i, analysis.overall_score) for i, analysis in archive.analyses().items())
+        self.assertEqual(rescored, scores)
+        self.assertEqual(list(AnalysisRollup.objects.values_list('analyses', 'fallback_total')), rollups)
+
+        response = self.client.post(
+            '/api/analyse/',
+            json.dumps({'conversation_id': ids[0]}),
+            content_type='application/json'
+        )
+        self.assertEqual(response.status_code, 409)
+
+
+    def test_rollups_after_archiving(self):
+        transcripts = create_transcripts(TRANSCRIPTS[1:] * 3)
+        ids = [conversation.id for conversation in transcripts]
+        Conversation.objects.filter(id__in=ids[::2]).update(bot='support')
+        analyze_conversation_range(ids[0], ids[-1])
+
+        def rollups():
+            rows = AnalysisRollup.objects.order_by('day', 'bot').values('day', 'bot', 'latency_sketch', *ROLLUP_COUNTERS)
+            return [{**row, 'overall_score_sum': round(row['overall_score_sum'], 9),
+                     'response_time_sum': round(row['response_time_sum'], 9)} for row in rows]
+
+        before = rollups()
+        archive_conversations(timezone.now() + timedelta(seconds=1), chunk_size=7)
+        self.assertEqual(rollups(), before)
+        # The same totals as counting the archived analyses from scratch
+        rebuild_rollups()
+        self.assertEqual(rollups(), before)
+
+    def test_stale_analyses_not_archived(self):
+        ids = create_conversations(4)
+        analyze_conversation_range(ids[0], ids[-1])
+        self.client.post(
+            '/api/analyse/',
+            json.dumps({'conversation_id': ids[1], 'metrics': ['sentiment']}),
+            content_type='application/json'
+        )
+        ConversationAnalysis.objects.filter(conversation_id=ids[2]).update(fingerprint='older rules')
+
+        older_than = timezone.now() + timedelta(seconds=1)
+        self.assertEqual(archive_conversations(older_than)['conversations'], 2)
+        self.assertEqual(
+            sorted(Conversation.objects.filter(archived_at__isnull=True, analyzed=False).values_list('id', flat=True)),
+            ids[1:3]
+        )
+
+        # Once analyzed again they are archived too
+        analyze_conversation_range(ids[0], ids[-1])
+        self.assertEqual(archive_conversations(older_than)['conversations'], 2)
+        for archive in iter_archives():
+            for analysis in archive.analyses().values():
+                self.assertIsNone(analysis.metrics)
+
+    def test_failed_rescore_keeps_analyses(self):
+        ids = create_conversations(3)
+        analyze_conversation_range(ids[0], ids[-1])
+        archive_conversations(timezone.now() + timedelta(seconds=1))
+        path, = archived_files()
+        with open(path.with_name(f'{path.stem}.analyses.npz'), 'rb') as handle:
+            analyses = handle.read()
+
+        with mock.patch.object(RollupDeltas, 'apply', side_effect=RuntimeError('rollups')):
+            with self.assertRaises(RuntimeError):
+                rescore_archive(path, ConversationAnalyzer(lexicons={'empathy': ['no such phrase']}))
+        with open(path.with_name(f'{path.stem}.analyses.npz'), 'rb') as handle:
+            self.assertEqual(handle.read(), analyses)
+        self.assertEqual(sorted(os.listdir(path.parent)), sorted([path.name, f'{path.stem}.analyses.npz']))
+
+
+class ExportTests(QueryBudgetTestCase):
+
+    def export(self, query=''):
+        response = self.client.get(f'/api/reports/export/{query}')
+        self.assertEqual(response.status_code, 200)
+        return b''.join(response.streaming_content)
+
+    @override_settings(EXPORT_CHUNK_SIZE=7)
+    def test_export(self):
+        create_analyses(30)
+        Conversation.objects.filter(id=Conversation.objects.first().id).update(title='a}\n{"id": 1')
+
+        # One query whatever the number of rows or chunks
+        with self.assertMaxQueries(1):
+            lines = self.export('?format=ndjson').decode().splitlines()
+        reports = self.client.get('/api/reports/?format=ndjson')
+        expected = b''.join(reports.streaming_content).decode().splitlines()
+        self.assertEqual([json.loads(line) for line in lines], [json.loads(line) for line in reversed(expected)])
+
+        self.assertEqual(gzip.decompress(self.export('?format=ndjson&gzip=true')).decode().splitlines(), lines)
+
+        # Continue after the 10th row
+        last = json.loads(lines[9])
+        rows = list(csv.reader(self.export(f"?since_id={last['id']}").decode().splitlines()))
+        self.assertEqual(rows[0][0], 'id')
+        self.assertEqual([int(row[0]) for row in rows[1:]], [json.loads(line)['id'] for line in lines[10:]])
+
+        # Rows are in id order, whatever their created_at
+        first = ConversationAnalysis.objects.order_by('id').first()
+        ConversationAnalysis.objects.filter(id=first.id).update(created_at=timezone.now() + timedelta(days=1))
+        ids = [json.loads(line)['id'] for line in self.export('?format=ndjson').decode().splitlines()]
+        self.assertEqual(ids, sorted(ids))
+
+        response = self.client.get('/api/reports/export/', HTTP_ACCEPT='application/x-ndjson')
+        self.assertEqual(response['Content-Type'], 'application/x-ndjson')
+        self.assertEqual(len(b''.join(response.streaming_content).splitlines()), 30)
+
+        for query in ('?since=yesterday', '?since_id=last'):
+            response = self.client.get(f'/api/reports/export/{query}')
+            self.assertEqual(response.status_code, 400)
+            self.assertEqual(response['Content-Type'], 'application/json')
+            self.assertIn('error', response.json())
+
+    def test_watermark_file(self):
+        create_analyses(5)
+        with tempfile.TemporaryDirectory() as directory:
+            output = os.path.join(directory, 'analyses.ndjson')
+            watermark = os.path.join(directory, 'analyses.wm')
+
+            def export():
+                call_command('export_analyses', output=output, watermark_file=watermark, stdout=io.StringIO())
+                with open(output) as handle:
+                    return [json.loads(line)['id'] for line in handle]
+
+            ids = export()
+            self.assertEqual(len(ids), 5)
+            create_analyses(2)
+            self.assertEqual(export(), sorted(ConversationAnalysis.objects.values_list('id', flat=True))[5:])
+            with open(watermark) as handle:
+                self.assertEqual(handle.read(), str(ConversationAnalysis.objects.order_by('-id').first().id))
+
+            # Written by earlier versions as "<created_at> <id>"
+            with open(watermark, 'w') as handle:
+                handle.write(f'2025-01-01T00:00:00Z {ids[-1]}')
+            self.assertEqual(len(export()), 2)
+
+
+class AnalyzerTests(TestCase):
+
+    # Results of TRANSCRIPTS[5] and TRANSCRIPTS[3] without an IDF table.
+    # A change here changes stored scores: bump ANALYZER_VERSION with it
+    BASELINE = [
+        {
+            'sentiment': 'positive', 'sentiment_trajectory': b'\x00\x00\x00\x00\x86\x1f', 'sentiment_slope': 0.4035,
+            'clarity_score': 0.9, 'relevance_score': 0.3, 'empathy_score': 1.0, 'completeness_score': 0.5,
+            'accuracy_score': 1.0, 'fallback_count': 0, 'resolution': True, 'escalation_needed': False,
+            'response_time_avg': 33.33, 'response_time_p50': 4.01, 'response_time_p95': 94.64,
+            'response_time_max': 95.0, 'response_count': 3,
+            'latency_sketch': {'zero': 0, 'buckets': {'0': 1, '70': 1, '228': 1}},
+            'overall_score': 0.71, 'metrics': None, 'analyzer_version': 3,
+        },
+        {
+            'sentiment': 'negative', 'sentiment_trajectory': b'<\xf6L\xf3', 'sentiment_slope': -0.0752,
+            'clarity_score': 0.9, 'relevance_score': 0.3, 'empathy_score': 0.5, 'completeness_score': 0.7,
+            'accuracy_score': 0.7, 'fallback_count': 2, 'resolution': False, 'escalation_needed': True,
+            'response_time_avg': 30.0, 'response_time_p50': 30.0, 'response_time_p95': 30.0,
+            'response_time_max': 30.0, 'response_count': 2,
+            'latency_sketch': {'zero': 0, 'buckets': {'171': 2}},
+            'overall_score': 0.61, 'metrics': None, 'analyzer_version': 3,
+        },
+    ]
+
+    def test_baseline(self):
+        self.assertEqual(ANALYZER_VERSION, 3, 'update BASELINE along with ANALYZER_VERSION')
+        with mock.patch('analysis.services.get_idf_table', return_value=IdfTable()):
+            analyzer = ConversationAnalyzer()
+        for conversation, expected in zip(create_transcripts([TRANSCRIPTS[5], TRANSCRIPTS[3]]), self.BASELINE):
+            result = analyzer.analyze_conversation(conversation)
+            self.assertEqual(len(result.pop('fingerprint')), 32)
+            self.assertEqual(result, expected, conversation.title)
+
+    def test_batch_matches_single_analyses(self):
+        conversations = create_transcripts(TRANSCRIPTS)
+        analyzer = ConversationAnalyzer()
+        batch = analyzer.analyze_batch(conversations)
+        states = analyzer.analyze_batch(conversations, return_state=True)
+
+        self.assertEqual(len(batch), len(conversations))
+        for conversation, result, (state_result, state) in zip(conversations, batch, states):
+            expected = analyzer.analyze_conversation(conversation)
+            self.assertEqual(result.keys(), expected.keys())
+            for field, value in expected.items():
+                self.assertEqual(result[field], value, f'{field} of {conversation.title}')
+            self.assertEqual((state_result, state), analyzer.analyze_conversation(conversation, return_state=True))
+
+
+    def test_incremental_matches_full_analysis(self):
+        analyzer = ConversationAnalyzer()
+        for conversation in create_transcripts(TRANSCRIPTS):
+            messages = list(conversation.messages.all())
+            state = analyzer.new_state()
+            for batch in (messages[:1], messages[1:3], messages[3:]):
+                state = analyzer.extend_state(state, batch)
+            self.assertEqual(
+                (analyzer.analyze_state(state), state),
+                analyzer.analyze_conversation(conversation, return_state=True),
+                conversation.title
+            )
+
+    def stored_analysis(self, conversation_id):
+        """
+        Returns: (stored analysis, running state, analysis of all the
+        conversation's messages from scratch)
+        """
+        conversation = Conversation.objects.prefetch_related('messages').get(id=conversation_id)
+        expected = ConversationAnalyzer().analyze_conversation(conversation)
+        stored = ConversationAnalysis.objects.values(*expected, 'running_state').get(conversation_id=conversation_id)
+        return stored, stored.pop('running_state'), expected
+
+    def test_appended_messages(self):
+        conversation_id = create_transcripts(TRANSCRIPTS[5:6])[0].id
+        self.client.post('/api/analyse/', json.dumps({'conversation_id': conversation_id}), content_type='application/json')
+        for turns in (1, 2, 5):
+            # Only the appended messages are analyzed
+            with mock.patch.object(ConversationAnalyzer, 'analyze_conversation', side_effect=AssertionError):
+                response = self.client.post(
+                    f'/api/conversations/{conversation_id}/messages/',
+                    json.dumps({'messages': conversation_payload(turns, turns)['messages'], 'analyze': True}),
+                    content_type='application/json'
+                )
+            self.assertEqual(response.status_code, 201)
+            stored, state, expected = self.stored_analysis(conversation_id)
+            self.assertIsNotNone(state)
+            self.assertEqual(stored, expected)
+
+    def test_plugin_metrics(self):
+        conversation_id = create_transcripts(TRANSCRIPTS[5:6])[0].id
+        analyse = json.dumps({'conversation_id': conversation_id})
+        self.client.post('/api/analyse/', analyse, content_type='application/json')
+        builtin = ConversationAnalysis.objects.get(conversation_id=conversation_id)
+        self.assertEqual(builtin.clarity_score, 0.9)
+
+        def constant_clarity(analyzer, inputs, results):
+            inputs.scores['clarity'] = 0.123
+            return {'clarity_score': 0.123}
+
+        original = registry.resolve(['clarity'])[0]
+        registry.register(Metric('clarity', ['ai_texts'], ['clarity_score'], constant_clarity), replace=True)
+        self.addCleanup(registry.register, original, replace=True)
+
+        analyzer = ConversationAnalyzer()
+        self.assertFalse(analyzer.builtin)
+        conversation = Conversation.objects.prefetch_related('messages').get(id=conversation_id)
+        result, state = analyzer.analyze_conversation(conversation, return_state=True)
+        self.assertEqual((result['clarity_score'], state), (0.123, None))
+        self.assertEqual(analyzer.analyze_batch([conversation])[0], result)
+        self.assertNotEqual(result['fingerprint'], builtin.fingerprint)
+
+        # The stored analysis is no longer up to date, nor its state usable
+        response = self.client.post('/api/analyse/', analyse, content_type='application/json')
+        self.assertFalse(response.json().get('cached'))
+        stored = ConversationAnalysis.objects.get(conversation_id=conversation_id)
+        self.assertEqual((stored.clarity_score, stored.running_state), (0.123, None))
+        self.assertEqual(stored.overall_score, result['overall_score'])
+
+    def test_edited_or_deleted_message_invalidates_state(self):
+        conversation_id = create_transcripts(TRANSCRIPTS[5:6])[0].id
+        for change in ('edit', 'delete'):
+            self.client.post('/api/analyse/', json.dumps({'conversation_id': conversation_id}), content_type='application/json')
+            self.assertIsNotNone(self.stored_analysis(conversation_id)[1])
+
+            message = Message.objects.filter(conversation_id=conversation_id).first()
+            if change == 'edit':
+                message.text = 'Actually, never mind. This is awful.'
+                message.save()
+            else:
+                message.delete()
+            self.assertIsNone(self.stored_analysis(conversation_id)[1])
+            self.assertFalse(Conversation.objects.get(id=conversation_id).analyzed)
+
+            # The next analysis reads every message again
+            self.client.post('/api/analyse/', json.dumps({'conversation_id': conversation_id}), content_type='application/json')
+            stored, _, expected = self.stored_analysis(conversation_id)
+            self.assertEqual(stored, expected)
+
+    def test_response_time_stats(self):
+        gaps = list(range(1, 21)) + [120]
+        conversation = create_transcripts([latency_transcript(gaps)])[0]
+        result = ConversationAnalyzer().analyze_conversation(conversation)
+
+        self.assertEqual(result['response_count'], 21)
+        self.assertEqual(result['response_time_avg'], 15.71)
+        self.assertEqual(result['response_time_max'], 120)
+        self.assertAlmostEqual(result['response_time_p50'], 11, delta=11 * QuantileSketch.RELATIVE_ACCURACY)
+        self.assertAlmostEqual(result['response_time_p95'], 20, delta=20 * QuantileSketch.RELATIVE_ACCURACY)
+        self.assertEqual(QuantileSketch.from_dict(result['latency_sketch']).count, 21)
+
+        # Percentiles never exceed the exact max (the sketch puts 4 at 4.01)
+        result = ConversationAnalyzer().analyze_conversation(create_transcripts([latency_transcript([4])])[0])
+        self.assertEqual((result['response_time_p50'], result['response_time_p95'], result['response_time_max']), (4, 4, 4))
+
+        result = ConversationAnalyzer().analyze_conversation(create_transcripts([[('user', 'Hello?')]])[0])
+        self.assertEqual(result['response_count'], 0)
+        self.assertIsNone(result['response_time_p50'])
+        self.assertIsNone(result['latency_sketch'])
+
+
+@override_settings(RELEVANCE_IDF_RELOAD=0)
+class RelevanceTests(TestCase):
+    USER = 'Refund my broken order!'
+    AI = 'Your order refund is ready.'
+
+    def setUp(self):
+        patcher = mock.patch.multiple(relevance, _idf_table=IdfTable(), _idf_checked_at=None)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_tokenize(self):
+        self.assertEqual(
+            find_tokens("Don't panic -- order #123 isn't_lost, is it?"),
+            ["don't", 'panic', 'order', '123', "isn't", 'lost', 'is', 'it'],
+        )
+        self.assertEqual(tokenize('Where is my ORDER? My order...'), ['order', 'order'])
+        self.assertEqual(count_terms([self.USER, 'order']), {'refund': 1, 'broken': 1, 'order': 2})
+
+    def test_score(self):
+        user, ai = count_terms([self.USER]), count_terms([self.AI])
+        # Without statistics every token weighs 1: 2 shared of 3 terms each
+        self.assertAlmostEqual(IdfTable().score(user, ai), 2 / 3)
+        # "order" is in 2 of 3 messages and weighs less than unseen terms
+        table = IdfTable(documents=3, frequencies={'order': 2})
+        self.assertAlmostEqual(table.score(user, ai), 0.563545, places=6)
+        self.assertEqual(table.score(user, user), 1.0)
+        self.assertEqual(table.score(user, count_terms(['Hello there'])), 0.0)
+        self.assertEqual(table.score({}, ai), 0.0)
+
+    def test_analyzer_scale(self):
+        analyzer = ConversationAnalyzer()
+        self.assertAlmostEqual(analyzer.analyze_relevance([self.AI], [self.USER]), 2 / 3)
+        self.assertAlmostEqual(analyzer.analyze_relevance([self.USER], [self.USER]), 1.0)
+        # Off-topic answers bottom out at 0.3; nothing to compare is 0.5
+        self.assertEqual(analyzer.analyze_relevance(['Hello there'], [self.USER]), 0.3)
+        self.assertEqual(analyzer.analyze_relevance([self.AI], ['Is it?']), 0.5)
+        self.assertEqual(analyzer.analyze_relevance([], [self.USER]), 0.5)
+
+    def test_term_statistics(self):
+        # No row, or an empty one: every token weighs 1
+        self.assertEqual((get_idf_table().version, get_idf_table().idf('order')), (0, 1.0))
+        empty = TermStatistics.objects.create()
+        self.assertEqual((get_idf_table().version, get_idf_table().idf('order')), (empty.id, 1.0))
+
+        create_transcripts([[('user', self.USER), ('ai', self.AI), ('user', 'Thanks')]])
+        statistics = refresh_idf_table()
+        self.assertEqual((statistics.documents, statistics.frequencies), (3, {'order': 2, 'refund': 2}))
+        self.assertEqual(list(TermStatistics.objects.values_list('id', flat=True)), [statistics.id])
+
+        table = get_idf_table()
+        self.assertEqual(table.version, statistics.id)
+        conversation = create_transcripts([[('user', self.USER), ('ai', self.AI)]])[0]
+        result = ConversationAnalyzer().analyze_conversation(conversation)
+        # Only shared terms are known: (a^2 + a^2) / (a^2 + a^2 + d^2)
+        a, d = math.log(4 / 3) + 1, math.log(4) + 1
+        self.assertEqual(result['relevance_score'], round(2 * a * a / (2 * a * a + d * d), 2))
+        self.assertEqual(ConversationAnalyzer().analyze_batch([conversation])[0]['relevance_score'], result['relevance_score'])
+
+
+class KeywordMatcherTests(SimpleTestCase):
+
+    LEXICONS = {
+        # Phrases that are prefixes, or inner parts, of other phrases
+        'apology': ['sorry', "sorry, i can't", 'sor', 'orr', 'apolog'],
+        # Regex metacharacters
+        'symbols': ['a.b', '(x)', 'c++', '[?]', '\\d', '$5', '^_^', 'a|b', '{2}', '*'],
+        'non_ascii': ['désolé', 'straße', 'спасибо', '申し訳', 'ÉCOLE', 'naïve'],
+        'shared': ['sorry', 'thanks', 'спасибо'],
+        'empty': [],
+    }
+
+    def expected(self, lexicons, text):
+        return frozenset(
+            name for name, phrases in lexicons.items()
+            if any(phrase.lower() in text for phrase in phrases if phrase)
+        )
+
+    def texts(self, lexicons, count=3000):
+        rng = random.Random(0)
+        pieces = [phrase.lower() for phrases in lexicons.values() for phrase in phrases]
+        # Fragments of phrases, so that partial matches are common
+        pieces += [piece[:rng.randint(1, len(piece))] for piece in pieces]
+        pieces += list('ab.()+?$^_|{}*xсé ') + ['', ' i ', "can't", 'ß']
+        return [''.join(rng.choice(pieces) for _ in range(rng.randint(0, 8))) for _ in range(count)]
+
+    def test_regex_matches_substring_scan(self):
+        from .matching import KeywordMatcher
+        from .services import DEFAULT_LEXICONS
+
+        for lexicons in (self.LEXICONS, DEFAULT_LEXICONS):
+            regex = KeywordMatcher(lexicons, scan_threshold=0)
+            scan = KeywordMatcher(lexicons, scan_threshold=10 ** 6)
+            self.assertFalse(regex._scan)
+            self.assertTrue(scan._scan)
+            texts = self.texts(lexicons) + [
+                "sorry, i can't", 'sorr', 'xsorryx', 'c+', 'a.b|c', '(x)(x)', 'ecole', 'école', 'strasse',
+            ]
+            for text in texts:
+                expected = self.expected(lexicons, text)
+                self.assertEqual(regex.match(text), expected, text)
+                self.assertEqual(scan.match(text), expected, text)
+
+
+class QuantileSketchTests(SimpleTestCase):
+
+    def test_relative_accuracy(self):
+        rng = random.Random(14)
+        for values in (
+            [rng.lognormvariate(1, 2) for _ in range(5000)],
+            [rng.uniform(0.01, 600) for _ in range(1000)],
+            [rng.expovariate(0.2) + QuantileSketch.MIN_VALUE for _ in range(333)],
+        ):
+            sketch = QuantileSketch()
+            for value in values:
+                sketch.add(value)
+            self.assertEqual(sketch.count, len(values))
+            for q in (0.0, 0.01, 0.25, 0.5, 0.9, 0.95, 0.99, 1.0):
+                exact = nearest_rank(values, q)
+                self.assertLessEqual(abs(sketch.quantile(q) - exact), exact * QuantileSketch.RELATIVE_ACCURACY * 1.000001)
+
+    def test_zero_bucket(self):
+        sketch = QuantileSketch()
+        self.assertIsNone(sketch.quantile(0.5))
+        for value in (0, 0, QuantileSketch.MIN_VALUE / 2, 10):
+            sketch.add(value)
+        self.assertEqual(sketch.zero_count, 3)
+        self.assertEqual(sketch.quantile(0.5), 0.0)
+        self.assertAlmostEqual(sketch.quantile(1.0), 10, delta=10 * QuantileSketch.RELATIVE_ACCURACY)
+
+    def test_merge(self):
+        rng = random.Random(7)
+        first, second, both = QuantileSketch(), QuantileSketch(), QuantileSketch()
+        for sketch in (first, second):
+            for _ in range(500):
+                value = rng.uniform(0, 120)
+                sketch.add(value)
+                both.add(value)
+
+        merged = QuantileSketch.from_dict(first.to_dict()).merge(second)
+        self.assertEqual((merged.buckets, merged.zero_count), (both.buckets, both.zero_count))
+        # Subtracting a sketch takes its values out again, empty buckets included
+        merged.merge(second, sign=-1)
+        self.assertEqual((merged.buckets, merged.zero_count), (first.buckets, first.zero_count))
+        self.assertFalse(QuantileSketch().merge(first).merge(first, sign=-1))
+
+
+class FakeRedis:
+    """
+    The subset of redis.Redis used by SentimentCache, optionally failing
+    """
+
+    def __init__(self, fail=False):
+        self.values = {}
+        self.fail = fail
+
+    def mget(self, keys):
+        if self.fail:
+            raise ConnectionError('redis is down')
+        return [self.values.get(key) for key in keys]
+
+    def pipeline(self, transaction=True):
+        return self
+
+    def set(self, key, value, ex=None):
+        self.values[key] = str(value).encode()
+
+    def execute(self):
+        if self.fail:
+            raise ConnectionError('redis is down')
+
+
+class SentimentCacheTests(SimpleTestCase):
+
+    def setUp(self):
+        self.computed = []
+
+    def compute_many(self, texts):
+        self.computed.extend(texts)
+        return [float(len(text)) for text in texts]
+
+    def test_lru_eviction_and_stats(self):
+        cache = SentimentCache(max_size=2)
+        self.assertEqual(cache.get_many(['a', 'bb', 'a'], self.compute_many), [1.0, 2.0, 1.0])
+        # Whitespace does not change a VADER score, so it is not part of the key
+        self.assertEqual(cache.get_many(['a ', ' bb'], self.compute_many), [1.0, 2.0])
+        cache.get_many(['ccc'], self.compute_many)  # evicts 'a', the least recently used
+        cache.get_many(['bb', 'a'], self.compute_many)
+        self.assertEqual(self.computed, ['a', 'bb', 'ccc', 'a'])
+        self.assertEqual(cache.stats(), {
+            'size': 2, 'max_size': 2, 'hits': 4, 'misses': 4, 'evictions': 2,
+            'redis_hits': 0, 'redis_errors': 0, 'hit_rate': 0.5,
+        })
+
+        cache.reset_stats()
+        self.assertEqual(cache.stats()['hits'], 0)
+        self.assertEqual(cache.stats()['hit_rate'], 0.0)
+
+    def test_redis_tier(self):
+        cache = SentimentCache(max_size=10)
+        cache._redis = FakeRedis()
+        cache.get_many(['shared', 'text'], self.compute_many)
+        self.assertEqual(set(cache._redis.values), {cache.redis_prefix + text_key(t) for t in ('shared', 'text')})
+        self.assertEqual(cache.redis_prefix, f'sentiment:{sentiment.FORMAT_VERSION}:{sentiment.nltk_version()}:')
+
+        # Another process: found in Redis, not computed again
+        other = SentimentCache(max_size=10)
+        other._redis = cache._redis
+        self.assertEqual(other.get_many(['shared', 'new'], self.compute_many), [6.0, 3.0])
+        self.assertEqual(self.computed, ['shared', 'text', 'new'])
+        stats = other.stats()
+        self.assertEqual((stats['hits'], stats['redis_hits'], stats['misses']), (1, 1, 1))
+
+    def test_redis_errors_fall_back_to_computing(self):
+        cache = SentimentCache(max_size=0)
+        cache._redis = FakeRedis(fail=True)
+        with self.assertLogs('analysis.cache', 'WARNING'):
+            self.assertEqual(cache.get_many(['text', 'text'], self.compute_many), [4.0, 4.0])
+        self.assertEqual(self.computed, ['text'])
+        stats = cache.stats()
+        # One failed lookup, one failed write
+        self.assertEqual((stats['redis_errors'], stats['misses'], stats['hits'], stats['size']), (2, 1, 1, 0))
+
+    def test_counters_are_thread_safe(self):
+        cache = SentimentCache(max_size=50)
+        texts = [f'text {i % 100}' for i in range(200)]
+
+        def lookups():
+            for start in range(0, len(texts), 7):
+                cache.get_many(texts[start:start + 7], self.compute_many)
+
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            for future in [executor.submit(lookups) for _ in range(8)]:
+                future.result()
+        stats = cache.stats()
+        self.assertEqual(stats['hits'] + stats['misses'], 8 * len(texts))
+        self.assertEqual(stats['misses'], len(self.computed))
+
+
+class SentimentEngineTests(SimpleTestCase):
+
+    def reference_corpus(self, engine, count=5000):
+        """
+        Texts exercising every VADER rule: lexicon words and emoticons,
+        boosters, negations, idioms, "but", "least", "never so", mixed
+        capitals, punctuation stuck to words and trailing !/?
+        """
+        rng = random.Random(0)
+        lexicon = sorted(engine.lexicon)
+        rule_words = sorted(
+            set(engine.boosters) | set(engine.negations)
+            | {word for words in engine.booster_pairs for word in words}
+            | {word for words in engine.idioms for word in words}
+            | {'but', 'least', 'at', 'very', 'never', 'so', 'this', 'the', 'I', 'it', 'a'}
+        )
+        punctuation = sorted(engine.punctuation)
+        texts = ['', ' ', 'a', ':)', 'I am NOT happy!!', 'at least good', 'never so good', 'kind of great']
+        for _ in range(count):
+            words = []
+            for _ in range(rng.randint(1, 16)):
+                word = rng.choice(lexicon if rng.random() < 0.4 else rule_words)
+                if rng.random() < 0.15:
+                    word = word.upper() if rng.random() < 0.7 else word.capitalize()
+                if rng.random() < 0.15:
+                    affix = rng.choice(punctuation)
+                    word = affix + word if rng.random() < 0.3 else word + affix
+                words.append(word)
+            texts.append(' '.join(words) + rng.choice(['', '!', '!!!!!!', '??', '????', '.']))
+        return texts
+
+    def test_matches_nltk(self):
+        from nltk.sentiment.vader import SentimentIntensityAnalyzer
+
+        analyzer = SentimentIntensityAnalyzer()
+        engine = SentimentEngine.from_nltk()
+        texts = self.reference_corpus(engine)
+        for text, score in zip(texts, engine.score_many(texts)):
+            self.assertAlmostEqual(score, analyzer.polarity_scores(text)['compound'], delta=1e-6, msg=text)
+
+    def test_loading_writes_no_file(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'sentiment_engine.marshal')
+            with self.assertLogs('analysis.sentiment', 'WARNING'):
+                engine = load_sentiment_engine(path)
+            self.assertFalse(os.path.exists(path))
+
+            call_command('compile_sentiment', output=path, stdout=io.StringIO())
+            self.assertEqual(load_sentiment_engine(path).lexicon, engine.lexicon)
@@ -0,0 +1,173 @@
+import hashlib
+import threading
+import zlib
+from collections import OrderedDict
+
+from django.conf import settings
+
+
+# Hashes per lookup query, well below every backend's parameter limit
+LOOKUP_BATCH_SIZE = 500
+
+
+def text_hash(text):
+    """
+    Content address of a message text: BLAKE2b-128 of the exact text
+    (unlike cache.text_key, whitespace matters here)
+    Returns: 32 hex characters
+    """
+    return hashlib.blake2b(text.encode('utf-8'), digest_size=16).hexdigest()
+
+
+def encode_text(text):
+    """
+    Returns: the (text, compressed) fields of a MessageText; texts of at
+    least MESSAGE_TEXT_COMPRESS_MIN bytes are zlib-compressed when that
+    makes them smaller
+    """
+    data = text.encode('utf-8')
+    if len(data) >= getattr(settings, 'MESSAGE_TEXT_COMPRESS_MIN', 512):
+        compressed = zlib.compress(data)
+        if len(compressed) < len(data):
+            return '', compressed
+    return text, None
+
+
+def decode_text(text, compressed):
+    if compressed is None:
+        return text
+    return zlib.decompress(compressed).decode('utf-8')
+
+
+class TextCache:
+    """
+    In-process LRU of hash -> text
+    A hash always names the same text, so entries never go stale
+    """
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_many(self, hashes):
+        """
+        Returns: {hash: text} of the cached hashes
+        """
+        found = {}
+        with self._lock:
+            for key in hashes:
+                text = self._entries.get(key)
+                if text is not None:
+                    self._entries.move_to_end(key)
+                    found[key] = text
+        return found
+
+    def set_many(self, texts):
+        if not self.max_size:
+            return
+        with self._lock:
+            for key, text in texts.items():
+                self._entries[key] = text
+                self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+_text_cache = None
+_text_cache_lock = threading.Lock()
+
+
+def get_text_cache():
+    """
+    Process-wide TextCache of MESSAGE_TEXT_CACHE_SIZE texts
+    """
+    global _text_cache
+    if _text_cache is None:
+        with _text_cache_lock:
+            if _text_cache is None:
+                _text_cache = TextCache(getattr(settings, 'MESSAGE_TEXT_CACHE_SIZE', 10000))
+    return _text_cache
+
+
+def store_texts(messages):
+    """
+    Move the texts of unsaved messages to MessageText: each message gets
+    the hash of its text and an empty text field
+    Known texts are looked up with one query per LOOKUP_BATCH_SIZE distinct
+    hashes and only new ones are inserted; a text inserted by a concurrent
+    upload in the meantime is skipped
+    Texts shorter than MESSAGE_TEXT_MIN_LENGTH stay inline, where they
+    take less room than a hash
+    """
+    from .models import MessageText
+
+    min_length = getattr(settings, 'MESSAGE_TEXT_MIN_LENGTH', 64)
+    new = {}
+    for message in messages:
+        if message.stored_text_id is None and len(message.text) >= min_length:
+            key = text_hash(message.text)
+            new.setdefault(key, message.text)
+            message.stored_text_id = key
+            message.text = ''
+    if not new:
+        return
+
+    # Known texts are never re-sent (or re-compressed), however common
+    hashes = list(new)
+    for start in range(0, len(hashes), LOOKUP_BATCH_SIZE):
+        known = MessageText.objects.filter(hash__in=hashes[start:start + LOOKUP_BATCH_SIZE])
+        for key in known.values_list('hash', flat=True):
+            del new[key]
+
+    rows = []
+    for key, text in new.items():
+        text_field, compressed = encode_text(text)
+        rows.append(MessageText(hash=key, text=text_field, compressed=compressed))
+    MessageText.objects.bulk_create(rows, batch_size=LOOKUP_BATCH_SIZE, ignore_conflicts=True)
+    get_text_cache().set_many(new)
+
+
+def get_texts(hashes):
+    """
+    Returns: {hash: text} of MessageText hashes, from the process cache or
+    with one query per LOOKUP_BATCH_SIZE missing hashes
+    """
+    from .models import MessageText
+
+    cache = get_text_cache()
+    texts = cache.get_many(hashes)
+    missing = [key for key in hashes if key not in texts]
+    loaded = {}
+    for start in range(0, len(missing), LOOKUP_BATCH_SIZE):
+        rows = MessageText.objects.filter(hash__in=missing[start:start + LOOKUP_BATCH_SIZE])
+        for key, text, compressed in rows.values_list('hash', 'text', 'compressed'):
+            loaded[key] = decode_text(text, compressed)
+    cache.set_many(loaded)
+    texts.update(loaded)
+    return texts
+
+
+def load_texts(messages):
+    """
+    Fill in the text of loaded messages stored in MessageText (see
+    get_texts); a non-empty inline text was written after the reference
+    and wins
+    Messages with the same hash share one string object, so per-text work
+    keyed by text (see ConversationAnalyzer.analyze_batch) hashes it once
+    """
+    pending = [
+        message for message in messages
+        if message.__dict__.get('stored_text_id') and message.__dict__.get('text') == ''
+    ]
+    if not pending:
+        return
+
+    texts = get_texts({message.stored_text_id for message in pending})
+    for message in pending:
+        # Message.save compares against it to tell whether the text changed
+        message.text = message._stored_text = texts[message.stored_text_id]
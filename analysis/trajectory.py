@@ -0,0 +1,68 @@
+import base64
+import sys
+from array import array
+
+
+# VADER compound scores are rounded to 4 decimals, so in ten-thousandths
+# they are integers in [-10000, 10000]: two bytes per message, exactly
+_TYPECODE = 'h'
+ITEM_SIZE = array(_TYPECODE).itemsize
+
+
+def pack(units):
+    """
+    Compact little-endian int16 encoding of compound scores
+    units: compound scores in SENTIMENT_SCALE units
+    Returns: bytes, ITEM_SIZE per score
+    """
+    values = array(_TYPECODE, units)
+    if sys.byteorder == 'big':
+        values.byteswap()
+    return values.tobytes()
+
+
+def unpack(data, last=None):
+    """
+    Scores packed by pack(), as a list of ints
+    data: bytes or memoryview (as BinaryField returns it), or None
+    last: only decode the last scores
+    """
+    if not data:
+        return []
+    data = bytes(data)
+    if last is not None:
+        data = data[-last * ITEM_SIZE:] if last else b''
+    values = array(_TYPECODE)
+    values.frombytes(data)
+    if sys.byteorder == 'big':
+        values.byteswap()
+    return values.tolist()
+
+
+def to_text(data):
+    """
+    Packed scores as a JSON-safe string, for the running state
+    """
+    return base64.b64encode(data).decode('ascii')
+
+
+def from_text(text):
+    return base64.b64decode(text)
+
+
+def slope(units, scale):
+    """
+    Least-squares slope of the scores against their position, in compound
+    score per message
+    The sums are exact integers, so every path that sees the same scores
+    gets the same float
+    Returns: float, or None for fewer than two scores
+    """
+    n = len(units)
+    if n < 2:
+        return None
+    sum_x = n * (n - 1) // 2
+    sum_xx = (n - 1) * n * (2 * n - 1) // 6
+    sum_y = sum(units)
+    sum_xy = sum(x * y for x, y in enumerate(units))
+    return (n * sum_xy - sum_x * sum_y) / ((n * sum_xx - sum_x * sum_x) * scale)
@@ -1,12 +1,31 @@
 from django.urls import path
-from . import views
+from . import async_views, views
 
 urlpatterns = [
     path('conversations/', views.upload_conversation, name='upload-conversation'),
     
+    path('conversations/bulk/', views.bulk_upload_conversations, name='bulk-upload-conversations'),
+    
     path('conversations/list/', views.list_conversations, name='list-conversations'),
     
+    path('conversations/<int:conversation_id>/messages/', views.append_messages, name='append-messages'),
+    
+    path('conversations/<int:conversation_id>/sentiment/', views.sentiment_trajectory, name='sentiment-trajectory'),
+    
     path('analyse/', views.analyze_conversation, name='analyze-conversation'),
     
+    path('analyse/<uuid:job_id>/', views.analysis_job_status, name='analysis-job-status'),
+    
     path('reports/', views.get_reports, name='get-reports'),
+    
+    path('reports/summary/', views.reports_summary, name='reports-summary'),
+    
+    path('reports/export/', views.export_reports, name='export-reports'),
+    
+    # Async versions for ASGI servers (see async_views.py)
+    path('async/conversations/', async_views.upload_conversation, name='async-upload-conversation'),
+    
+    path('async/analyse/', async_views.analyze_conversation, name='async-analyze-conversation'),
+    
+    path('async/reports/', async_views.get_reports, name='async-get-reports'),
 ]
@@ -1,13 +1,83 @@
 from rest_framework import status
-from rest_framework.decorators import api_view
+from django.conf import settings
+from django.db import transaction
+from django.http import HttpResponse, StreamingHttpResponse
+from django.urls import reverse
+from django.utils.dateparse import parse_date
+from django.views.decorators.http import require_GET
+from rest_framework.decorators import api_view, parser_classes, renderer_classes
+from rest_framework.parsers import JSONParser
 from rest_framework.response import Response
-from .models import Conversation, ConversationAnalysis
+from rest_framework.settings import api_settings
+from .export import AnalysisExport
+from .incremental import analyze, get_conversation, mark_analyzed, reanalyze, save_analysis
+from .ingestion import ingest_conversations
+from .jobs import enqueue_analysis
+from .metrics import UnknownMetric, prometheus_text
+from .models import AnalysisJob, AnalysisRollup, Conversation, ConversationAnalysis, Message
+from .pagination import InvalidCursor, keyset_page, ndjson_response
+from .parsers import NDJSONParser
+from .renderers import CSVExportRenderer, NDJSONExportRenderer, NDJSONRenderer, ParquetExportRenderer
+from .rollups import SUMMARY_BUCKETS, summarize
 from .serializers import (
     ConversationCreateSerializer,
     ConversationListSerializer,
-    AnalysisSerializer
+    MessageSerializer,
+    AnalysisSerializer,
+    AnalysisJobSerializer
 )
-from .services import ConversationAnalyzer
+from .services import SENTIMENT_SCALE, TREND_WINDOW, ConversationAnalyzer
+from . import trajectory
+
+
+# Archived conversations are read-only: their messages are in cold
+# storage (see archive.py)
+ARCHIVED_ERROR = ({'error': 'Conversation is archived'}, status.HTTP_409_CONFLICT)
+
+
+def report_queryset():
+    """
+    ConversationAnalysis rows with only the columns AnalysisSerializer
+    reads, joined to their conversation title in the same query
+    """
+    fields = [name for name in AnalysisSerializer.Meta.fields if name != 'conversation_title']
+    return (
+        ConversationAnalysis.objects
+        .select_related('conversation')
+        .only(*fields, 'conversation__title')
+    )
+
+
+def list_response(request, queryset, serializer_class):
+    """
+    Shared response for the list endpoints:
+    - default: one keyset page, {'results': [...], 'next_cursor': ...}
+    - ?format=ndjson: every row streamed as newline-delimited JSON
+    - API_UNPAGINATED_LISTS = True: the whole table, {'count', 'results'}
+    """
+    try:
+        if request.accepted_renderer.format == 'ndjson':
+            return ndjson_response(queryset, request, serializer_class)
+        
+        if getattr(settings, 'API_UNPAGINATED_LISTS', False):
+            serializer = serializer_class(queryset, many=True)
+            return Response(
+                {
+                    'count': queryset.count(),
+                    'results': serializer.data
+                },
+                status=status.HTTP_200_OK
+            )
+        
+        return Response(
+            keyset_page(queryset, request, serializer_class),
+            status=status.HTTP_200_OK
+        )
+    except InvalidCursor:
+        return Response(
+            {'error': 'Invalid cursor'},
+            status=status.HTTP_400_BAD_REQUEST
+        )
 
 
 @api_view(['POST'])
@@ -29,17 +99,115 @@ def upload_conversation(request):
     
     if serializer.is_valid():
         conversation = serializer.save()
+        return Response(uploaded(conversation), status=status.HTTP_201_CREATED)
+    
+    return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+
+def uploaded(conversation):
+    return {
+        'id': conversation.id,
+        'title': conversation.title,
+        'message': 'Conversation uploaded successfully',
+        'analyzed': conversation.analyzed
+    }
+
+
+@api_view(['POST'])
+def append_messages(request, conversation_id):
+    """
+    POST /api/conversations/<id>/messages/
+    Append messages to an existing conversation
+    
+    Expected JSON format:
+    {
+        "messages": [
+            {"sender": "user", "text": "It broke again"},
+            {"sender": "ai", "text": "Sorry to hear that, let me check"}
+        ],
+        "analyze": true
+    }
+    
+    The conversation is marked unanalyzed so the nightly run picks it up;
+    with "analyze": true its analysis is updated right away. Either way
+    only the appended messages are analyzed, not the whole conversation
+    """
+    try:
+        conversation = get_conversation(conversation_id)
+    except Conversation.DoesNotExist:
         return Response(
-            {
-                'id': conversation.id,
-                'title': conversation.title,
-                'message': 'Conversation uploaded successfully',
-                'analyzed': conversation.analyzed
-            },
-            status=status.HTTP_201_CREATED
+            {'error': f'Conversation with id {conversation_id} not found'},
+            status=status.HTTP_404_NOT_FOUND
         )
+    if conversation.archived_at:
+        return Response(*ARCHIVED_ERROR)
     
-    return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+    serializer = MessageSerializer(data=request.data.get('messages'), many=True)
+    if not serializer.is_valid():
+        return Response({'messages': serializer.errors}, status=status.HTTP_400_BAD_REQUEST)
+    if not serializer.validated_data:
+        return Response(
+            {'messages': ['At least one message is required.']},
+            status=status.HTTP_400_BAD_REQUEST
+        )
+    
+    with transaction.atomic():
+        Message.objects.bulk_create([
+            Message(conversation=conversation, **message_data)
+            for message_data in serializer.validated_data
+        ])
+        Conversation.objects.filter(id=conversation.id).update(analyzed=False)
+        conversation.analyzed = False
+    
+    response = {
+        'id': conversation.id,
+        'appended': len(serializer.validated_data),
+        'analyzed': False
+    }
+    
+    if request.data.get('analyze'):
+        analysis, _ = reanalyze(ConversationAnalyzer(), conversation)
+        response['analyzed'] = True
+        response['analysis'] = AnalysisSerializer(analysis).data
+    
+    return Response(response, status=status.HTTP_201_CREATED)
+
+
+@api_view(['POST'])
+@parser_classes([JSONParser, NDJSONParser])
+def bulk_upload_conversations(request):
+    """
+    POST /api/conversations/bulk/
+    Upload many conversations in one request
+    
+    Accepts a JSON array (application/json) or one conversation
+    per line (application/x-ndjson), each in the same format as
+    POST /api/conversations/
+    
+    Valid items are inserted in batches, invalid ones are reported
+    per item and skipped
+    """
+    items = request.data
+    
+    if not isinstance(items, list):
+        return Response(
+            {'error': 'Expected a JSON array or NDJSON body of conversations'},
+            status=status.HTTP_400_BAD_REQUEST
+        )
+    
+    max_items = getattr(settings, 'BULK_INGEST_MAX_ITEMS', 5000)
+    if len(items) > max_items:
+        return Response(
+            {'error': f'Too many conversations in one request (max {max_items})'},
+            status=status.HTTP_400_BAD_REQUEST
+        )
+    
+    result = ingest_conversations(items)
+    
+    return Response(
+        result,
+        status=status.HTTP_201_CREATED if result['created'] else status.HTTP_400_BAD_REQUEST
+    )
 
 
 @api_view(['POST'])
@@ -50,8 +218,17 @@ def analyze_conversation(request):
     
     Expected JSON format:
     {
-        "conversation_id": 1
+        "conversation_id": 1,
+        "async": true,
+        "metrics": ["clarity", "sentiment"]
     }
+    
+    With "async": true (or ?async=true, or ANALYSIS_ASYNC_DEFAULT = True)
+    the analysis is queued and 202 is returned with a job id to poll
+    at GET /api/analyse/<job_id>/
+    
+    "metrics" (or ?metrics=clarity,sentiment) computes only those metrics
+    instead of ANALYSIS_METRICS / all of them
     """
     conversation_id = request.data.get('conversation_id')
     
@@ -61,56 +238,211 @@ def analyze_conversation(request):
             status=status.HTTP_400_BAD_REQUEST
         )
     
+    metrics = request.data.get('metrics', request.query_params.get('metrics')) or None
+    try:
+        analyzer = ConversationAnalyzer(metrics=metrics)
+    except UnknownMetric as e:
+        return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+    
+    run_async = request.data.get('async', request.query_params.get('async'))
+    if run_async is None:
+        run_async = getattr(settings, 'ANALYSIS_ASYNC_DEFAULT', False)
+    elif isinstance(run_async, str):
+        run_async = run_async.lower() in ('true', '1', 'yes')
+    
+    if run_async:
+        return queue_analysis(request, conversation_id, analyzer)
+    
     try:
-        conversation = Conversation.objects.get(id=conversation_id)
+        conversation = get_conversation(conversation_id)
     except Conversation.DoesNotExist:
         return Response(
             {'error': f'Conversation with id {conversation_id} not found'},
             status=status.HTTP_404_NOT_FOUND
         )
     
+    body, code = analysis_response(analyzer, conversation)
+    return Response(body, status=code)
+
+
+def analysis_response(analyzer, conversation):
+    """
+    Bring the analysis of conversation up to date and describe the result
+    (shared by the sync and async analyse endpoints)
+    conversation: with its analysis select_related
+    Returns: (response body, status code)
+    """
+    if conversation.archived_at:
+        return ARCHIVED_ERROR
+    
+    # Only messages appended since the last analysis are read, and
+    # nothing is recomputed if the stored fingerprint still matches
+    result = analyze(analyzer, conversation)
+    
+    if result is None:
+        mark_analyzed([conversation])
+        return {
+            'message': 'Analysis already up to date',
+            'cached': True,
+            'analysis': AnalysisSerializer(conversation.analysis).data
+        }, status.HTTP_200_OK
+    
+    analysis_data, state = result
+    
+    # Partial analyses have no state, but their messages are prefetched
+    message_count = state['message_count'] if state else len(conversation.messages.all())
+    if not message_count:
+        return {'error': 'Conversation has no messages to analyze'}, status.HTTP_400_BAD_REQUEST
+    
+    analysis = save_analysis(conversation, analysis_data, state)
+    
+    return {
+        'message': 'Analysis completed successfully',
+        'cached': False,
+        'analysis': AnalysisSerializer(analysis).data
+    }, status.HTTP_200_OK
+
+
+def queue_analysis(request, conversation_id, analyzer):
+    """
+    Async mode of POST /api/analyse/: validate, queue and return 202
+    """
+    try:
+        conversation = get_conversation(conversation_id)
+    except (Conversation.DoesNotExist, ValueError):
+        return Response(
+            {'error': f'Conversation with id {conversation_id} not found'},
+            status=status.HTTP_404_NOT_FOUND
+        )
+    
+    if conversation.archived_at:
+        return Response(*ARCHIVED_ERROR)
     if not conversation.messages.exists():
         return Response(
             {'error': 'Conversation has no messages to analyze'},
             status=status.HTTP_400_BAD_REQUEST
         )
     
-    analyzer = ConversationAnalyzer()
-    analysis_data = analyzer.analyze_conversation(conversation)
+    job = enqueue_analysis(conversation, analyzer)
     
-    analysis, created = ConversationAnalysis.objects.update_or_create(
-        conversation=conversation,
-        defaults=analysis_data
+    return Response(
+        {
+            'message': 'Analysis queued' if job.status == AnalysisJob.QUEUED else 'Analysis already up to date',
+            'job_id': str(job.id),
+            'status': job.status,
+            'status_url': request.build_absolute_uri(
+                reverse('analysis-job-status', args=[job.id])
+            )
+        },
+        status=status.HTTP_202_ACCEPTED
     )
+
+
+@api_view(['GET'])
+def sentiment_trajectory(request, conversation_id):
+    """
+    GET /api/conversations/<id>/sentiment/
+    Compound sentiment score of each user message, in order, as stored by
+    the last analysis (no message is read or scored again)
     
-    conversation.analyzed = True
-    conversation.save()
+    Optional query parameters:
+    - window: number of last user messages recent_slope is fitted on
+      (default TREND_WINDOW, at least 2)
+    """
+    window = request.query_params.get('window', TREND_WINDOW)
+    try:
+        window = int(window)
+    except (TypeError, ValueError):
+        window = 0
+    if window < 2:
+        return Response(
+            {'error': 'window must be an integer of at least 2'},
+            status=status.HTTP_400_BAD_REQUEST
+        )
+    
+    analysis = (
+        ConversationAnalysis.objects
+        .filter(conversation_id=conversation_id)
+        .only('conversation_id', 'sentiment', 'sentiment_trajectory', 'sentiment_slope')
+        .first()
+    )
+    if analysis is None:
+        return Response(
+            {'error': f'Conversation {conversation_id} has not been analyzed'},
+            status=status.HTTP_404_NOT_FOUND
+        )
     
-    serializer = AnalysisSerializer(analysis)
+    units = trajectory.unpack(analysis.sentiment_trajectory)
+    slope = trajectory.slope(units, SENTIMENT_SCALE)
+    recent_slope = trajectory.slope(units[-window:], SENTIMENT_SCALE)
     
     return Response(
         {
-            'message': 'Analysis completed successfully',
-            'analysis': serializer.data
+            'conversation': conversation_id,
+            'sentiment': analysis.sentiment,
+            'scores': [unit / SENTIMENT_SCALE for unit in units],
+            'slope': round(slope, 4) if slope is not None else None,
+            'window': window,
+            'recent_slope': round(recent_slope, 4) if recent_slope is not None else None,
         },
         status=status.HTTP_200_OK
     )
 
 
 @api_view(['GET'])
+def analysis_job_status(request, job_id):
+    """
+    GET /api/analyse/<job_id>/
+    Status of a queued analysis, with the analysis once it has succeeded
+    """
+    try:
+        job = AnalysisJob.objects.get(id=job_id)
+    except AnalysisJob.DoesNotExist:
+        return Response(
+            {'error': f'Analysis job {job_id} not found'},
+            status=status.HTTP_404_NOT_FOUND
+        )
+    
+    data = AnalysisJobSerializer(job).data
+    
+    if job.status == AnalysisJob.SUCCEEDED:
+        analysis = report_queryset().filter(conversation_id=job.conversation_id).first()
+        data['analysis'] = AnalysisSerializer(analysis).data if analysis else None
+    
+    return Response(data, status=status.HTTP_200_OK)
+
+
+@api_view(['GET'])
+@renderer_classes(api_settings.DEFAULT_RENDERER_CLASSES + [NDJSONRenderer])
 def get_reports(request):
     """
     GET /api/reports/
-    Retrieve all conversation analysis results
+    Retrieve conversation analysis results, newest first
     
     Optional query parameters:
     - sentiment: filter by sentiment (positive, neutral, negative)
     - resolution: filter by resolution status (true, false)
+    - max_slope: only analyses whose recent sentiment slope is at most
+      this (e.g. -0.1 for conversations getting worse)
+    - limit: page size (default API_PAGE_SIZE)
+    - cursor: next_cursor from the previous page
+    - format=ndjson: stream all matching rows instead of one page
     """
-    analyses = ConversationAnalysis.objects.all()
+    try:
+        analyses = filter_reports(report_queryset(), request.query_params)
+    except ValueError as e:
+        return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
     
-    sentiment_filter = request.query_params.get('sentiment', None)
-    resolution_filter = request.query_params.get('resolution', None)
+    return list_response(request, analyses, AnalysisSerializer)
+
+
+def filter_reports(analyses, params):
+    """
+    Apply the /api/reports/ query parameter filters
+    Raises: ValueError for a malformed max_slope
+    """
+    sentiment_filter = params.get('sentiment', None)
+    resolution_filter = params.get('resolution', None)
     
     if sentiment_filter:
         analyses = analyses.filter(sentiment=sentiment_filter)
@@ -119,30 +451,119 @@ def get_reports(request):
         resolution_bool = resolution_filter.lower() == 'true'
         analyses = analyses.filter(resolution=resolution_bool)
     
-    serializer = AnalysisSerializer(analyses, many=True)
+    max_slope = params.get('max_slope', None)
+    if max_slope:
+        try:
+            analyses = analyses.filter(sentiment_slope__lte=float(max_slope))
+        except ValueError:
+            raise ValueError('max_slope must be a number')
+    
+    return analyses
+
+
+@api_view(['GET'])
+@renderer_classes([CSVExportRenderer, NDJSONExportRenderer, ParquetExportRenderer])
+def export_reports(request):
+    """
+    GET /api/reports/export/
+    Stream every matching analysis, oldest first, as a file download
+    (see export.py)
+    
+    Optional query parameters:
+    - format: csv (default), ndjson or parquet (or the Accept header)
+    - since_id: the id of the last row of a previous export, to continue
+      after it
+    - since: only analyses created after this ISO 8601 datetime
+    - gzip=true: gzip the file on the fly
+    - sentiment, resolution, max_slope: as for /api/reports/
+    """
+    params = request.query_params
+    try:
+        export = AnalysisExport(
+            filter_reports(ConversationAnalysis.objects.all(), params),
+            format=request.accepted_renderer.format,
+            since=params.get('since'),
+            since_id=params.get('since_id'),
+            gzip=params.get('gzip', '').lower() in ('1', 'true'),
+        )
+    except ValueError as e:
+        return Response({'error': str(e)}, status=status.HTTP_400_BAD_REQUEST)
+    
+    response = StreamingHttpResponse(export, content_type=export.content_type)
+    response['Content-Disposition'] = f'attachment; filename="{export.filename}"'
+    return response
+
+
+@api_view(['GET'])
+def reports_summary(request):
+    """
+    GET /api/reports/summary/
+    Fleet-level metrics per time bucket, read from the incrementally
+    maintained rollup table instead of the analysis table
+    
+    Optional query parameters:
+    - bucket: day, week, month or year (default day)
+    - start, end: first and last day to include (YYYY-MM-DD)
+    - bot: only this bot
+    - group_by=bot: one row per bucket and bot
+    """
+    bucket = request.query_params.get('bucket', 'day')
+    if bucket not in SUMMARY_BUCKETS:
+        return Response(
+            {'error': f'bucket must be one of {", ".join(SUMMARY_BUCKETS)}'},
+            status=status.HTTP_400_BAD_REQUEST
+        )
+    
+    rollups = AnalysisRollup.objects.all()
+    
+    for param, lookup in (('start', 'day__gte'), ('end', 'day__lte')):
+        value = request.query_params.get(param)
+        if value:
+            try:
+                day = parse_date(value)
+            except ValueError:
+                day = None
+            if day is None:
+                return Response(
+                    {'error': f'{param} must be a date (YYYY-MM-DD)'},
+                    status=status.HTTP_400_BAD_REQUEST
+                )
+            rollups = rollups.filter(**{lookup: day})
+    
+    bot_filter = request.query_params.get('bot', None)
+    if bot_filter is not None:
+        rollups = rollups.filter(bot=bot_filter)
+    
+    by_bot = request.query_params.get('group_by') == 'bot'
     
     return Response(
         {
-            'count': analyses.count(),
-            'results': serializer.data
+            'bucket': bucket,
+            'results': summarize(rollups, bucket, by_bot)
         },
         status=status.HTTP_200_OK
     )
 
 
 @api_view(['GET'])
+@renderer_classes(api_settings.DEFAULT_RENDERER_CLASSES + [NDJSONRenderer])
 def list_conversations(request):
     """
-    GET /api/conversations/
-    List all conversations
+    GET /api/conversations/list/
+    List conversations, newest first
+    
+    Optional query parameters: limit, cursor, format=ndjson (as for reports)
     """
-    conversations = Conversation.objects.all()
-    serializer = ConversationListSerializer(conversations, many=True)
+    conversations = Conversation.objects.only(*ConversationListSerializer.Meta.fields)
     
-    return Response(
-        {
-            'count': conversations.count(),
-            'results': serializer.data
-        },
-        status=status.HTTP_200_OK
-    )
+    return list_response(request, conversations, ConversationListSerializer)
+
+
+@require_GET
+def prometheus_metrics(request):
+    """
+    GET /metrics
+    Wall time and call count of every analysis metric in this process,
+    in the Prometheus text format
+    """
+    return HttpResponse(prometheus_text(), content_type='text/plain; version=0.0.4; charset=utf-8')
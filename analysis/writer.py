@@ -0,0 +1,179 @@
+import logging
+import time
+
+from django.conf import settings
+from django.db import connection, transaction
+
+from .metrics import registry
+from .models import Conversation, ConversationAnalysis
+from .rollups import RollupDeltas, analysis_values
+
+
+logger = logging.getLogger(__name__)
+
+# Written on conflict; created_at keeps the time of the first analysis
+UPSERT_FIELDS = [
+    field.name for field in ConversationAnalysis._meta.concrete_fields
+    if field.name not in ('id', 'conversation', 'created_at')
+]
+
+
+def prepare_analysis(conversation, analysis_data, state=None):
+    """
+    Set an analysis result on the conversation's ConversationAnalysis
+    (a new one if it has none yet) without saving it
+    conversation: with its analysis (if any) select_related
+    Returns: (conversation, analysis), for write_analyses
+    """
+    try:
+        analysis = conversation.analysis
+    except ConversationAnalysis.DoesNotExist:
+        analysis = ConversationAnalysis(conversation=conversation)
+
+    # Fields of metrics left out of a partial analysis go back to their
+    # defaults rather than keep the values of an earlier analysis (and
+    # the analysis drops out of the rollups, see RollupDeltas.add)
+    for field in registry.fields():
+        setattr(analysis, field, ConversationAnalysis._meta.get_field(field).get_default())
+    for name, value in {**analysis_data, 'running_state': state}.items():
+        setattr(analysis, name, value)
+    conversation.analysis = analysis
+    return conversation, analysis
+
+
+def write_analyses(prepared):
+    """
+    Save analyses from prepare_analysis in one transaction: one UPDATE
+    marking the conversations analyzed, the locked read of what they
+    contributed to the rollups so far, one bulk_create upsert and one
+    rollup update per touched day and bot
+    bulk_create sends no signals, so the rollup deltas are applied here
+    """
+    analyses = [analysis for _, analysis in prepared]
+    conversation_ids = sorted(conversation.id for conversation, _ in prepared)
+
+    # No savepoint: inside a caller's transaction a failed write aborts
+    # it, so batches are written (and retried row by row) outside one
+    with transaction.atomic(savepoint=False):
+        # What the rows contribute is read under lock, not taken from
+        # when they were loaded: a concurrent write of the same
+        # conversation (API and nightly task) waits for this one and then
+        # subtracts what this one added. The conversations are locked, in
+        # id order, so that analyses not created yet are covered too
+        conversations = Conversation.objects.filter(id__in=conversation_ids)
+        if connection.features.has_select_for_update:
+            list(conversations.select_for_update().order_by('id').values_list('id', flat=True))
+        # SQLite has no row locks, and a transaction that reads first
+        # fails with "database is locked" instead of waiting when another
+        # one commits meanwhile; writing first takes the database lock
+        conversations.update(analyzed=True)
+        previous = {
+            values.pop('conversation_id'): values
+            for values in ConversationAnalysis.objects
+            .filter(conversation_id__in=conversation_ids)
+            .values('conversation_id', *ConversationAnalysis.ROLLUP_FIELDS)
+        }
+
+        ConversationAnalysis.objects.bulk_create(
+            analyses,
+            update_conflicts=True,
+            unique_fields=['conversation'],
+            update_fields=UPSERT_FIELDS,
+        )
+        # bulk_create sets auto_now_add fields on every row, but rows
+        # that already existed keep their stored created_at
+        for analysis in analyses:
+            if analysis.conversation_id in previous:
+                analysis.created_at = previous[analysis.conversation_id]['created_at']
+
+        # The database does not return the ids of upserted rows
+        new = {analysis.conversation_id: analysis for analysis in analyses if analysis.pk is None}
+        if new:
+            rows = (
+                ConversationAnalysis.objects
+                .filter(conversation_id__in=list(new))
+                .values_list('conversation_id', 'id')
+            )
+            for conversation_id, analysis_id in rows:
+                analysis = new[conversation_id]
+                analysis.pk = analysis_id
+                analysis._state.adding = False
+                analysis._state.db = ConversationAnalysis.objects.db
+
+        deltas = RollupDeltas()
+        for conversation, analysis in prepared:
+            if conversation.id in previous:
+                deltas.add(previous[conversation.id], conversation.bot, sign=-1)
+            deltas.add(analysis_values(analysis), conversation.bot)
+        deltas.apply()
+
+    for conversation, analysis in prepared:
+        conversation.analyzed = True
+        analysis._rollup_snapshot = analysis_values(analysis)
+
+
+class AnalysisWriter:
+    """
+    Collects analysis results and saves them in batches with
+    write_analyses
+
+    Pending results are flushed once max_rows are waiting or max_seconds
+    after the first of them was added (checked on add); call flush() for
+    the rest, or use the writer as a context manager
+    """
+
+    def __init__(self, max_rows=None, max_seconds=None):
+        if max_rows is None:
+            max_rows = getattr(settings, 'ANALYSIS_WRITE_BATCH_SIZE', 500)
+        if max_seconds is None:
+            max_seconds = getattr(settings, 'ANALYSIS_WRITE_INTERVAL', 10.0)
+        self.max_rows = max_rows
+        self.max_seconds = max_seconds
+        self.written = 0
+        self._pending = []
+        self._started = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        if exc_type is None:
+            self.flush()
+
+    def add(self, conversation, analysis_data, state=None):
+        """
+        Queue the analysis of a conversation
+        conversation: with its analysis (if any) select_related
+        Returns: the ConversationAnalysis, saved once flushed
+        """
+        prepared = prepare_analysis(conversation, analysis_data, state)
+        self._pending.append(prepared)
+        if self._started is None:
+            self._started = time.monotonic()
+        if len(self._pending) >= self.max_rows or time.monotonic() - self._started >= self.max_seconds:
+            self.flush()
+        return prepared[1]
+
+    def flush(self):
+        """
+        Write every pending result; if the batch fails, its rows are
+        retried one by one and those that fail again are skipped
+        Returns: number of analyses written
+        """
+        pending, self._pending, self._started = self._pending, [], None
+        if not pending:
+            return 0
+        try:
+            write_analyses(pending)
+            written = len(pending)
+        except Exception as e:
+            logger.warning(f"Writing {len(pending)} analyses failed, writing them one by one: {e}")
+            written = 0
+            for item in pending:
+                try:
+                    write_analyses([item])
+                    written += 1
+                except Exception:
+                    logger.exception(f"Saving the analysis of conversation {item[0].id} failed")
+        self.written += written
+        return written
@@ -0,0 +1,269 @@
+"""
+Many concurrent slow clients against the WSGI and the ASGI paths
+
+    python -m benchmarks.bench_async --clients 500 --client-delay 0.5
+    python -m benchmarks.bench_async --compare baseline.json
+
+Each client sends its request body --client-delay seconds after
+connecting (a slow network), then waits for the response. Three
+deployments are compared, driven in-process without sockets:
+
+- wsgi: the sync endpoints (/api/...) on --threads worker threads, like a
+  threaded WSGI server; a thread is held while its client is slow
+- asgi-sync: the same sync endpoints under the ASGI handler, where every
+  sync view runs on Django's single sync thread
+- asgi-async: the async endpoints (/api/async/...) on one event loop, the
+  analyzer running on ANALYSIS_ASYNC_THREADS threads
+
+Runs use a throwaway SQLite file (or the configured database server), so
+the WSGI and analysis threads really work concurrently.
+"""
+import argparse
+import asyncio
+import io
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from .common import setup_django
+from .generator import ConversationGenerator
+from .results import compare_results, load_results, print_comparison, write_results
+
+
+def wsgi_call(app, method, path, body, delay):
+    """
+    Returns: (status code, response body)
+    """
+    # The worker thread is held while the slow client sends its request
+    time.sleep(delay)
+    path, _, query = path.partition('?')
+    environ = {
+        'REQUEST_METHOD': method,
+        'PATH_INFO': path,
+        'QUERY_STRING': query,
+        'SERVER_NAME': 'testserver',
+        'SERVER_PORT': '80',
+        'SERVER_PROTOCOL': 'HTTP/1.1',
+        'HTTP_HOST': 'testserver',
+        'CONTENT_TYPE': 'application/json',
+        'CONTENT_LENGTH': str(len(body)),
+        'wsgi.input': io.BytesIO(body),
+        'wsgi.errors': sys.stderr,
+        'wsgi.url_scheme': 'http',
+        'wsgi.version': (1, 0),
+        'wsgi.multithread': True,
+        'wsgi.multiprocess': False,
+        'wsgi.run_once': False,
+    }
+    started = []
+    response = app(environ, lambda status, headers, exc_info=None: started.append(status))
+    try:
+        content = b''.join(response)
+    finally:
+        response.close()
+    return int(started[0].split()[0]), content
+
+
+async def asgi_call(app, method, path, body, delay):
+    """
+    Returns: (status code, response body)
+    """
+    path, _, query = path.partition('?')
+    scope = {
+        'type': 'http',
+        'asgi': {'version': '3.0'},
+        'http_version': '1.1',
+        'method': method,
+        'scheme': 'http',
+        'path': path,
+        'raw_path': path.encode(),
+        'query_string': query.encode(),
+        'headers': [
+            (b'host', b'testserver'),
+            (b'content-type', b'application/json'),
+            (b'content-length', str(len(body)).encode()),
+        ],
+        'client': ('127.0.0.1', 50000),
+        'server': ('testserver', 80),
+    }
+    received = False
+    response = {'status': None, 'body': b''}
+
+    async def receive():
+        nonlocal received
+        if received:
+            # Nothing more to send; the client never disconnects
+            await asyncio.Event().wait()
+        await asyncio.sleep(delay)
+        received = True
+        return {'type': 'http.request', 'body': body, 'more_body': False}
+
+    async def send(message):
+        if message['type'] == 'http.response.start':
+            response['status'] = message['status']
+        elif message['type'] == 'http.response.body':
+            response['body'] += message.get('body', b'')
+
+    await app(scope, receive, send)
+    return response['status'], response['body']
+
+
+def scenario_requests(scenario, generator, conversation_ids, prefix, count, turns):
+    """
+    (method, path, body) of each client's request
+    """
+    requests = []
+    for index in range(count):
+        if scenario == 'upload':
+            body = json.dumps(generator.payload(index, turns)).encode()
+            requests.append(('POST', f'/api/{prefix}conversations/', body))
+        elif scenario == 'analyse':
+            body = json.dumps({'conversation_id': conversation_ids[index % len(conversation_ids)]}).encode()
+            requests.append(('POST', f'/api/{prefix}analyse/', body))
+        else:
+            requests.append(('GET', f'/api/{prefix}reports/?limit=20', b''))
+    return requests
+
+
+def summarize(latencies, seconds):
+    latencies = sorted(latencies)
+    return {
+        'p50_ms': statistics.median(latencies) * 1000,
+        'p95_ms': latencies[min(len(latencies) - 1, int(len(latencies) * 0.95))] * 1000,
+        'max_ms': latencies[-1] * 1000,
+        'wall_s': seconds,
+        'requests_per_s': len(latencies) / seconds,
+        'requests': len(latencies),
+    }
+
+
+def run_wsgi(requests, delay, threads):
+    from django.core.wsgi import get_wsgi_application
+
+    app = get_wsgi_application()
+    latencies = []
+    # Clients all connect at once, so latency counts from the start,
+    # including the wait for a free worker thread
+    start = time.perf_counter()
+
+    def client(request):
+        code, content = wsgi_call(app, *request, delay)
+        assert code < 300, (code, content[:200])
+        latencies.append(time.perf_counter() - start)
+
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        list(executor.map(client, requests))
+    return summarize(latencies, time.perf_counter() - start)
+
+
+def run_asgi(requests, delay):
+    from django.core.asgi import get_asgi_application
+
+    app = get_asgi_application()
+    latencies = []
+    start = time.perf_counter()
+
+    async def client(request):
+        code, content = await asgi_call(app, *request, delay)
+        assert code < 300, (code, content[:200])
+        latencies.append(time.perf_counter() - start)
+
+    async def main():
+        await asyncio.gather(*(client(request) for request in requests))
+
+    asyncio.run(main())
+    return summarize(latencies, time.perf_counter() - start)
+
+
+def use_database_file(path):
+    """
+    Point the test database at a file, so threads share it (the default
+    in-memory SQLite test database is per connection)
+    """
+    from django.conf import settings
+
+    database = settings.DATABASES['default']
+    if database['ENGINE'].endswith('sqlite3'):
+        database.setdefault('TEST', {})['NAME'] = path
+        database.setdefault('OPTIONS', {})['timeout'] = 60
+
+
+def print_results(results):
+    for name, stats in results.items():
+        print(
+            f'  {name:32s} p50 {stats["p50_ms"]:9.1f}ms  p95 {stats["p95_ms"]:9.1f}ms  '
+            f'wall {stats["wall_s"]:7.2f}s  {stats["requests_per_s"]:8.1f} req/s'
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--clients', type=int, default=200, help='Concurrent clients per run')
+    parser.add_argument('--client-delay', type=float, default=0.5, help='Seconds before each request body arrives')
+    parser.add_argument('--threads', type=int, default=8, help='WSGI worker threads')
+    parser.add_argument('--scenarios', nargs='+', default=['upload', 'reports', 'analyse'],
+                        choices=['upload', 'reports', 'analyse'])
+    parser.add_argument('--modes', nargs='+', default=['wsgi', 'asgi-sync', 'asgi-async'],
+                        choices=['wsgi', 'asgi-sync', 'asgi-async'])
+    parser.add_argument('--turns', type=int, default=20, help='Messages per uploaded or analysed conversation')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default='benchmark-results-async.json')
+    parser.add_argument('--compare', help='Baseline results file to flag regressions against')
+    parser.add_argument('--threshold', type=float, default=0.1, help='Allowed slowdown, 0.1 = 10%%')
+    args = parser.parse_args()
+
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'conversation_analyzer.settings')
+    import django
+    django.setup()
+    directory = tempfile.TemporaryDirectory()
+    use_database_file(os.path.join(directory.name, 'bench.sqlite3'))
+    teardown = setup_django()
+    results = {}
+    try:
+        from django.db import connection
+
+        from analysis.ingestion import ingest_conversations
+
+        if connection.vendor == 'sqlite':
+            connection.cursor().execute('PRAGMA journal_mode=WAL')
+        generator = ConversationGenerator(seed=args.seed)
+        created = ingest_conversations(generator.payloads(args.clients, args.turns))
+        conversation_ids = [item['id'] for item in created['results']]
+        # Committed before other threads read it
+        connection.close()
+
+        for scenario in args.scenarios:
+            for mode in args.modes:
+                prefix = 'async/' if mode == 'asgi-async' else ''
+                requests = scenario_requests(scenario, generator, conversation_ids, prefix, args.clients, args.turns)
+                if scenario == 'analyse':
+                    # Every mode analyses from scratch
+                    from analysis.models import ConversationAnalysis
+                    ConversationAnalysis.objects.all().delete()
+                    connection.close()
+                if mode == 'wsgi':
+                    stats = run_wsgi(requests, args.client_delay, args.threads)
+                else:
+                    stats = run_asgi(requests, args.client_delay)
+                results[f'concurrency/{scenario}/{mode}'] = stats
+                print_results({f'concurrency/{scenario}/{mode}': stats})
+
+        write_results(args.output, results, args)
+    finally:
+        teardown()
+        directory.cleanup()
+
+    print(f'Results written to {args.output}')
+
+    if args.compare:
+        rows = compare_results(load_results(args.compare), results, args.threshold)
+        if print_comparison(rows):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
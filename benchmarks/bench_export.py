@@ -0,0 +1,91 @@
+"""
+Throughput and memory of the streaming analysis export
+
+    python -m benchmarks.bench_export --rows 1000000
+
+Seeds --rows analyses (see bench_report_queries.seed) and exports all of
+them with AnalysisExport in every available format, plain and gzipped,
+discarding the output. Reports rows/s, output size and how much the
+peak RSS of the process grew, which stays flat however many rows there
+are. For comparison, streams --baseline-rows rows the way
+/api/reports/?format=ndjson does, through AnalysisSerializer.
+"""
+import argparse
+import json
+import resource
+import time
+
+from .common import setup_django
+
+
+def peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def export(**options):
+    """
+    Returns: (rows, bytes, seconds, peak RSS growth in MB)
+    """
+    from analysis.export import AnalysisExport
+
+    rss = peak_rss_mb()
+    start = time.perf_counter()
+    result = AnalysisExport(**options)
+    size = sum(len(data) for data in result)
+    return result.rows, size, time.perf_counter() - start, peak_rss_mb() - rss
+
+
+def serializer_baseline(rows):
+    """
+    Returns: seconds to render rows analyses through AnalysisSerializer
+    """
+    from analysis.serializers import AnalysisSerializer
+    from analysis.views import report_queryset
+
+    start = time.perf_counter()
+    for analysis in report_queryset().order_by('created_at', 'id')[:rows].iterator(chunk_size=2000):
+        json.dumps(AnalysisSerializer(analysis).data)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=1000000)
+    parser.add_argument('--baseline-rows', type=int, default=50000)
+    parser.add_argument('--chunk-size', type=int, default=None)
+    args = parser.parse_args()
+
+    teardown = setup_django()
+    try:
+        from analysis.export import FORMATS, parquet_schema
+
+        from .bench_report_queries import seed
+
+        # Every seeded conversation gets an analysis
+        seed(args.rows, 0)
+
+        formats = list(FORMATS)
+        try:
+            parquet_schema()
+        except ValueError as e:
+            print(f'  skipping parquet: {e}')
+            formats.remove('parquet')
+
+        for format in formats:
+            for compress in (False, True):
+                rows, size, seconds, rss = export(format=format, gzip=compress, chunk_size=args.chunk_size)
+                label = f"{format}{' gzip' if compress else ''}"
+                print(
+                    f'  {label:13s} {rows} rows  {rows / seconds:9.0f} rows/s  '
+                    f'{size / 1e6:8.1f}MB  peak RSS +{rss:.1f}MB'
+                )
+
+        baseline = min(args.baseline_rows, args.rows)
+        seconds = serializer_baseline(baseline)
+        print(f'  {"serializer":13s} {baseline} rows  {baseline / seconds:9.0f} rows/s')
+    finally:
+        teardown()
+
+
+if __name__ == '__main__':
+    main()
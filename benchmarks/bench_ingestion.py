@@ -0,0 +1,67 @@
+"""
+Compare per-row conversation ingestion with the bulk ingestion path
+
+    python -m benchmarks.bench_ingestion --conversations 500 --turns 40
+"""
+import argparse
+
+from .common import make_conversation_payload, setup_django, timer
+
+
+def ingest_per_row(payloads):
+    """
+    The original ingestion path: one INSERT per conversation and per message
+    """
+    from analysis.models import Conversation, Message
+
+    for payload in payloads:
+        conversation = Conversation.objects.create(title=payload['title'])
+        for message_data in payload['messages']:
+            Message.objects.create(conversation=conversation, **message_data)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--conversations', type=int, default=500)
+    parser.add_argument('--turns', type=int, default=40)
+    args = parser.parse_args()
+
+    teardown = setup_django()
+    try:
+        from django.db import connection
+        from django.test.utils import CaptureQueriesContext
+
+        from analysis.ingestion import ingest_conversations
+        from analysis.models import Conversation
+
+        payloads = [
+            make_conversation_payload(index, args.turns)
+            for index in range(args.conversations)
+        ]
+        timings = {}
+        queries = {}
+
+        with CaptureQueriesContext(connection) as captured, timer(timings, 'per_row'):
+            ingest_per_row(payloads)
+        queries['per_row'] = len(captured)
+        Conversation.objects.all().delete()
+
+        with CaptureQueriesContext(connection) as captured, timer(timings, 'bulk'):
+            result = ingest_conversations(payloads)
+        queries['bulk'] = len(captured)
+        assert result['created'] == args.conversations, result['failed']
+
+        messages = args.conversations * args.turns
+        print(f'{args.conversations} conversations x {args.turns} turns ({messages} messages)')
+        for key in ('per_row', 'bulk'):
+            print(
+                f'  {key:8s} {timings[key]:8.3f}s  '
+                f'{messages / timings[key]:10.0f} msg/s  {queries[key]:7d} queries'
+            )
+        print(f'  speedup  {timings["per_row"] / timings["bulk"]:.1f}x')
+    finally:
+        teardown()
+
+
+if __name__ == '__main__':
+    main()
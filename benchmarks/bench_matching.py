@@ -0,0 +1,99 @@
+"""
+Compare per-keyword substring scans with the precompiled KeywordMatcher
+
+    python -m benchmarks.bench_matching --messages 2000
+"""
+import argparse
+import random
+import time
+
+from analysis.matching import KeywordMatcher
+from analysis.services import DEFAULT_LEXICONS
+
+
+WORDS = (
+    'order refund account password reset delivery package late broken '
+    'thanks sorry help please still not working understand issue charge '
+    'card subscription cancel upgrade plan error login email update glad'
+).split()
+
+
+def make_phrases(count, rng):
+    """
+    Lexicon phrases: mostly rare made-up words, a few common ones, so
+    that like real lexicons most messages match nothing
+    """
+    phrases = set()
+    while len(phrases) < count:
+        words = [
+            rng.choice(WORDS) if rng.random() < 0.2
+            else ''.join(rng.choice('abcdefghijklmnopqrstuvwxyz') for _ in range(rng.randint(4, 9)))
+            for _ in range(rng.randint(1, 3))
+        ]
+        phrases.add(' '.join(words))
+    return sorted(phrases)
+
+
+def make_messages(count, rng):
+    return [
+        ' '.join(rng.choice(WORDS) for _ in range(rng.randint(3, 40))).lower()
+        for _ in range(count)
+    ]
+
+
+def scan(phrases, messages):
+    return [any(phrase in message for phrase in phrases) for message in messages]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--messages', type=int, default=2000)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10, 100, 10000])
+    args = parser.parse_args()
+
+    rng = random.Random(42)
+    messages = make_messages(args.messages, rng)
+
+    print(f'{args.messages} messages')
+
+    matcher = KeywordMatcher(DEFAULT_LEXICONS)
+    start = time.perf_counter()
+    expected = [
+        {name for name, phrases in DEFAULT_LEXICONS.items() if any(phrase in message for phrase in phrases)}
+        for message in messages
+    ]
+    scan_time = time.perf_counter() - start
+    start = time.perf_counter()
+    found = matcher.match_many(messages)
+    match_time = time.perf_counter() - start
+    assert found == expected
+    print(
+        f'  default lexicons ({matcher.phrase_count} phrases, 3 scans vs 1)  '
+        f'scan {scan_time * 1e6 / args.messages:.1f}us/msg  '
+        f'matcher {match_time * 1e6 / args.messages:.1f}us/msg  speedup {scan_time / match_time:.1f}x'
+    )
+    for size in args.sizes:
+        phrases = make_phrases(size, rng)
+
+        start = time.perf_counter()
+        matcher = KeywordMatcher({'lexicon': phrases}, scan_threshold=0)
+        build = time.perf_counter() - start
+
+        start = time.perf_counter()
+        expected = scan(phrases, messages)
+        scan_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        found = ['lexicon' in hits for hits in matcher.match_many(messages)]
+        match_time = time.perf_counter() - start
+
+        assert found == expected
+        print(
+            f'  {size:6d} phrases  scan {scan_time * 1e6 / args.messages:9.1f}us/msg  '
+            f'regex {match_time * 1e6 / args.messages:7.1f}us/msg  '
+            f'(build {build * 1000:.1f}ms)  speedup {scan_time / match_time:.1f}x'
+        )
+
+
+if __name__ == '__main__':
+    main()
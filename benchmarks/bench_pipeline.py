@@ -0,0 +1,211 @@
+"""
+Throughput of the analysis pipeline per metric and conversation size, and
+end-to-end upload -> analyse -> reports latency through the test client
+
+    python -m benchmarks.bench_pipeline --sizes 4 20 100 --output latest.json
+    python -m benchmarks.bench_pipeline --compare baseline.json
+
+Conversations come from the synthetic generator (benchmarks/generator.py),
+so runs with the same arguments analyze the same text. Results are
+written as JSON; with --compare, measurements more than --threshold
+slower than in the baseline are flagged and the exit status is 1.
+"""
+import argparse
+import json
+import statistics
+import sys
+import time
+
+from .common import setup_django
+from .generator import ConversationGenerator
+from .results import compare_results, load_results, print_comparison, write_results
+
+
+def median_time(run, repeat, before=None):
+    """
+    Median wall time of run() over repeat runs, calling before() first each time
+    """
+    samples = []
+    for _ in range(repeat):
+        if before:
+            before()
+        start = time.perf_counter()
+        run()
+        samples.append(time.perf_counter() - start)
+    return statistics.median(samples)
+
+
+def throughput(seconds, conversations, turns):
+    return {
+        'us_per_conversation': seconds * 1e6 / conversations,
+        'conversations_per_s': conversations / seconds,
+        'messages_per_s': conversations * turns / seconds,
+    }
+
+
+def load_conversations(generator, count, turns):
+    from analysis.ingestion import ingest_conversations
+    from analysis.models import Conversation
+
+    result = ingest_conversations(generator.payloads(count, turns))
+    ids = [item['id'] for item in result['results']]
+    # Analyzed in memory: the database is not part of these numbers
+    return list(Conversation.objects.filter(id__in=ids).prefetch_related('messages'))
+
+
+def bench_analyzer(args, generator, results):
+    """
+    Per conversation size: the per-conversation paths (metric by metric
+    and with a running state), analyze_batch, and folding two appended
+    messages into a stored state
+    """
+    from analysis.cache import get_sentiment_cache
+    from analysis.metrics import registry
+    from analysis.services import ConversationAnalyzer
+
+    analyzer = ConversationAnalyzer(metrics=registry.names())
+    cache = get_sentiment_cache()
+    cold_cache = None if args.warm_cache else cache.clear
+
+    for turns in args.sizes:
+        conversations = load_conversations(generator, args.conversations, turns)
+        count = len(conversations)
+        size = f'{turns} turns'
+
+        registry.reset_stats()
+        seconds = median_time(
+            lambda: [analyzer.analyze_conversation(c) for c in conversations],
+            args.repeat, cold_cache
+        )
+        results[f'analyzer/metrics/{size}'] = throughput(seconds, count, turns)
+        for name, stats in registry.stats().items():
+            results[f'metric/{name}/{size}'] = {
+                'us_per_conversation': stats['seconds'] * 1e6 / stats['calls'],
+                'share': stats['seconds'] / (seconds * args.repeat),
+            }
+
+        seconds = median_time(
+            lambda: [analyzer.analyze_conversation(c, return_state=True) for c in conversations],
+            args.repeat, cold_cache
+        )
+        results[f'analyzer/state/{size}'] = throughput(seconds, count, turns)
+
+        seconds = median_time(
+            lambda: analyzer.analyze_batch(conversations, return_state=True),
+            args.repeat, cold_cache
+        )
+        results[f'analyzer/batch/{size}'] = throughput(seconds, count, turns)
+
+        if turns > 2:
+            prefixes = []
+            for conversation in conversations:
+                messages = list(conversation.messages.all())
+                state = analyzer.extend_state(analyzer.new_state(), messages[:-2])
+                prefixes.append((state, messages[-2:]))
+            seconds = median_time(
+                lambda: [
+                    analyzer.analyze_state(analyzer.extend_state(state, appended))
+                    for state, appended in prefixes
+                ],
+                args.repeat, cold_cache
+            )
+            results[f'analyzer/append 2/{size}'] = throughput(seconds, count, 2)
+
+
+def percentiles(samples):
+    samples = sorted(samples)
+    return {
+        'p50_ms': statistics.median(samples) * 1000,
+        'p95_ms': samples[min(len(samples) - 1, int(len(samples) * 0.95))] * 1000,
+        'mean_ms': statistics.fmean(samples) * 1000,
+        'requests': len(samples),
+    }
+
+
+def bench_api(args, generator, results):
+    """
+    Latency of each step of the upload -> analyse -> reports flow, as a
+    client sees it (routing, serialization and database included)
+    """
+    from django.test import Client
+
+    client = Client()
+    timings = {'upload': [], 'analyse': [], 'reports': []}
+
+    def timed(step, call):
+        start = time.perf_counter()
+        response = call()
+        timings[step].append(time.perf_counter() - start)
+        assert response.status_code < 300, (step, response.status_code, response.content[:200])
+        return response
+
+    for index in range(args.requests):
+        payload = json.dumps(generator.payload(index, args.api_turns))
+        response = timed('upload', lambda: client.post(
+            '/api/conversations/', payload, content_type='application/json'
+        ))
+        analyse = json.dumps({'conversation_id': response.json()['id']})
+        timed('analyse', lambda: client.post('/api/analyse/', analyse, content_type='application/json'))
+        timed('reports', lambda: client.get('/api/reports/'))
+
+    for step, samples in timings.items():
+        results[f'api/{step}/{args.api_turns} turns'] = percentiles(samples)
+
+
+def print_results(results):
+    for name, stats in results.items():
+        if 'us_per_conversation' in stats and 'messages_per_s' in stats:
+            print(
+                f'  {name:35s} {stats["us_per_conversation"]:10.1f}us/conversation  '
+                f'{stats["conversations_per_s"]:9.0f} conv/s  {stats["messages_per_s"]:10.0f} msg/s'
+            )
+        elif 'us_per_conversation' in stats:
+            print(f'  {name:35s} {stats["us_per_conversation"]:10.1f}us/conversation  {stats["share"]:6.1%}')
+        else:
+            print(
+                f'  {name:35s} p50 {stats["p50_ms"]:8.2f}ms  p95 {stats["p95_ms"]:8.2f}ms  '
+                f'mean {stats["mean_ms"]:8.2f}ms'
+            )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[4, 20, 100], help='Turns per conversation')
+    parser.add_argument('--conversations', type=int, default=200, help='Conversations per size')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--words', type=float, default=12, help='Median words per message')
+    parser.add_argument('--words-sigma', type=float, default=0.8, help='Log-normal spread of message length')
+    parser.add_argument('--vocabulary', type=int, default=5000)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--warm-cache', action='store_true', help='Keep sentiment cache hits between repeats')
+    parser.add_argument('--requests', type=int, default=100, help='End-to-end iterations')
+    parser.add_argument('--api-turns', type=int, default=20)
+    parser.add_argument('--output', default='benchmark-results.json')
+    parser.add_argument('--compare', help='Baseline results file to flag regressions against')
+    parser.add_argument('--threshold', type=float, default=0.1, help='Allowed slowdown, 0.1 = 10%%')
+    args = parser.parse_args()
+
+    teardown = setup_django()
+    try:
+        generator = ConversationGenerator(
+            seed=args.seed, words_mean=args.words, words_sigma=args.words_sigma,
+            vocabulary=args.vocabulary
+        )
+        results = {}
+        bench_analyzer(args, generator, results)
+        bench_api(args, generator, results)
+        write_results(args.output, results, args)
+    finally:
+        teardown()
+
+    print_results(results)
+    print(f'Results written to {args.output}')
+
+    if args.compare:
+        rows = compare_results(load_results(args.compare), results, args.threshold)
+        if print_comparison(rows):
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,138 @@
+"""
+Seed a large dataset and compare query plans and latencies of the report,
+message and nightly-scan queries without and with the model indexes
+
+    python -m benchmarks.bench_report_queries --conversations 1000000
+
+Runs against the configured database engine (a throwaway test database).
+"""
+import argparse
+import random
+import statistics
+import time
+from datetime import timedelta
+
+from .common import setup_django
+
+
+def seed(conversations, messages_per_conversation, batch_size=10000):
+    from django.db import transaction
+    from django.utils import timezone
+
+    from analysis.models import Conversation, ConversationAnalysis, Message
+
+    rng = random.Random(0)
+    start = timezone.now() - timedelta(days=365)
+    sentiments = ['positive', 'neutral', 'negative']
+
+    for offset in range(0, conversations, batch_size):
+        count = min(batch_size, conversations - offset)
+        with transaction.atomic():
+            created = Conversation.objects.bulk_create([
+                Conversation(
+                    title=f'Conversation {offset + i}',
+                    analyzed=rng.random() < 0.9,
+                )
+                for i in range(count)
+            ])
+            Message.objects.bulk_create([
+                Message(conversation=conversation, sender='user' if turn % 2 == 0 else 'ai', text=f'Message {turn}')
+                for conversation in created
+                for turn in range(messages_per_conversation)
+            ], batch_size=batch_size)
+            ConversationAnalysis.objects.bulk_create([
+                ConversationAnalysis(
+                    conversation=conversation,
+                    sentiment=rng.choice(sentiments),
+                    resolution=rng.random() < 0.6,
+                    overall_score=rng.random(),
+                )
+                for conversation in created
+                if conversation.analyzed
+            ], batch_size=batch_size)
+
+        # created_at is auto_now_add; spread it over a year afterwards
+        ids = [conversation.id for conversation in created]
+        ConversationAnalysis.objects.filter(conversation_id__in=ids).update(
+            created_at=start + timedelta(seconds=offset * 30)
+        )
+        print(f'  seeded {offset + count}/{conversations}', end='\r', flush=True)
+    print()
+
+
+def queries():
+    from analysis.models import Conversation, ConversationAnalysis, Message
+    from analysis.pagination import keyset_filter, encode_cursor
+    from analysis.views import report_queryset
+
+    middle = ConversationAnalysis.objects.order_by('-created_at', '-id')[
+        ConversationAnalysis.objects.count() // 2
+    ]
+    conversation_id = Conversation.objects.order_by('-id').values_list('id', flat=True).first()
+
+    return {
+        'reports page': keyset_filter(report_queryset(), None)[:100],
+        'reports deep page': keyset_filter(report_queryset(), encode_cursor(middle))[:100],
+        'reports filtered': keyset_filter(
+            report_queryset().filter(sentiment='negative', resolution=False), None
+        )[:100],
+        'reports by resolution': keyset_filter(report_queryset().filter(resolution=True), None)[:100],
+        'conversation messages': Message.objects.filter(conversation_id=conversation_id),
+        'unanalyzed ids': Conversation.objects.filter(analyzed=False).order_by('id').values_list('id', flat=True)[:1000],
+    }
+
+
+def measure(repeat):
+    results = {}
+    for name, queryset in queries().items():
+        plan = queryset.explain()
+        samples = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            list(queryset.all())
+            samples.append(time.perf_counter() - start)
+        results[name] = (statistics.median(samples) * 1000, plan)
+    return results
+
+
+def set_indexes(enabled):
+    from django.db import connection
+
+    from analysis.models import Conversation, ConversationAnalysis, Message
+
+    with connection.schema_editor() as editor:
+        for model in (Conversation, Message, ConversationAnalysis):
+            for index in model._meta.indexes:
+                if enabled:
+                    editor.add_index(model, index)
+                else:
+                    editor.remove_index(model, index)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--conversations', type=int, default=100000)
+    parser.add_argument('--messages', type=int, default=4, help='Messages per conversation')
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    teardown = setup_django()
+    try:
+        print(f'Seeding {args.conversations} conversations')
+        seed(args.conversations, args.messages)
+
+        set_indexes(False)
+        before = measure(args.repeat)
+        set_indexes(True)
+        after = measure(args.repeat)
+
+        for name in before:
+            print(f'\n{name}: {before[name][0]:.2f}ms -> {after[name][0]:.2f}ms')
+            print(f'  before: {before[name][1]}'.replace('\n', '\n          '))
+            print(f'  after:  {after[name][1]}'.replace('\n', '\n          '))
+    finally:
+        teardown()
+
+
+if __name__ == '__main__':
+    main()
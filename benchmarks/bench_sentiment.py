@@ -0,0 +1,69 @@
+"""
+Compare NLTK's VADER with the precompiled SentimentEngine
+
+    python -m benchmarks.bench_sentiment --messages 20000
+
+Scores synthetic user messages (see benchmarks/generator.py) with
+SentimentIntensityAnalyzer.polarity_scores and SentimentEngine.score_many,
+checks that every compound score matches, and reports the time per
+message and the cost of loading each.
+"""
+import argparse
+import os
+import tempfile
+import time
+
+import django
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--messages', type=int, default=20000)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--sentiment-rate', type=float, default=0.15, help='Share of sentiment words')
+    args = parser.parse_args()
+
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'conversation_analyzer.settings')
+    django.setup()
+
+    from nltk.sentiment.vader import SentimentIntensityAnalyzer
+
+    from analysis.sentiment import SentimentEngine
+
+    from .generator import ConversationGenerator
+
+    generator = ConversationGenerator(seed=args.seed, sentiment_rate=args.sentiment_rate)
+    # Distinct texts, so neither side profits from repeats
+    texts = list(dict.fromkeys(generator.text() for _ in range(args.messages)))
+
+    start = time.perf_counter()
+    analyzer = SentimentIntensityAnalyzer()
+    nltk_load = time.perf_counter() - start
+    engine = SentimentEngine.from_nltk()
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'sentiment_engine.marshal')
+        engine.save(path)
+        start = time.perf_counter()
+        SentimentEngine.load(path)
+        engine_load = time.perf_counter() - start
+
+    start = time.perf_counter()
+    expected = [analyzer.polarity_scores(text)['compound'] for text in texts]
+    nltk_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    scores = engine.score_many(texts)
+    engine_time = time.perf_counter() - start
+
+    worst = max(abs(score - reference) for score, reference in zip(scores, expected))
+    print(f'{len(texts)} messages, largest difference from NLTK {worst:g}')
+    print(f'  load   nltk {nltk_load * 1000:7.1f}ms     compiled {engine_load * 1000:7.1f}ms')
+    print(
+        f'  score  nltk {nltk_time * 1e6 / len(texts):7.1f}us/msg  '
+        f'engine {engine_time * 1e6 / len(texts):7.1f}us/msg  speedup {nltk_time / engine_time:.1f}x'
+    )
+    assert worst <= 1e-6
+
+
+if __name__ == '__main__':
+    main()
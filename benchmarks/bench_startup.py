@@ -0,0 +1,77 @@
+"""
+Cold-start and per-request cost of creating a ConversationAnalyzer
+
+Before the shared analyzer every request built its own
+SentimentIntensityAnalyzer, re-parsing the VADER lexicon from disk. The
+compiled sentiment tables (SENTIMENT_ENGINE_FILE) load without importing
+NLTK at all; they are compiled first (manage.py compile_sentiment) if
+the file is missing.
+
+    python -m benchmarks.bench_startup --requests 50
+"""
+import argparse
+import io
+import os
+import statistics
+import time
+
+from .common import make_conversation_payload, setup_django
+
+
+def per_request(analyze, requests):
+    samples = []
+    for _ in range(requests):
+        start = time.perf_counter()
+        analyze()
+        samples.append(time.perf_counter() - start)
+    return statistics.median(samples) * 1000, max(samples) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--requests', type=int, default=50)
+    parser.add_argument('--turns', type=int, default=10)
+    args = parser.parse_args()
+
+    teardown = setup_django()
+    try:
+        from django.conf import settings
+        from django.core.management import call_command
+
+        from analysis.ingestion import ingest_conversations
+        from analysis.models import Conversation
+        from analysis.sentiment import SentimentEngine, load_sentiment_engine
+        from analysis.services import ConversationAnalyzer
+
+        result = ingest_conversations([make_conversation_payload(0, args.turns)])
+        conversation = Conversation.objects.prefetch_related('messages').get(id=result['results'][0]['id'])
+
+        start = time.perf_counter()
+        SentimentEngine.from_nltk()
+        cold = (time.perf_counter() - start) * 1000
+        if not os.path.exists(settings.SENTIMENT_ENGINE_FILE):
+            call_command('compile_sentiment', stdout=io.StringIO())
+        start = time.perf_counter()
+        load_sentiment_engine()
+        compiled = (time.perf_counter() - start) * 1000
+
+        def analyze_unshared():
+            analyzer = ConversationAnalyzer()
+            analyzer.sentiment_engine = SentimentEngine.from_nltk()
+            analyzer.analyze_conversation(conversation)
+
+        def analyze_shared():
+            ConversationAnalyzer().analyze_conversation(conversation)
+
+        print(f'lexicon load from NLTK (cold start, once per process): {cold:.1f}ms')
+        print(f'compiled lexicon load ({settings.SENTIMENT_ENGINE_FILE}): {compiled:.1f}ms')
+        print(f'per request, {args.turns}-turn conversation, median / max over {args.requests}:')
+        for label, analyze in (('new analyzer per request', analyze_unshared), ('shared analyzer', analyze_shared)):
+            median, worst = per_request(analyze, args.requests)
+            print(f'  {label:26s} {median:7.2f}ms / {worst:7.2f}ms')
+    finally:
+        teardown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,148 @@
+"""
+Storage and analysis cost of message texts, inline or content-addressed
+
+    python -m benchmarks.bench_texts --conversations 2000 --template-rate 0.4
+
+Stores the same synthetic conversations twice, with MESSAGE_TEXT_DEDUP
+off and on. --template-rate is the share of messages that repeat one of
+--templates canned texts of --template-words median words, like a bot's
+templated replies.
+Reports the bytes of text stored, the database size (SQLite), the upload
+time, and the time to load every conversation with its messages and to
+analyze them with ConversationAnalyzer.analyze_batch, whose results must
+be identical either way. (analyze_batch works per distinct text in both
+cases; dedup only saves hashing texts that share one string object.)
+"""
+import argparse
+import time
+
+from .common import setup_django
+from .generator import ConversationGenerator
+
+
+# Size of the hash referencing a MessageText
+HASH_BYTES = 32
+
+
+def text_bytes():
+    """
+    Returns: (bytes of inline message texts, bytes of MessageText rows
+    including the hashes referencing them)
+    """
+    from analysis.models import Message, MessageText
+
+    inline = sum(len(text.encode('utf-8')) for text in Message.objects.values_list('text', flat=True).iterator())
+    stored = 0
+    for text, compressed in MessageText.objects.values_list('text', 'compressed').iterator():
+        stored += HASH_BYTES + len(text.encode('utf-8')) + len(compressed or b'')
+    stored += HASH_BYTES * Message.objects.filter(stored_text__isnull=False).count()
+    return inline, stored
+
+
+def database_bytes():
+    from django.db import connection
+
+    if connection.vendor != 'sqlite':
+        return None
+    with connection.cursor() as cursor:
+        cursor.execute('VACUUM')
+        cursor.execute('PRAGMA page_count')
+        pages = cursor.fetchone()[0]
+        cursor.execute('PRAGMA page_size')
+        return pages * cursor.fetchone()[0]
+
+
+def run(payloads, chunk):
+    """
+    Returns: (stats, analyses)
+    """
+    from analysis.cache import get_sentiment_cache
+    from analysis.ingestion import ingest_conversations
+    from analysis.models import Conversation, MessageText
+    from analysis.services import ConversationAnalyzer
+    from analysis.texts import get_text_cache
+
+    Conversation.objects.all().delete()
+    MessageText.objects.all().delete()
+    get_text_cache().clear()
+
+    stats = {}
+    start = time.perf_counter()
+    ingest_conversations(payloads)
+    stats['upload_s'] = time.perf_counter() - start
+    stats['inline_bytes'], stats['stored_bytes'] = text_bytes()
+    stats['database_bytes'] = database_bytes()
+    stats['distinct_texts'] = MessageText.objects.count()
+
+    # Cold: every stored text is read from the database and scored once
+    get_text_cache().clear()
+    get_sentiment_cache().clear()
+    analyzer = ConversationAnalyzer()
+    ids = list(Conversation.objects.order_by('id').values_list('id', flat=True))
+    analyses = []
+    stats['load_s'] = stats['analyze_s'] = 0.0
+    for offset in range(0, len(ids), chunk):
+        start = time.perf_counter()
+        conversations = list(
+            Conversation.objects.filter(id__in=ids[offset:offset + chunk])
+            .order_by('id').prefetch_related('messages')
+        )
+        stats['load_s'] += time.perf_counter() - start
+        start = time.perf_counter()
+        analyses.extend(analyzer.analyze_batch(conversations))
+        stats['analyze_s'] += time.perf_counter() - start
+    return stats, analyses
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--conversations', type=int, default=2000)
+    parser.add_argument('--turns', type=int, default=20)
+    parser.add_argument('--template-rate', type=float, default=0.4, help='Share of messages repeating a canned text')
+    parser.add_argument('--templates', type=int, default=200, help='Number of canned texts')
+    parser.add_argument('--template-words', type=float, default=40, help='Median words of a canned text')
+    parser.add_argument('--chunk', type=int, default=500, help='Conversations loaded and analyzed at once')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    teardown = setup_django()
+    try:
+        from django.test import override_settings
+
+        generator = ConversationGenerator(
+            seed=args.seed, template_rate=args.template_rate, templates=args.templates,
+            template_words=args.template_words
+        )
+        payloads = generator.payloads(args.conversations, args.turns)
+        messages = sum(len(payload['messages']) for payload in payloads)
+        distinct = len({message['text'] for payload in payloads for message in payload['messages']})
+        print(f'{args.conversations} conversations, {messages} messages, {distinct} distinct texts '
+              f'({1 - distinct / messages:.0%} duplicates)')
+
+        results = {}
+        for dedup in (False, True):
+            with override_settings(MESSAGE_TEXT_DEDUP=dedup):
+                results[dedup] = run(payloads, args.chunk)
+
+        for dedup, (stats, _) in results.items():
+            label = 'content-addressed' if dedup else 'inline'
+            database = stats['database_bytes']
+            database = f'{database / 1e6:7.2f}MB' if database is not None else '      -'
+            print(
+                f'  {label:18s} text {(stats["inline_bytes"] + stats["stored_bytes"]) / 1e6:7.2f}MB  '
+                f'database {database}  upload {stats["upload_s"]:6.2f}s  '
+                f'load {stats["load_s"]:6.2f}s  analyze {stats["analyze_s"]:6.2f}s'
+            )
+        inline, stored = results[False][0], results[True][0]
+        saved = 1 - (stored['inline_bytes'] + stored['stored_bytes']) / inline['inline_bytes']
+        line = f'  text storage {saved:.0%} smaller'
+        if inline['database_bytes']:
+            line += f', database {1 - stored["database_bytes"] / inline["database_bytes"]:.0%} smaller'
+        print(line)
+        assert results[False][1] == results[True][1], 'analyses differ'
+    finally:
+        teardown()
+
+
+if __name__ == '__main__':
+    main()
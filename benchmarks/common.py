@@ -0,0 +1,57 @@
+"""
+Shared helpers for the benchmark scripts
+
+Benchmarks run against a throwaway test database so they never touch
+db.sqlite3. Run them from the repository root, e.g.
+
+    python -m benchmarks.bench_ingestion
+"""
+import os
+import time
+from contextlib import contextmanager
+
+import django
+
+
+def setup_django():
+    """
+    Configure Django and create a fresh test database
+    Returns a callable that destroys the database again
+    """
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'conversation_analyzer.settings')
+    django.setup()
+
+    from django.db import connection
+    from django.test.utils import setup_test_environment
+
+    setup_test_environment()
+    old_name = connection.settings_dict['NAME']
+    connection.creation.create_test_db(verbosity=0, autoclobber=True)
+
+    def teardown():
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+
+    return teardown
+
+
+@contextmanager
+def timer(results, key):
+    """
+    Store the elapsed wall time of the block in results[key] (seconds)
+    """
+    start = time.perf_counter()
+    yield
+    results[key] = time.perf_counter() - start
+
+
+def make_conversation_payload(index, turns):
+    return {
+        'title': f'Benchmark conversation {index}',
+        'messages': [
+            {
+                'sender': 'user' if turn % 2 == 0 else 'ai',
+                'text': f'Message {turn} of conversation {index}, I need help with my order',
+            }
+            for turn in range(turns)
+        ],
+    }
@@ -0,0 +1,112 @@
+"""
+Synthetic conversations for the benchmarks
+
+Conversations alternate user and AI turns with realistic-looking text:
+words drawn from a Zipf-distributed vocabulary, message lengths from a
+log-normal distribution, a share of lexicon phrases (empathy, fallback,
+resolution) and sentiment words so every metric has work to do, and
+timestamps with log-normal reply delays. Optionally a share of messages
+repeat canned texts, like a bot's templated replies. Output is
+deterministic for a given seed.
+"""
+import math
+import random
+from datetime import datetime, timedelta, timezone
+
+from analysis.services import DEFAULT_LEXICONS
+
+
+SENTIMENT_WORDS = (
+    'great good love happy excellent thanks awesome perfect '
+    'bad terrible angry hate awful broken useless frustrated'
+).split()
+
+
+class ConversationGenerator:
+    """
+    turns: messages per conversation, an int or a (min, max) range
+    words_mean / words_sigma: log-normal words per message (median
+    words_mean), so a few messages are much longer than the rest
+    vocabulary: number of distinct filler words; their frequencies follow
+    Zipf's law like natural text
+    phrase_rate: chance that a message contains a lexicon phrase
+    sentiment_rate: chance that a word is a sentiment word
+    reply_seconds: median user -> AI reply delay
+    template_rate: chance that a message is one of `templates` canned
+    texts instead of a new one; template_words: their median words
+    (words_mean by default), as canned replies tend to be longer
+    """
+
+    def __init__(self, seed=0, turns=10, words_mean=12, words_sigma=0.8,
+                 vocabulary=5000, phrase_rate=0.3, sentiment_rate=0.05,
+                 reply_seconds=20.0, template_rate=0.0, templates=50,
+                 template_words=None):
+        self.rng = random.Random(seed)
+        self.turns = turns if isinstance(turns, (tuple, list)) else (turns, turns)
+        self.words_mu = math.log(words_mean)
+        self.words_sigma = words_sigma
+        self.phrase_rate = phrase_rate
+        self.sentiment_rate = sentiment_rate
+        self.reply_mu = math.log(reply_seconds)
+        self.words = [self._word(index) for index in range(vocabulary)]
+        self.weights = [1 / (rank + 1) for rank in range(vocabulary)]
+        self.phrases = [phrase for phrases in DEFAULT_LEXICONS.values() for phrase in phrases]
+        self.start = datetime(2025, 1, 1, tzinfo=timezone.utc)
+        self.template_rate = template_rate
+        # Drawn from their own generator, so the other texts of a seed do
+        # not depend on the number of templates
+        template_rng = random.Random(f'{seed}-templates')
+        template_mu = math.log(template_words) if template_words else self.words_mu
+        self.templates = [
+            self._new_text(template_rng, template_mu) for _ in range(templates)
+        ] if template_rate else []
+
+    def _word(self, index):
+        # Pronounceable, distinct and stable for a given index
+        consonants, vowels = 'bcdfghjklmnprstvwz', 'aeiou'
+        word = ''
+        index += 1
+        while index:
+            index, digit = divmod(index, len(consonants) * len(vowels))
+            word += consonants[digit % len(consonants)] + vowels[digit // len(consonants)]
+        return word
+
+    def text(self):
+        if self.template_rate and self.rng.random() < self.template_rate:
+            return self.rng.choice(self.templates)
+        return self._new_text(self.rng, self.words_mu)
+
+    def _new_text(self, rng, words_mu):
+        count = max(1, round(rng.lognormvariate(words_mu, self.words_sigma)))
+        words = rng.choices(self.words, self.weights, k=count)
+        for index in range(count):
+            if rng.random() < self.sentiment_rate:
+                words[index] = rng.choice(SENTIMENT_WORDS)
+        if rng.random() < self.phrase_rate:
+            words.insert(rng.randrange(count + 1), rng.choice(self.phrases))
+        return ' '.join(words).capitalize()
+
+    def messages(self, turns=None):
+        if turns is None:
+            turns = self.rng.randint(*self.turns)
+        timestamp = self.start + timedelta(seconds=self.rng.randrange(365 * 86400))
+        messages = []
+        for turn in range(turns):
+            sender = 'user' if turn % 2 == 0 else 'ai'
+            delay = self.rng.lognormvariate(self.reply_mu, 1.0) if sender == 'ai' else self.rng.uniform(5, 120)
+            timestamp += timedelta(seconds=delay)
+            messages.append({'sender': sender, 'text': self.text(), 'timestamp': timestamp.isoformat()})
+        return messages
+
+    def payload(self, index, turns=None):
+        """
+        One conversation in the POST /api/conversations/ format
+        """
+        return {
+            'title': f'Synthetic conversation {index}',
+            'bot': f'bot-{index % 4}',
+            'messages': self.messages(turns),
+        }
+
+    def payloads(self, count, turns=None):
+        return [self.payload(index, turns) for index in range(count)]
@@ -0,0 +1,108 @@
+"""
+Store benchmark results as JSON and compare two runs
+
+    python -m benchmarks.results baseline.json latest.json --threshold 0.1
+
+Exits with status 1 when a measurement got slower by more than the
+threshold, so it can gate CI.
+"""
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+from datetime import datetime, timezone
+
+
+# The statistic each measurement is compared on; lower is better for all
+PRIMARY_STATS = ('us_per_conversation', 'p50_ms')
+
+
+def environment():
+    """
+    Where the numbers come from, to tell apart runs on different machines
+    """
+    import numpy
+    from django.db import connection
+
+    try:
+        commit = subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+
+    return {
+        'created_at': datetime.now(timezone.utc).isoformat(),
+        'commit': commit,
+        'python': platform.python_version(),
+        'numpy': numpy.__version__,
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+        'database': connection.vendor,
+    }
+
+
+def write_results(path, results, args):
+    """
+    results: {measurement name: {statistic: value}}
+    """
+    with open(path, 'w') as f:
+        json.dump(
+            {'environment': environment(), 'arguments': vars(args), 'results': results},
+            f, indent=2, sort_keys=True
+        )
+
+
+def load_results(path):
+    with open(path) as f:
+        return json.load(f)['results']
+
+
+def primary(stats):
+    for name in PRIMARY_STATS:
+        if name in stats:
+            return name, stats[name]
+    return None, None
+
+
+def compare_results(baseline, latest, threshold):
+    """
+    Returns: list of (name, statistic, baseline value, latest value,
+    ratio, regressed) for the measurements found in both runs
+    """
+    rows = []
+    for name in sorted(set(baseline) & set(latest)):
+        stat, old = primary(baseline[name])
+        _, new = primary(latest[name])
+        if stat is None or new is None or not old:
+            continue
+        ratio = new / old
+        rows.append((name, stat, old, new, ratio, ratio > 1 + threshold))
+    return rows
+
+
+def print_comparison(rows):
+    for name, stat, old, new, ratio, regressed in rows:
+        flag = '  REGRESSION' if regressed else ''
+        print(f'  {name:45s} {stat:20s} {old:12.2f} -> {new:12.2f}  {(ratio - 1) * 100:+6.1f}%{flag}')
+    regressions = sum(1 for row in rows if row[-1])
+    print(f'{regressions} regression(s) in {len(rows)} measurements')
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('baseline')
+    parser.add_argument('latest')
+    parser.add_argument('--threshold', type=float, default=0.1, help='Allowed slowdown, 0.1 = 10%%')
+    args = parser.parse_args()
+
+    rows = compare_results(load_results(args.baseline), load_results(args.latest), args.threshold)
+    sys.exit(1 if print_comparison(rows) else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,6 +1,7 @@
 import os
 from celery import Celery
 from celery.schedules import crontab
+from celery.signals import worker_process_init
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'conversation_analyzer.settings')
 
@@ -15,6 +16,23 @@ app.conf.beat_schedule = {
         'task': 'analysis.tasks.analyze_all_new_conversations',
         'schedule': crontab(hour=0, minute=0), 
     },
+    'refresh-relevance-idf-weekly': {
+        'task': 'analysis.tasks.refresh_relevance_idf',
+        'schedule': crontab(hour=23, minute=0, day_of_week='sunday'),
+    },
+    'prune-analysis-jobs-daily': {
+        'task': 'analysis.tasks.prune_analysis_jobs',
+        'schedule': crontab(hour=1, minute=0),
+    },
 }
 
 app.conf.timezone = 'UTC'
+
+
+@worker_process_init.connect
+def warm_up_analyzer(**kwargs):
+    """
+    Load the analyzer in each worker process before its first task
+    """
+    from analysis.services import preload
+    preload()
@@ -134,3 +134,117 @@ CELERY_ACCEPT_CONTENT = ['json']
 CELERY_TASK_SERIALIZER = 'json'
 CELERY_RESULT_SERIALIZER = 'json'
 CELERY_TIMEZONE = 'UTC'
+
+# Bulk ingestion (POST /api/conversations/bulk/)
+BULK_INGEST_BATCH_SIZE = 200
+BULK_INGEST_MAX_ITEMS = 5000
+
+# Conversations analyzed per ConversationAnalyzer.analyze_batch call
+ANALYSIS_BATCH_SIZE = 500
+
+# Load the VADER lexicon and keyword matcher when a server or worker
+# process starts (gunicorn post_fork in gunicorn.conf.py, celery
+# worker_process_init) instead of on its first analysis. Management
+# commands never load them unless they analyze
+ANALYSIS_PRELOAD = True
+
+# Sentiment cache: VADER scores keyed by a hash of the normalized text.
+# SENTIMENT_CACHE_SIZE entries are kept per process (0 disables it); set
+# SENTIMENT_CACHE_REDIS_URL (e.g. to CELERY_BROKER_URL) to share scores
+# between workers, expiring after SENTIMENT_CACHE_TTL seconds. Redis keys
+# include the sentiment engine format and NLTK versions
+SENTIMENT_CACHE_SIZE = 50000
+SENTIMENT_CACHE_REDIS_URL = None
+SENTIMENT_CACHE_TTL = 7 * 24 * 3600
+
+# Nightly analysis fan-out: unanalyzed ids are split into key ranges of
+# ANALYSIS_CHUNK_SIZE, one Celery task each (or a local process pool of
+# ANALYSIS_LOCAL_WORKERS processes when no broker is configured). A chunk
+# claims its rows; claims older than ANALYSIS_CLAIM_TIMEOUT seconds are
+# considered abandoned
+ANALYSIS_CHUNK_SIZE = 1000
+ANALYSIS_CLAIM_TIMEOUT = 3600
+ANALYSIS_LOCAL_WORKERS = None
+
+# List endpoints (/api/reports/, /api/conversations/list/) return keyset
+# pages of API_PAGE_SIZE rows (?limit= up to API_MAX_PAGE_SIZE); with
+# ?format=ndjson they stream every row, reading API_STREAM_CHUNK_SIZE rows
+# at a time. API_UNPAGINATED_LISTS = True restores the old single
+# response with every row, for small installs
+API_PAGE_SIZE = 100
+API_MAX_PAGE_SIZE = 1000
+API_STREAM_CHUNK_SIZE = 2000
+API_UNPAGINATED_LISTS = False
+
+# POST /api/analyse/ queues the analysis and returns 202 with a job id
+# when the request passes "async": true, or by default with
+# ANALYSIS_ASYNC_DEFAULT = True. Without a reachable broker jobs run in a
+# pool of ANALYSIS_LOCAL_THREADS threads inside the web process
+ANALYSIS_ASYNC_DEFAULT = False
+ANALYSIS_LOCAL_THREADS = 2
+
+# Local jobs die with their process: those of a stopped process (checked
+# when a gunicorn worker starts) or older than ANALYSIS_LOCAL_JOB_TIMEOUT
+# seconds are marked failed. Finished jobs are deleted after
+# ANALYSIS_JOB_RETENTION_DAYS days (daily Celery Beat task, or
+# manage.py prune_jobs)
+ANALYSIS_LOCAL_JOB_TIMEOUT = 3600
+ANALYSIS_JOB_RETENTION_DAYS = 7
+
+# Analysis metrics (see analysis/metrics.py). ANALYSIS_METRICS limits
+# every analysis to the listed metric names (None computes all of them;
+# POST /api/analyse/ can still pick its own with "metrics"). Modules in
+# ANALYSIS_METRIC_PLUGINS are imported at startup to register extra or
+# replacement metrics. Per-metric timings are served at /metrics
+ANALYSIS_METRICS = None
+ANALYSIS_METRIC_PLUGINS = []
+
+# Relevance is the cosine similarity of TF-IDF vectors. The IDF table is
+# rebuilt weekly from all messages (or with manage.py refresh_idf),
+# keeping the RELEVANCE_IDF_MAX_TERMS most frequent tokens found in at
+# least RELEVANCE_IDF_MIN_DF messages. Processes check for a newer table
+# every RELEVANCE_IDF_RELOAD seconds
+RELEVANCE_IDF_MIN_DF = 2
+RELEVANCE_IDF_MAX_TERMS = 100000
+RELEVANCE_IDF_RELOAD = 300
+
+# Batch analysis (nightly task, imports) saves results with one bulk
+# upsert per ANALYSIS_WRITE_BATCH_SIZE analyses, or sooner once the oldest
+# pending result is ANALYSIS_WRITE_INTERVAL seconds old
+ANALYSIS_WRITE_BATCH_SIZE = 500
+ANALYSIS_WRITE_INTERVAL = 10.0
+
+# The async endpoints (/api/async/..., served by an ASGI server such as
+# uvicorn) run analyses on a pool of ANALYSIS_ASYNC_THREADS threads, so
+# the event loop is never blocked by the analyzer
+ANALYSIS_ASYNC_THREADS = 4
+
+# VADER sentiment is scored from tables compiled out of NLTK's lexicon and
+# rules, saved to SENTIMENT_ENGINE_FILE by manage.py compile_sentiment.
+# If the file is missing or was compiled from another NLTK version (or
+# with None) each process compiles them in memory
+SENTIMENT_ENGINE_FILE = BASE_DIR / 'sentiment_engine.marshal'
+
+# With MESSAGE_TEXT_DEDUP, uploaded message texts of at least
+# MESSAGE_TEXT_MIN_LENGTH characters are stored once in MessageText,
+# keyed by their hash, and zlib-compressed from MESSAGE_TEXT_COMPRESS_MIN
+# bytes. Loaded messages get their text back transparently; each process
+# caches MESSAGE_TEXT_CACHE_SIZE texts. A reference takes 32 characters,
+# so shorter texts only pay off when repeated many times
+MESSAGE_TEXT_DEDUP = False
+MESSAGE_TEXT_MIN_LENGTH = 64
+MESSAGE_TEXT_COMPRESS_MIN = 512
+MESSAGE_TEXT_CACHE_SIZE = 10000
+
+# manage.py archive_conversations moves old conversations' messages and
+# analyses to compressed columnar files in ARCHIVE_DIR, one file per
+# ARCHIVE_CHUNK_SIZE conversations (see analysis/archive.py)
+ARCHIVE_DIR = BASE_DIR / 'archive'
+ARCHIVE_CHUNK_SIZE = 5000
+
+# /api/reports/export/ and manage.py export_analyses stream analyses as
+# CSV, NDJSON or Parquet (with pyarrow installed), reading
+# EXPORT_CHUNK_SIZE rows at a time (one Parquet row group each); gzipped
+# exports use zlib level EXPORT_GZIP_LEVEL, fast enough to keep up
+EXPORT_CHUNK_SIZE = 10000
+EXPORT_GZIP_LEVEL = 1
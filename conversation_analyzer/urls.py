@@ -1,7 +1,10 @@
 from django.contrib import admin
 from django.urls import path, include
 
+from analysis.views import prometheus_metrics
+
 urlpatterns = [
     path('admin/', admin.site.urls),
     path('api/', include('analysis.urls')),
+    path('metrics', prometheus_metrics, name='prometheus-metrics'),
 ]
@@ -0,0 +1,23 @@
+"""
+Gunicorn settings, read from the working directory:
+
+    gunicorn conversation_analyzer.wsgi
+"""
+import os
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'conversation_analyzer.settings')
+
+
+def post_fork(server, worker):
+    """
+    Load the analyzer in each worker before it serves its first request
+    (see analysis.services.preload), and fail the local jobs a previous
+    worker lost (see analysis.jobs.fail_lost_jobs)
+    """
+    import django
+    django.setup()
+
+    from analysis.jobs import fail_lost_jobs
+    from analysis.services import preload
+    preload()
+    fail_lost_jobs()